@@ -0,0 +1,307 @@
+"""
+Офлайн-бенчмарк бота: настоящий Dispatcher с роутером и middleware из main.py,
+Bot API — локальная фейковая сессия, Redis — fakeredis (или локальный Redis).
+
+Прогоняет синтетические заказы (/start → напиток → количество → оформить →
+подтвердить → время готовности) или записанные апдейты и печатает пропускную
+способность, p50/p95/p99 по апдейтам и хендлерам и число обращений к Redis на апдейт.
+fakeredis сам по себе дорогой по CPU, поэтому абсолютные цифры сравнивать только
+между прогонами на одной машине; число обращений к Redis от этого не зависит.
+
+    pip install -r requirements-bench.txt
+    python bench.py --flows 500 --concurrency 50
+    python bench.py --replay updates.jsonl      # по одному сырому Update в строке
+    python bench.py --json > result.json        # для сравнения между коммитами
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+# main.py читает окружение и config.json при импорте: данные — во временный каталог,
+# меню и часы работы — из config.json рядом со скриптом
+_HERE = os.path.dirname(os.path.abspath(__file__))
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="cafebot-bench-")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+if os.path.exists(os.path.join(_HERE, "config.json")):
+    shutil.copy(os.path.join(_HERE, "config.json"), os.environ["DATA_DIR"])
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.base import BaseSession
+from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.types import Chat, Message, Update, User
+
+import main
+
+BENCH_TOKEN = "123456:bench"
+BENCH_USER_ID_BASE = 7_000_000_000  # не пересекается с ADMIN_ID и реальными id
+
+
+class FakeTelegramSession(BaseSession):
+    """Bot API без сети: на send*/edit* отвечает фиктивным Message, на остальное — True."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = 0
+        self._message_id = 0
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        if False:
+            yield b""
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        returning = method.__returning__
+        if returning is Message:
+            self._message_id += 1
+            chat_id = getattr(method, "chat_id", 0)
+            return Message(
+                message_id=self._message_id,
+                date=datetime.now(),
+                chat=Chat(id=chat_id if isinstance(chat_id, int) else 0, type="private"),
+                text=getattr(method, "text", None),
+            ).as_(bot)
+        if returning is User:
+            return User(id=int(BENCH_TOKEN.split(":")[0]), is_bot=True, first_name="bench")
+        return True
+
+
+class UpdateProbe(BaseMiddleware):
+    """Последний outer-middleware: запоминает счётчик Redis, который ведёт MetricsMiddleware."""
+
+    def __init__(self):
+        self.redis_usage: Dict[int, list] = {}
+
+    async def __call__(self, handler, event: Update, data: Dict[str, Any]) -> Any:
+        usage = data.get("redis_usage")
+        if usage is not None:
+            self.redis_usage[event.update_id] = usage
+        return await handler(event, data)
+
+
+class HandlerProbe(BaseMiddleware):
+    """Inner-middleware диспетчера: время каждого хендлера без FSM и прочих middleware."""
+
+    def __init__(self):
+        self.latency: Dict[str, List[float]] = {}
+
+    async def __call__(self, handler, event, data: Dict[str, Any]) -> Any:
+        name = getattr(getattr(data.get("handler"), "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.latency.setdefault(name, []).append(time.perf_counter() - started)
+
+
+def message_update(update_id: int, user_id: int, text: str) -> Dict[str, Any]:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"bench{user_id}"},
+            "text": text,
+        },
+    }
+
+
+def order_flow(user_id: int, first_update_id: int, drink: str) -> List[Dict[str, Any]]:
+    texts = ["/start", drink, "2", main.BTN_CHECKOUT, main.BTN_CONFIRM, main.BTN_READY_20]
+    return [message_update(first_update_id + i, user_id, text) for i, text in enumerate(texts)]
+
+
+def synthetic_chats(flows: int, offset: int = 0) -> List[List[Dict[str, Any]]]:
+    drinks = list(main.MENU)
+    chats = []
+    for i in range(offset, offset + flows):
+        chats.append(order_flow(BENCH_USER_ID_BASE + i, i * 10 + 1, drinks[i % len(drinks)]))
+    return chats
+
+
+def replay_chats(path: str) -> List[List[Dict[str, Any]]]:
+    """Апдейты одного чата идут строго по порядку, разные чаты — параллельно (как в UpdateExecutor)."""
+    chats: Dict[int, List[Dict[str, Any]]] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                update = json.loads(line)
+                chats.setdefault(main.update_shard_key(update), []).append(update)
+    return list(chats.values())
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))]
+
+
+class Bench:
+    def __init__(self, api_latency: float = 0.0):
+        self.session = FakeTelegramSession(latency=api_latency)
+        self.bot = main.build_bot(BENCH_TOKEN, session=self.session)
+        self.storage: Optional[RedisStorage] = None
+        self.dp = None
+        self.update_probe = UpdateProbe()
+        self.handler_probe = HandlerProbe()
+        self.update_latency: List[float] = []
+        self.errors = 0
+
+    async def setup(self, redis_url: Optional[str] = None):
+        if redis_url:
+            pool = main.InstrumentedRedisPool.from_url(
+                redis_url, decode_responses=True, max_connections=main.REDIS_POOL_MAX_CONNECTIONS
+            )
+        else:
+            try:
+                import fakeredis
+            except ImportError:
+                sys.exit("bench.py: нужен fakeredis с Lua — pip install -r requirements-bench.txt")
+            pool = main.InstrumentedRedisPool(
+                connection_class=getattr(
+                    fakeredis.aioredis, "FakeAsyncRedisConnection", fakeredis.aioredis.FakeConnection
+                ),
+                server=fakeredis.FakeServer(),
+                decode_responses=True,
+                max_connections=main.REDIS_POOL_MAX_CONNECTIONS,
+                timeout=main.REDIS_POOL_TIMEOUT_SECONDS,
+            )
+        self.storage = RedisStorage(redis=main.init_redis_pool(pool))
+        self.dp = main.build_dispatcher(self.storage)
+        self.dp.update.outer_middleware(self.update_probe)
+        self.dp.message.middleware(self.handler_probe)
+        self.dp.callback_query.middleware(self.handler_probe)
+        # кафе всегда открыто, иначе оформление упирается в часы работы
+        main.WORK_START, main.WORK_END = 0, 24
+
+    async def close(self):
+        await self.storage.close()
+        await main.close_redis_pool()
+
+    def reset(self):
+        self.update_probe.redis_usage.clear()
+        self.handler_probe.latency.clear()
+        self.update_latency.clear()
+        self.session.calls = 0
+        self.errors = 0
+
+    async def _run_chat(self, updates: List[Dict[str, Any]], gate: asyncio.Semaphore):
+        async with gate:
+            for update in updates:
+                started = time.perf_counter()
+                try:
+                    await self.dp.feed_raw_update(self.bot, update)
+                except Exception as e:
+                    self.errors += 1
+                    print(f"update_id={update.get('update_id')}: {type(e).__name__}: {e}", file=sys.stderr)
+                self.update_latency.append(time.perf_counter() - started)
+
+    async def run(self, chats: List[List[Dict[str, Any]]], concurrency: int) -> float:
+        gate = asyncio.Semaphore(concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*(self._run_chat(updates, gate) for updates in chats))
+        return time.perf_counter() - started
+
+    def report(self, elapsed: float, concurrency: int) -> Dict[str, Any]:
+        updates = len(self.update_latency)
+        roundtrips = [usage[0] for usage in self.update_probe.redis_usage.values()]
+
+        def ms(values: List[float]) -> Dict[str, float]:
+            return {
+                "p50": round(percentile(values, 50) * 1000, 3),
+                "p95": round(percentile(values, 95) * 1000, 3),
+                "p99": round(percentile(values, 99) * 1000, 3),
+                "max": round(max(values, default=0.0) * 1000, 3),
+            }
+
+        return {
+            "updates": updates,
+            "errors": self.errors,
+            "concurrency": concurrency,
+            "seconds": round(elapsed, 3),
+            "updates_per_second": round(updates / elapsed, 1) if elapsed else 0.0,
+            "update_ms": ms(self.update_latency),
+            "redis_roundtrips_per_update": {
+                "mean": round(sum(roundtrips) / len(roundtrips), 2) if roundtrips else 0.0,
+                "p50": percentile(roundtrips, 50),
+                "p95": percentile(roundtrips, 95),
+                "max": max(roundtrips, default=0),
+            },
+            "bot_api_calls_per_update": round(self.session.calls / updates, 2) if updates else 0.0,
+            "handlers": {
+                name: {"count": len(values), **ms(values)}
+                for name, values in sorted(self.handler_probe.latency.items(), key=lambda kv: -len(kv[1]))
+            },
+        }
+
+
+def print_report(result: Dict[str, Any]):
+    u = result["update_ms"]
+    r = result["redis_roundtrips_per_update"]
+    print(
+        f"updates: {result['updates']} за {result['seconds']} с → {result['updates_per_second']} upd/s "
+        f"(concurrency {result['concurrency']}, ошибок {result['errors']})"
+    )
+    print(f"update, ms:  p50 {u['p50']}  p95 {u['p95']}  p99 {u['p99']}  max {u['max']}")
+    print(f"redis round trips / update:  mean {r['mean']}  p50 {r['p50']}  p95 {r['p95']}  max {r['max']}")
+    print(f"bot api calls / update: {result['bot_api_calls_per_update']}")
+    print()
+    print(f"{'handler':<32}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, h in result["handlers"].items():
+        print(f"{name:<32}{h['count']:>8}{h['p50']:>10}{h['p95']:>10}{h['p99']:>10}")
+
+
+async def run_bench(args: argparse.Namespace) -> Dict[str, Any]:
+    bench = Bench(api_latency=args.api_latency_ms / 1000)
+    await bench.setup(args.redis_url)
+    try:
+        # прогрев: загрузка Lua-скриптов, первые ключи — в результат не идёт
+        if args.warmup:
+            await bench.run(synthetic_chats(args.warmup, offset=args.flows), args.concurrency)
+            bench.reset()
+        chats = replay_chats(args.replay) if args.replay else synthetic_chats(args.flows)
+        elapsed = await bench.run(chats, args.concurrency)
+        return bench.report(elapsed, args.concurrency)
+    finally:
+        await bench.close()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк обработки апдейтов")
+    parser.add_argument("--flows", type=int, default=300, help="синтетических заказов (по одному на пользователя)")
+    parser.add_argument("--concurrency", type=int, default=50, help="чатов, обрабатываемых одновременно")
+    parser.add_argument("--warmup", type=int, default=20, help="заказов на прогрев, не входят в отчёт")
+    parser.add_argument("--replay", help="JSONL с сырыми апдейтами вместо синтетики")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="искусственная задержка Bot API")
+    parser.add_argument("--redis-url", help="локальный Redis вместо fakeredis (пишет ключи — берите отдельную БД)")
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = parser.parse_args()
+
+    try:
+        result = asyncio.run(run_bench(args))
+    finally:
+        main.stop_logging()
+        shutil.rmtree(os.environ["DATA_DIR"], ignore_errors=True)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,34 +1,164 @@
 import os
 import json
+import math
 import logging
+import logging.handlers
 import asyncio
+import queue
 import time
 import random
 import re
+import signal
+import socket
+import sys
+import threading
+import traceback
+from collections import deque
 from datetime import datetime, timezone, timedelta
 from typing import Dict, Any, Optional, Tuple
+from dataclasses import asdict, dataclass, field
 import base64
+import cProfile
+import io
+import pstats
+import bisect
+import contextvars
+import copy
+import functools
+import hmac
 
 import redis.asyncio as redis
 from aiohttp import web
 
-from aiogram import Bot, Dispatcher, F, Router, html
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router, html
 from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.fsm.middleware import FSMContextMiddleware
+from aiogram.types import BufferedInputFile, Update, Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.filters import CommandStart, Command, StateFilter
 from aiogram.client.default import DefaultBotProperties
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.client.session.base import BaseSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import BaseRequestHandler, setup_application
 
 import uuid
 import httpx  # не забудь в requirements.txt: httpx>=0.27.0,<1.0
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+# ---------------- Logging ----------------
+# Хендлеры логов не пишут в stdout из event loop: записи уходят в очередь, а
+# форматирование и вывод делает поток QueueListener. Дампы апдейтов и HTTP-запросов
+# пишутся выборочно (LOG_*_SAMPLE_RATE), с обрезкой и маскированием персональных полей.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text | json
+LOG_UPDATES_SAMPLE_RATE = float(os.getenv("LOG_UPDATES_SAMPLE_RATE", 0.01))
+LOG_HTTP_SAMPLE_RATE = float(os.getenv("LOG_HTTP_SAMPLE_RATE", 0.05))
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", 2000))
+LOG_REDACT_FIELDS = frozenset({"phone_number", "first_name", "last_name", "username", "email", "vcard"})
+
+
+def _redact(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {k: "***" if k in LOG_REDACT_FIELDS else _redact(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_redact(v) for v in value]
+    return value
+
+
+class LazyPayload:
+    """Сериализуется в потоке логирования, а не в хендлере; результат маскируется и обрезается."""
+
+    def __init__(self, build):
+        self._build = build
+
+    def __str__(self) -> str:
+        try:
+            text = json.dumps(_redact(self._build()), ensure_ascii=False, default=str)
+        except Exception as e:
+            text = f"<payload error: {e}>"
+        if len(text) > LOG_PAYLOAD_MAX_CHARS:
+            text = text[:LOG_PAYLOAD_MAX_CHARS] + f"…(+{len(text) - LOG_PAYLOAD_MAX_CHARS})"
+        return text
+
+
+class StructuredFormatter(logging.Formatter):
+    """Поля из extra={"fields": {...}}: key=value в текстовом формате, ключи объекта в json."""
+
+    def __init__(self, as_json: bool):
+        super().__init__("%(asctime)s - %(levelname)s - %(message)s")
+        self.as_json = as_json
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", None) or {}
+        if self.as_json:
+            payload = {
+                "ts": self.formatTime(record),
+                "level": record.levelname,
+                "logger": record.name,
+                "msg": record.getMessage(),
+                **{k: str(v) if isinstance(v, LazyPayload) else v for k, v in fields.items()},
+            }
+            if record.exc_info:
+                payload["exc"] = self.formatException(record.exc_info)
+            return json.dumps(payload, ensure_ascii=False, default=str)
+
+        if fields:
+            record = logging.makeLogRecord(record.__dict__)
+            record.msg = record.getMessage() + " " + " ".join(f"{k}={v}" for k, v in fields.items())
+            record.args = None
+        return super().format(record)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # очередь внутри процесса: форматировать здесь незачем, это сделает поток listener'а
+        return record
+
+
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging():
+    global _log_listener
+    if _log_listener is not None:
+        return
+    stream = logging.StreamHandler()
+    stream.setFormatter(StructuredFormatter(as_json=LOG_FORMAT == "json"))
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [_DeferredQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    _log_listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    _log_listener.start()
+
+
+def stop_logging():
+    global _log_listener
+    listener, _log_listener = _log_listener, None
+    if listener is not None:
+        listener.stop()
+
+
+def log_sampled(rate: float) -> bool:
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+setup_logging()
 logger = logging.getLogger(__name__)
 
 MSK_TZ = timezone(timedelta(hours=3))
-RATE_LIMIT_SECONDS = 60
+RATE_LIMIT_SECONDS = 60  # минимальный интервал между заказами
+RATE_LIMIT_BOOKINGS_PER_HOUR = int(os.getenv("RATE_LIMIT_BOOKINGS_PER_HOUR", 5))
+RATE_LIMIT_TEXT_PER_MINUTE = int(os.getenv("RATE_LIMIT_TEXT_PER_MINUTE", 30))
 
 # --- DEMO mode ---
 DEMO_MODE = True  # в клиентской версии можно будет выключить
@@ -39,16 +169,53 @@ CONFIG_PATH = os.path.join(DATA_DIR, "config.json")
 
 # --- Redis keys ---
 MENU_REDIS_KEY = "menu:items"  # hash: {drink_name: price}
+MENU_VERSION_KEY = "menu:version"  # int, растёт при каждом изменении меню
+MENU_CHANNEL = "menu:invalidate"  # pub/sub: новая версия меню для других реплик
+MENU_LISTENER_RETRY_SECONDS = 5
 
 # Stats keys
 STATS_TOTAL_ORDERS = "stats:total_orders"
 STATS_TOTAL_REVENUE = "stats:total_revenue"
+STATS_DRINKS_KEY = "stats:drinks"  # hash: {drink_name: qty}
+STATS_DRINKS_REV_KEY = "stats:drinks_revenue"  # hash: {drink_name: revenue}
+# Старый формат: отдельная строка на каждую позицию; переносится в hash на старте
 STATS_DRINK_PREFIX = "stats:drink:"
 STATS_DRINK_REV_PREFIX = "stats:drink_revenue:"
+STATS_MIGRATED_KEY = "stats:migrated:drinks_hash"
+# Бакеты по времени (МСК): hash с полями orders, revenue, qty:<drink>, rev:<drink>;
+# в дневном бакете дополнительно hour:<HH> — число заказов по часам.
+STATS_HOUR_PREFIX = "stats:h:"  # stats:h:YYYYMMDDHH
+STATS_DAY_PREFIX = "stats:d:"  # stats:d:YYYYMMDD
+STATS_HOUR_TTL_SECONDS = 35 * 86400
+STATS_DAY_TTL_SECONDS = 400 * 86400
+
+# Журнал заказов: поток с номером заказа и позициями, читают группы потребителей
+ORDER_SEQ_KEY = "orders:seq"
+ORDER_STREAM_KEY = "orders:stream"
+# orders:stream режется не по длине, а по прогрессу групп (XTRIM MINID): запись удаляется,
+# только когда её прочитали и подтвердили все группы, — отставшая группа ничего не теряет
+ORDER_TRIM_INTERVAL_SECONDS = 60
+ORDER_CONSUMER_IDLE_DELETE_MS = 24 * 3600 * 1000  # консьюмеры прошлых процессов без pending
+ORDER_GROUP_STATS = "stats"
+ORDER_GROUP_PROFILE = "profile"
+ORDER_GROUP_NOTIFY = "notify"
+# имя консьюмера — своё у каждого процесса: pending, счётчики доставок и XAUTOCLAIM
+# разделяют реплики, а не смешивают их записи под одним именем
+ORDER_CONSUMER_NAME = os.getenv("ORDER_CONSUMER_NAME") or f"{socket.gethostname()}-{os.getpid()}"
+ORDER_READ_COUNT = 50
+ORDER_BLOCK_MS = 5000
+ORDER_CLAIM_IDLE_MS = 60_000
+ORDER_RETRY_SECONDS = 5
+# Запись, которую группа не смогла обработать за ORDER_MAX_DELIVERIES доставок, уходит в orders:dead
+ORDER_MAX_DELIVERIES = int(os.getenv("ORDER_MAX_DELIVERIES", 5))
+ORDER_DEAD_STREAM_KEY = "orders:dead"
+ORDER_DEAD_MAXLEN = 10_000
 
 # Per-user "repeat last order"
 LAST_SEEN_KEY_PREFIX = "last_seen:"   # string timestamp
 LAST_ORDER_KEY_PREFIX = "last_order:" # string json snapshot
+CART_KEY_PREFIX = "cart:"  # hash: drink -> qty
+CART_TTL_SECONDS = 24 * 3600  # брошенная корзина живёт сутки с последнего изменения
 
 # Drafts for payment notifications (admin approves sending to user)
 PAY_DRAFT_PREFIX = "paydraft:"  # key -> json
@@ -60,6 +227,20 @@ def _pay_draft_key(draft_id: str) -> str:
 CUSTOMERS_SET_KEY = "customers:set"
 CUSTOMER_KEY_PREFIX = "customer:"
 CUSTOMER_DRINKS_PREFIX = "customer:drinks:"
+CUSTOMERS_DUE_KEY = "customers:due"  # zset: user_id -> когда можно слать напоминание
+CUSTOMERS_DUE_INDEXED_KEY = "customers:due_indexed"
+CUSTOMERS_FAVORITES_INDEXED_KEY = "customers:favorites_indexed"
+
+# Сегменты аудитории: обновляются скриптом заказа, собираются на стороне Redis
+SEGMENT_DRINK_PREFIX = "seg:drink:"  # set: кто хоть раз брал позицию
+SEGMENT_SPEND_KEY = "seg:spend"  # zset: user_id -> total_spent
+SEGMENT_ORDERS_KEY = "seg:orders"  # zset: user_id -> total_orders
+SEGMENT_RECENCY_KEY = "seg:recency"  # zset: user_id -> last_order_ts
+SEGMENTS_INDEXED_KEY = "seg:indexed"
+SEGMENT_RESULT_PREFIX = "seg:result:"
+SEGMENT_RESULT_TTL_SECONDS = 30 * 60
+RETURN_LOCK_KEY = "customers:return_lock"
+RETURN_BATCH = 200
 
 DEFAULT_RETURN_CYCLE_DAYS = 7
 RETURN_COOLDOWN_DAYS = 30
@@ -67,10 +248,47 @@ RETURN_CHECK_EVERY_SECONDS = 6 * 60 * 60
 RETURN_SEND_FROM_HOUR = 10
 RETURN_SEND_TO_HOUR = 20
 RETURN_DISCOUNT_PERCENT = 10
+RETURN_RETRY_SECONDS = 60 * 60  # повтор для клиентов, которым не удалось отправить из-за временной ошибки
+
+# Исходящие рассылки: лимиты Telegram ~30 сообщений/с на бота и ~1/с на чат.
+# Уведомления персоналу (outbox) идут отдельной полосой со своим token bucket, чтобы не
+# стоять в очереди за тысячами рекламных отправок; сумма двух лимитов — в пределах бота.
+OUTBOUND_RATE_PER_SECOND = float(os.getenv("OUTBOUND_RATE_PER_SECOND", 25))
+OUTBOUND_CONCURRENCY = int(os.getenv("OUTBOUND_CONCURRENCY", 8))
+OUTBOUND_PER_CHAT_INTERVAL = 1.0
+OUTBOUND_MAX_RETRIES = 3
+OUTBOX_RATE_PER_SECOND = float(os.getenv("OUTBOX_RATE_PER_SECOND", 5))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", 4))
+
+# Рассылки владельца: задания в Redis, воркер идёт по customers:set через SSCAN с сохранением курсора
+BROADCAST_SEQ_KEY = "broadcast:seq"
+BROADCAST_QUEUE_KEY = "broadcast:queue"
+BROADCAST_JOB_PREFIX = "broadcast:job:"
+BROADCAST_LOCK_KEY = "broadcast:worker_lock"
+BROADCAST_CHUNK = 200
+BROADCAST_POLL_SECONDS = 5
+BROADCAST_LOCK_TTL_SECONDS = 5 * 60
+BROADCAST_KEEP_SECONDS = 30 * 24 * 3600
+
+# Outbox уведомлений админу/персоналу: zset outbox:pending (id -> когда отправлять)
+# + hash outbox:item:<id>; недоставленные после OUTBOX_MAX_ATTEMPTS — в список outbox:dead
+OUTBOX_PENDING_KEY = "outbox:pending"
+OUTBOX_ITEM_PREFIX = "outbox:item:"
+OUTBOX_DEAD_KEY = "outbox:dead"
+OUTBOX_BATCH = 20
+OUTBOX_POLL_SECONDS = 1
+OUTBOX_LEASE_SECONDS = 60  # взятое в работу, но не подтверждённое — снова в очереди через минуту
+OUTBOX_LEASE_RENEW_SECONDS = 20  # пока пачка отправляется, аренда продлевается с этим шагом
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_BASE_SECONDS = 5
+OUTBOX_DEAD_MAX = 1000
+OUTBOX_DEAD_KEEP_SECONDS = 30 * 24 * 3600
 
 # Подписки Cafebotify
-SUBS_CHECK_EVERY_SECONDS = 24 * 60 * 60  # раз в сутки
+SUBS_CHECK_EVERY_SECONDS = 5 * 60  # сканер читает только окно zset, можно часто
 SUBS_REMIND_DAYS_BEFORE = 3
+SUBS_SCAN_BATCH = 100
+SUBS_SCAN_LOCK_KEY = "subs:scan_lock"
 
 
 def get_moscow_time() -> datetime:
@@ -153,6 +371,7 @@ ADMIN_ID = int(cafe_config["admin_chat_id"])
 CAFE_ADDRESS = cafe_config.get("address", "")
 
 MENU: Dict[str, int] = dict(cafe_config["menu"])
+MENU_VERSION: Optional[int] = None  # версия меню из Redis, с которой синхронизирован MENU
 WORK_START = int(cafe_config["work_start"])
 WORK_END = int(cafe_config["work_end"])
 RETURN_CYCLE_DAYS = int(cafe_config.get("return_cycle_days", DEFAULT_RETURN_CYCLE_DAYS))
@@ -205,12 +424,505 @@ def build_links_text(cafe_code: str) -> str:
         "<code>/bind </code><i>(дописать код вручную)</i>"
     )
 
+# router — только реестр хендлеров из декораторов, сам он ни к чему не подключается:
+# каждый Dispatcher получает свою копию из create_router()
 router = Router()
 
 
+def create_router() -> Router:
+    """Новый Router с хендлерами модульного router; его можно подключать к любому числу диспетчеров."""
+    fresh = Router(name=router.name)
+    for event_name, observer in router.observers.items():
+        fresh.observers[event_name].handlers.extend(observer.handlers)
+    return fresh
+
+
+# ---------------- Metrics ----------------
+# Метрики в текстовом формате Prometheus на /metrics. Всё живёт в одном event loop,
+# поэтому коллекторы — обычные dict без блокировок: observe() — bisect и пара
+# инкрементов. Кумулятивные бакеты гистограмм считаются только при выдаче.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # пусто — /metrics без авторизации
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+
+def _metric_label_value(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def _metric_labels(names: Tuple[str, ...], values: Tuple[Any, ...], le: Optional[str] = None) -> str:
+    pairs = [f'{n}="{_metric_label_value(v)}"' for n, v in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values: Dict[Tuple[Any, ...], float] = {}
+
+    def inc(self, *labels: Any, value: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + value
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{_metric_labels(self.labels, k)} {v:g}" for k, v in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: Any, value: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) - value
+
+    def set(self, *labels: Any, value: float):
+        self._values[labels] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [счётчики по бакетам (последний — +Inf), сумма]
+        self._series: Dict[Tuple[Any, ...], list] = {}
+
+    def observe(self, *labels: Any, value: float):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list[str]:
+        lines = []
+        for key, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_metric_labels(self.labels, key, format(bound, 'g'))} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{self.name}_bucket{_metric_labels(self.labels, key, '+Inf')} {cumulative}")
+            lines.append(f"{self.name}_sum{_metric_labels(self.labels, key)} {total:g}")
+            lines.append(f"{self.name}_count{_metric_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list = []
+        self._collectors: list = []
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self._add(Gauge(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = METRICS_LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def collector(self, fn):
+        """fn() -> [(name, kind, help_text, {label_tuple: value}, label_names)] — снимается при каждой выдаче."""
+        self._collectors.append(fn)
+        return fn
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        out = []
+        for m in self._metrics:
+            out.append(f"# HELP {m.name} {m.help_text}")
+            out.append(f"# TYPE {m.name} {m.kind}")
+            out.extend(m.render())
+        for fn in self._collectors:
+            try:
+                families = fn()
+            except Exception as e:
+                logger.error(f"metrics collector {getattr(fn, '__name__', fn)} failed: {e}")
+                continue
+            for name, kind, help_text, values, label_names in families:
+                out.append(f"# HELP {name} {help_text}")
+                out.append(f"# TYPE {name} {kind}")
+                out.extend(f"{name}{_metric_labels(label_names, k)} {v:g}" for k, v in values.items())
+        return "\n".join(out) + "\n"
+
+
+metrics = MetricsRegistry()
+
+METRIC_UPDATE_SECONDS = metrics.histogram(
+    "bot_update_seconds", "Полное время обработки апдейта, включая FSM и rate limit", ("type",))
+METRIC_UPDATES_IN_FLIGHT = metrics.gauge("bot_updates_in_flight", "Апдейты в обработке")
+METRIC_UPDATE_REDIS_CALLS = metrics.histogram(
+    "bot_update_redis_roundtrips", "Обращений к Redis за один апдейт", ("type",), METRICS_COUNT_BUCKETS)
+METRIC_UPDATE_REDIS_SECONDS = metrics.histogram(
+    "bot_update_redis_seconds", "Суммарное время ожидания Redis за один апдейт", ("type",))
+METRIC_HANDLER_SECONDS = metrics.histogram("bot_handler_seconds", "Время работы хендлера", ("handler",))
+METRIC_STATE_SECONDS = metrics.histogram("bot_state_seconds", "Время работы хендлеров по FSM-состоянию", ("state",))
+METRIC_HANDLER_ERRORS = metrics.counter("bot_handler_errors_total", "Исключения из хендлеров", ("handler", "error"))
+METRIC_HANDLERS_IN_FLIGHT = metrics.gauge("bot_handlers_in_flight", "Хендлеры в работе", ("handler",))
+METRIC_REDIS_COMMANDS = metrics.counter("redis_commands_total", "Команды Redis (pipeline — одна запись)", ("command",))
+METRIC_REDIS_SECONDS = metrics.histogram("redis_command_seconds", "Задержка команд Redis", ("command",))
+METRIC_REDIS_ERRORS = metrics.counter("redis_command_errors_total", "Ошибки команд Redis", ("command",))
+METRIC_TELEGRAM_SECONDS = metrics.histogram("telegram_api_seconds", "Задержка вызовов Bot API", ("method",))
+METRIC_TELEGRAM_ERRORS = metrics.counter("telegram_api_errors_total", "Ошибки вызовов Bot API", ("method", "error"))
+
+# [обращений, секунд] к Redis в рамках текущего апдейта; вне апдейта — None
+_update_redis_usage: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("update_redis_usage", default=None)
+
+
+def _record_redis_call(command: str, elapsed: float, failed: bool = False):
+    METRIC_REDIS_COMMANDS.inc(command)
+    METRIC_REDIS_SECONDS.observe(command, value=elapsed)
+    if failed:
+        METRIC_REDIS_ERRORS.inc(command)
+    usage = _update_redis_usage.get()
+    if usage is not None:
+        usage[0] += 1
+        usage[1] += elapsed
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Внешний middleware апдейта: общее время, in-flight и расход Redis на апдейт."""
+
+    async def __call__(self, handler, event: Update, data: Dict[str, Any]) -> Any:
+        kind = event.event_type
+        usage = [0, 0.0]
+        token = _update_redis_usage.set(usage)
+        data["redis_usage"] = usage
+        METRIC_UPDATES_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            METRIC_UPDATE_SECONDS.observe(kind, value=time.perf_counter() - started)
+            METRIC_UPDATES_IN_FLIGHT.dec()
+            METRIC_UPDATE_REDIS_CALLS.observe(kind, value=usage[0])
+            METRIC_UPDATE_REDIS_SECONDS.observe(kind, value=usage[1])
+            _update_redis_usage.reset(token)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware роутера: время и ошибки конкретного хендлера и FSM-состояния."""
+
+    async def __call__(self, handler, event, data: Dict[str, Any]) -> Any:
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        state = data.get("raw_state") or "none"
+        METRIC_HANDLERS_IN_FLIGHT.inc(name)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            METRIC_HANDLER_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            METRIC_HANDLER_SECONDS.observe(name, value=elapsed)
+            METRIC_STATE_SECONDS.observe(state, value=elapsed)
+            METRIC_HANDLERS_IN_FLIGHT.dec(name)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: задержка и ошибки исходящих вызовов Bot API."""
+
+    async def __call__(self, make_request, bot: Bot, method: TelegramMethod):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            METRIC_TELEGRAM_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            METRIC_TELEGRAM_SECONDS.observe(name, value=time.perf_counter() - started)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    if METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"
+    ):
+        return web.Response(status=401)
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+# ---------------- Event loop monitor ----------------
+# Весь бот — один event loop, любой синхронный кусок (файловый I/O, тяжёлый json)
+# тормозит все вебхуки сразу. Задача-пульс отмечается каждые LOOP_MONITOR_INTERVAL
+# секунд и меряет лаг loop. Сторожевой поток следит за пульсом: если loop молчит
+# дольше порога, он снимает стек главного потока — это и есть код, который держит
+# loop, — и пишет его в лог. Когда loop отпускает, пульс учитывает блокировку в метриках.
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", 0.1))
+LOOP_BLOCK_THRESHOLD_SECONDS = float(os.getenv("LOOP_BLOCK_THRESHOLD_SECONDS", 0.2))
+LOOP_STACK_DEPTH = int(os.getenv("LOOP_STACK_DEPTH", 12))
+LOOP_OFFENDERS_MAX = 20
+
+METRIC_LOOP_LAG = metrics.histogram("event_loop_lag_seconds", "Опоздание пульса event loop")
+METRIC_LOOP_BLOCKED = metrics.counter(
+    "event_loop_blocked_total", "Блокировки loop дольше порога по месту в коде", ("where",))
+METRIC_LOOP_BLOCKED_SECONDS = metrics.histogram("event_loop_blocked_seconds", "Длительность блокировок loop")
+
+
+def _blocking_location(stack: list[traceback.FrameSummary]) -> str:
+    """Самый глубокий кадр из main.py (наш код), иначе — самый глубокий вообще."""
+    for frame in reversed(stack):
+        if frame.filename == __file__:
+            return f"{frame.name}:{frame.lineno}"
+    frame = stack[-1]
+    return f"{os.path.basename(frame.filename)}:{frame.name}:{frame.lineno}"
+
+
+class LoopMonitor:
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = 0.0
+        self.blocked_total = 0
+        self.offenders: Dict[str, int] = {}
+        self._beat = time.monotonic()
+        self._recent_lags: deque = deque(maxlen=max(1, int(5 / interval)))  # ~5 секунд
+        self._captured: deque = deque(maxlen=32)  # (пульс, место) из сторожевого потока
+        self._loop_thread_id: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.running():
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._pulse())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+        self._task = None
+        self._thread = None
+
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def recent_max_lag(self) -> float:
+        return max(self._recent_lags, default=self.lag)
+
+    def top_offenders(self, limit: int = 5) -> list[Tuple[str, int]]:
+        return sorted(self.offenders.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+
+    async def _pulse(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._beat = now
+            lag = max(0.0, now - expected)
+            self.lag = lag
+            self._recent_lags.append(lag)
+            METRIC_LOOP_LAG.observe(value=lag)
+            if lag < self.threshold:
+                continue
+            # блокировка закончилась: метрики пишем здесь, в потоке loop
+            self.blocked_total += 1
+            METRIC_LOOP_BLOCKED_SECONDS.observe(value=lag)
+            where = "unknown"
+            while self._captured:
+                _, where = self._captured.popleft()
+            METRIC_LOOP_BLOCKED.inc(where)
+            self.offenders[where] = self.offenders.get(where, 0) + 1
+            if len(self.offenders) > LOOP_OFFENDERS_MAX:
+                self.offenders.pop(min(self.offenders, key=self.offenders.get))
+            logger.warning(
+                "event loop blocked",
+                extra={"fields": {"ms": round(lag * 1000, 1), "where": where}},
+            )
+
+    def _watch(self):
+        reported_beat = None
+        while not self._stop.wait(self.threshold / 2):
+            beat = self._beat
+            if beat == reported_beat or time.monotonic() - beat - self.interval < self.threshold:
+                continue
+            reported_beat = beat
+            try:
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is None:
+                    continue
+                stack = traceback.extract_stack(frame)[-LOOP_STACK_DEPTH:]
+                del frame
+                where = _blocking_location(stack)
+                self._captured.append((beat, where))
+                # пишем сразу, пока loop ещё стоит: если он не отпустит, стек всё равно будет в логах
+                logger.warning(
+                    "event loop blocking call in progress",
+                    extra={"fields": {"where": where, "stack": "".join(traceback.format_list(stack))}},
+                )
+            except Exception as e:
+                logger.error(f"loop watchdog: {e}")
+
+
+loop_monitor = LoopMonitor(LOOP_MONITOR_INTERVAL, LOOP_BLOCK_THRESHOLD_SECONDS)
+
+
 # ---------------- Redis ----------------
-async def get_redis_client():
-    return redis.from_url(REDIS_URL, decode_responses=True)
+# Один пул соединений на процесс: создаётся на старте, закрывается на shutdown.
+REDIS_POOL_MAX_CONNECTIONS = int(os.getenv("REDIS_POOL_MAX_CONNECTIONS", 32))
+REDIS_POOL_TIMEOUT_SECONDS = float(os.getenv("REDIS_POOL_TIMEOUT_SECONDS", 5))
+
+
+class InstrumentedRedisPool(redis.BlockingConnectionPool):
+    """BlockingConnectionPool, который считает время ожидания свободного соединения."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.acquired_total = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.timeouts_total = 0
+        self.errors_total = 0
+
+    async def get_connection(self, *args, **kwargs):
+        # аргументы — как пришли: redis-py 5.3 считает command_name устаревшим и ругается на него
+        started = time.perf_counter()
+        try:
+            connection = await super().get_connection(*args, **kwargs)
+        except redis.ConnectionError as e:
+            # «No connection available» — пул исчерпан; остальное (отказ, DNS) — ошибки соединения
+            if isinstance(e.__cause__, asyncio.TimeoutError):
+                self.timeouts_total += 1
+            else:
+                self.errors_total += 1
+            raise
+        waited = time.perf_counter() - started
+        self.acquired_total += 1
+        self.wait_seconds_total += waited
+        if waited > self.wait_seconds_max:
+            self.wait_seconds_max = waited
+        return connection
+
+    def stats(self) -> Dict[str, Any]:
+        in_use = len(self._in_use_connections)
+        idle = len([c for c in self._available_connections if c is not None and c.is_connected])
+        acquired = self.acquired_total
+        return {
+            "max_connections": self.max_connections,
+            "in_use": in_use,
+            "idle": idle,
+            "acquired_total": acquired,
+            "timeouts_total": self.timeouts_total,
+            "errors_total": self.errors_total,
+            "wait_avg_ms": round(self.wait_seconds_total / acquired * 1000, 3) if acquired else 0.0,
+            "wait_max_ms": round(self.wait_seconds_max * 1000, 3),
+        }
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """Pipeline/MULTI считается одним обращением к Redis."""
+
+    async def execute(self, raise_on_error: bool = True):
+        name = "MULTI" if self.is_transaction else "PIPELINE"
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await super().execute(raise_on_error)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            _record_redis_call(name, time.perf_counter() - started, failed)
+
+
+class InstrumentedRedis(redis.Redis):
+    """Клиент, который пишет число и задержку команд в метрики (в т.ч. в разрезе апдейта)."""
+
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await super().execute_command(*args, **options)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            _record_redis_call(str(args[0]).upper(), time.perf_counter() - started, failed)
+
+    def pipeline(self, transaction: bool = True, shard_hint: Optional[str] = None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+_redis_pool: Optional[InstrumentedRedisPool] = None
+_redis_client: Optional[redis.Redis] = None
+
+
+def init_redis_pool(pool: Optional[InstrumentedRedisPool] = None) -> redis.Redis:
+    """pool — готовый пул вместо REDIS_URL (бенчмарк подставляет пул поверх fakeredis)."""
+    global _redis_pool, _redis_client
+    if _redis_client is None:
+        _redis_pool = pool or InstrumentedRedisPool.from_url(
+            REDIS_URL,
+            decode_responses=True,
+            max_connections=REDIS_POOL_MAX_CONNECTIONS,
+            timeout=REDIS_POOL_TIMEOUT_SECONDS,
+        )
+        _redis_client = InstrumentedRedis(connection_pool=_redis_pool)
+    return _redis_client
+
+
+async def close_redis_pool():
+    global _redis_pool, _redis_client
+    pool, _redis_pool, _redis_client = _redis_pool, None, None
+    _redis_scripts.clear()
+    if pool is not None:
+        await pool.disconnect()
+
+
+def redis_pool_stats() -> Dict[str, Any]:
+    if _redis_pool is None:
+        return {}
+    return _redis_pool.stats()
+
+
+@metrics.collector
+def _redis_pool_metrics():
+    stats = redis_pool_stats()
+    if not stats:
+        return []
+    return [
+        ("redis_pool_connections", "gauge", "Соединения пула Redis",
+         {("in_use",): stats["in_use"], ("idle",): stats["idle"], ("max",): stats["max_connections"]}, ("state",)),
+        ("redis_pool_acquired_total", "counter", "Выдано соединений из пула", {(): stats["acquired_total"]}, ()),
+        ("redis_pool_timeouts_total", "counter", "Таймауты ожидания соединения", {(): stats["timeouts_total"]}, ()),
+        ("redis_pool_errors_total", "counter", "Ошибки установки соединения", {(): stats["errors_total"]}, ()),
+    ]
+
+
+async def get_redis_client() -> redis.Redis:
+    # Общий клиент поверх пула; закрывать его в хелперах не нужно.
+    return init_redis_pool()
+
+
+_redis_scripts: Dict[str, Any] = {}
+
+
+def redis_script(lua: str):
+    """Lua-скрипт, зарегистрированный на общем клиенте (EVALSHA с fallback на EVAL)."""
+    script = _redis_scripts.get(lua)
+    if script is None:
+        script = init_redis_pool().register_script(lua)
+        _redis_scripts[lua] = script
+    return script
 
 def k_admin_subscription(cafe_id: str) -> str:
     return f"cafe:{cafe_id}:admin_subscription"
@@ -231,78 +943,171 @@ async def get_effective_admin_id(r: redis.Redis, cafe_id: str) -> int:
     return ADMIN_ID
 
 
-async def find_free_cafe_id(r: redis.Redis) -> Optional[str]:
-    keys = await r.keys("cafe:*:profile")
-    now_ts = int(time.time())
+# Индексы по кафе вместо KEYS cafe:*:profile:
+#   cafes:free        — set кафе без админа и без активной подписки (SPOP)
+#   cafes:by_admin    — hash admin_id -> cafe_id
+#   cafes:active_subs — zset cafe_id со score = cafebotify_valid_until (только paid=1)
+# Обновляются через index_cafe() после каждой записи профиля/подписки — её же должен
+# вызывать клиентский бот, когда меняет admin_id. Проиндексированный админ хранится
+# в профиле (indexed_admin_id): при перепривязке скрипт снимает старую запись by_admin,
+# если она всё ещё указывает на это кафе. Читатели by_admin всё равно сверяют admin_id
+# в профиле — профиль мог поменяться без переиндексации.
+CAFES_FREE_KEY = "cafes:free"
+CAFES_BY_ADMIN_KEY = "cafes:by_admin"
+CAFES_ACTIVE_SUBS_KEY = "cafes:active_subs"
+CAFES_INDEXED_KEY = "cafes:indexed"
+
+CAFE_INDEX_LUA = """
+local admin = redis.call('HGET', KEYS[1], 'admin_id')
+local paid = redis.call('HGET', KEYS[2], 'cafebotify_paid')
+local valid_until = tonumber(redis.call('HGET', KEYS[2], 'cafebotify_valid_until') or '') or 0
+local now = tonumber(ARGV[2])
+local has_admin = admin and admin ~= '' and admin ~= '0'
+
+-- старые привязки: проиндексированный ранее админ и явно переданный устаревший
+for _, old in ipairs({redis.call('HGET', KEYS[1], 'indexed_admin_id'), ARGV[3]}) do
+    if old and old ~= '' and old ~= admin and redis.call('HGET', KEYS[4], old) == ARGV[1] then
+        redis.call('HDEL', KEYS[4], old)
+    end
+end
+if has_admin then
+    redis.call('HSET', KEYS[4], admin, ARGV[1])
+    redis.call('HSET', KEYS[1], 'indexed_admin_id', admin)
+else
+    redis.call('HDEL', KEYS[1], 'indexed_admin_id')
+end
+if paid == '1' then
+    redis.call('ZADD', KEYS[5], valid_until, ARGV[1])
+else
+    redis.call('ZREM', KEYS[5], ARGV[1])
+end
+if not has_admin and paid ~= '1' and valid_until <= now then
+    redis.call('SADD', KEYS[3], ARGV[1])
+else
+    redis.call('SREM', KEYS[3], ARGV[1])
+end
+return 1
+"""
+
+
+async def index_cafe(r: redis.Redis, cafe_id: str, stale_admin_id: Optional[int] = None):
+    """stale_admin_id — админ из by_admin, который больше не совпадает с профилем."""
+    await redis_script(CAFE_INDEX_LUA)(
+        keys=[
+            k_cafe_profile(cafe_id),
+            k_admin_subscription(cafe_id),
+            CAFES_FREE_KEY,
+            CAFES_BY_ADMIN_KEY,
+            CAFES_ACTIVE_SUBS_KEY,
+        ],
+        args=[cafe_id, int(time.time()), "" if stale_admin_id is None else str(stale_admin_id)],
+        client=r,
+    )
 
-    for key in keys:
-        try:
-            parts = key.split(":")
-            if len(parts) < 3:
-                continue
 
-            cafe_id = parts[1]
-            admin_id_raw = await r.hget(key, "admin_id")
-            if admin_id_raw and str(admin_id_raw).strip() not in ("", "0"):
-                continue
+async def rebuild_cafe_indexes(r: redis.Redis, force: bool = False) -> int:
+    """Первичное построение индексов через SCAN (не блокирует Redis, в отличие от KEYS)."""
+    if not force and await r.exists(CAFES_INDEXED_KEY):
+        return 0
 
-            sub = await r.hgetall(k_admin_subscription(cafe_id))
-            paid_flag = str(sub.get("cafebotify_paid", "0")).strip()
-            valid_until_raw = str(sub.get("cafebotify_valid_until", "0")).strip()
+    count = 0
+    async for key in r.scan_iter(match="cafe:*:profile", count=500):
+        parts = key.split(":")
+        if len(parts) < 3:
+            continue
+        await index_cafe(r, parts[1])
+        count += 1
 
-            try:
-                valid_until_ts = int(valid_until_raw or 0)
-            except Exception:
-                valid_until_ts = 0
+    await r.set(CAFES_INDEXED_KEY, str(int(time.time())))
+    return count
 
-            if paid_flag == "1" or valid_until_ts > now_ts:
-                continue
 
-            return cafe_id
+def _cafe_sub_is_free(sub: Dict[str, str], now_ts: int) -> bool:
+    paid_flag = str(sub.get("cafebotify_paid", "0")).strip()
+    try:
+        valid_until_ts = int(str(sub.get("cafebotify_valid_until", "0")).strip() or 0)
+    except Exception:
+        valid_until_ts = 0
+    return not (paid_flag == "1" or valid_until_ts > now_ts)
+
+
+async def find_free_cafe_id(r: redis.Redis) -> Optional[str]:
+    """
+    Забирает (SPOP) свободное кафе из пула. Кандидат перепроверяется: если индекс
+    устарел, кафе переиндексируется и берётся следующее.
+    """
+    while True:
+        cafe_id = await r.spop(CAFES_FREE_KEY)
+        if not cafe_id:
+            return None
+
+        try:
+            pipe = r.pipeline(transaction=False)
+            pipe.hget(k_cafe_profile(cafe_id), "admin_id")
+            pipe.hgetall(k_admin_subscription(cafe_id))
+            admin_id_raw, sub = await pipe.execute()
         except Exception:
+            await r.sadd(CAFES_FREE_KEY, cafe_id)
+            raise
+
+        if admin_id_raw and str(admin_id_raw).strip() not in ("", "0"):
+            await index_cafe(r, cafe_id)
             continue
+        if not _cafe_sub_is_free(sub, int(time.time())):
+            await index_cafe(r, cafe_id)
+            continue
+        return cafe_id
 
-    return None
 
+async def release_free_cafe_id(r: redis.Redis, cafe_id: str):
+    """Возвращает кафе в пул, если привязка после find_free_cafe_id не состоялась."""
+    await index_cafe(r, cafe_id)
 
-async def get_bound_active_cafe_id_by_admin(r: redis.Redis, admin_tg_id: int) -> Optional[str]:
-    keys = await r.keys("cafe:*:profile")
-    now_ts = int(time.time())
 
-    for key in keys:
-        try:
-            parts = key.split(":")
-            if len(parts) < 3:
-                continue
+async def get_cafe_id_by_admin(r: redis.Redis, admin_tg_id: int) -> Optional[str]:
+    """Кафе админа по cafes:by_admin; запись, не совпавшая с профилем, снимается."""
+    cafe_id = await r.hget(CAFES_BY_ADMIN_KEY, str(admin_tg_id))
+    if not cafe_id:
+        return None
 
-            candidate_cafe_id = parts[1]
-            admin_id_raw = await r.hget(key, "admin_id")
-            if not admin_id_raw or int(admin_id_raw) != admin_tg_id:
-                continue
+    admin_id_raw = await r.hget(k_cafe_profile(cafe_id), "admin_id")
+    if str(admin_id_raw or "").strip() == str(admin_tg_id):
+        return cafe_id
 
-            sub = await r.hgetall(k_admin_subscription(candidate_cafe_id))
-            paid_flag = str(sub.get("cafebotify_paid", "0")).strip()
-            valid_until_raw = str(sub.get("cafebotify_valid_until", "0")).strip()
+    await index_cafe(r, cafe_id, stale_admin_id=admin_tg_id)
+    return None
 
-            try:
-                valid_until_ts = int(valid_until_raw or 0)
-            except Exception:
-                valid_until_ts = 0
 
-            if paid_flag == "1" and valid_until_ts > now_ts:
-                return candidate_cafe_id
-        except Exception:
-            continue
+async def get_bound_active_cafe_id_by_admin(r: redis.Redis, admin_tg_id: int) -> Optional[str]:
+    cafe_id = await r.hget(CAFES_BY_ADMIN_KEY, str(admin_tg_id))
+    if not cafe_id:
+        return None
 
+    pipe = r.pipeline(transaction=False)
+    pipe.hget(k_cafe_profile(cafe_id), "admin_id")
+    pipe.hgetall(k_admin_subscription(cafe_id))
+    admin_id_raw, sub = await pipe.execute()
+
+    if str(admin_id_raw or "").strip() != str(admin_tg_id):
+        await index_cafe(r, cafe_id, stale_admin_id=admin_tg_id)
+        return None
+
+    try:
+        valid_until_ts = int(str(sub.get("cafebotify_valid_until", "0")).strip() or 0)
+    except Exception:
+        valid_until_ts = 0
+    if str(sub.get("cafebotify_paid", "0")).strip() == "1" and valid_until_ts > int(time.time()):
+        return cafe_id
     return None
-    
+
 
 async def has_active_bound_cafe_by_admin(r: redis.Redis, admin_tg_id: int) -> bool:
     cafe_id = await get_bound_active_cafe_id_by_admin(r, admin_tg_id)
     return bool(cafe_id)
 
-def _rate_limit_key(user_id: int) -> str:
-    return f"rate_limit:{user_id}"
+
+def _rate_limit_key(action: str, user_id: int) -> str:
+    return f"rate_limit:{action}:{user_id}"
 
 
 def _last_seen_key(user_id: int) -> str:
@@ -317,12 +1122,221 @@ async def is_user_paid(user_id: int) -> bool:
     try:
         r = await get_redis_client()
         val = await r.hget(f"user:{user_id}", "cafebotify_paid")
-        await r.aclose()
         return val == "1"
     except Exception:
         return False
 
 
+# ---------------- Rate limiting ----------------
+@dataclass(frozen=True)
+class RateLimitPolicy:
+    limit: int  # сколько действий разрешено в окне
+    window_seconds: int
+
+
+RATE_LIMIT_POLICIES: Dict[str, RateLimitPolicy] = {
+    "order": RateLimitPolicy(limit=1, window_seconds=RATE_LIMIT_SECONDS),
+    "booking": RateLimitPolicy(limit=RATE_LIMIT_BOOKINGS_PER_HOUR, window_seconds=60 * 60),
+    "text": RateLimitPolicy(limit=RATE_LIMIT_TEXT_PER_MINUTE, window_seconds=60),
+}
+
+# Скользящее окно на sorted set. Возвращает 0, если действие разрешено,
+# иначе через сколько миллисекунд освободится слот.
+RATE_LIMIT_LUA = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+if redis.call('ZCARD', KEYS[1]) >= limit then
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    return math.max(1, tonumber(oldest[2]) + window - now)
+end
+redis.call('ZADD', KEYS[1], now, ARGV[4])
+redis.call('PEXPIRE', KEYS[1], window)
+return 0
+"""
+
+
+async def rate_limit_hit(action: str, user_id: int) -> float:
+    """0 — действие разрешено и учтено, иначе сколько секунд ждать. При ошибке Redis пропускаем."""
+    policy = RATE_LIMIT_POLICIES[action]
+    now_ms = int(time.time() * 1000)
+    try:
+        retry_ms = await redis_script(RATE_LIMIT_LUA)(
+            keys=[_rate_limit_key(action, user_id)],
+            args=[now_ms, policy.window_seconds * 1000, policy.limit, f"{now_ms}:{uuid.uuid4().hex[:8]}"],
+        )
+    except Exception as e:
+        logger.error(f"rate_limit_hit action={action} user_id={user_id}: {e}")
+        return 0.0
+    return int(retry_ms) / 1000
+
+
+async def rate_limit_notice_due(user_id: int, retry_after: float) -> bool:
+    """Одно предупреждение на период блокировки, а не ответ на каждое отбитое сообщение."""
+    try:
+        r = await get_redis_client()
+        return bool(await r.set(_rate_limit_key("notice", user_id), 1, nx=True, ex=max(1, math.ceil(retry_after))))
+    except Exception as e:
+        logger.error(f"rate_limit_notice_due user_id={user_id}: {e}")
+        return False
+
+
+def rate_limit_action(message: Message, data: Dict[str, Any]) -> Optional[str]:
+    # "order" и "booking" здесь нет: слот списывается вместе с записью заказа
+    # (ORDER_COMMIT_LUA) и брони (booking_finish). "text" — только свободный текст:
+    # сообщение без активного состояния, которое не разобрал ни один хендлер, кроме
+    # any_text_message (команды, кнопки и выбор напитка туда не доходят или отсекаются)
+    callback = getattr(data.get("handler"), "callback", None)
+    if callback is not any_text_message or data.get("raw_state") is not None:
+        return None
+    text = (message.text or "").strip()
+    if not text or text.startswith("/") or text in FALLBACK_KNOWN_BUTTONS or text in MENU:
+        return None
+    return "text"
+
+
+async def rate_limit_reject(message: Message, action: str) -> bool:
+    """Учитывает действие; True — лимит исчерпан и пользователь уже предупреждён."""
+    retry_after = await rate_limit_hit(action, message.from_user.id)
+    if not retry_after:
+        return False
+
+    logger.info(f"RATE LIMIT action={action} user_id={message.from_user.id} retry_after={retry_after:.1f}s")
+    if action == "booking":
+        await message.answer(
+            "⏳ Слишком много бронирований. Попробуйте позже или позвоните нам.",
+            reply_markup=create_client_menu_keyboard(),
+        )
+    elif await rate_limit_notice_due(message.from_user.id, retry_after):
+        await message.answer(f"⏳ Слишком много сообщений. Подождите {max(1, math.ceil(retry_after))} сек.")
+    return True
+
+
+class RateLimitMiddleware(BaseMiddleware):
+    """
+    Inner middleware диспетчера на message: хендлер уже выбран, state прочитан одним
+    MGET (CachedFSMContext), но логика хендлера ещё не запускалась — отбитый флуд не
+    доходит до ответов и записей в Redis.
+    """
+
+    async def __call__(self, handler, event: Message, data: Dict[str, Any]):
+        if event.from_user is None:
+            return await handler(event, data)
+
+        action = rate_limit_action(event, data)
+        if action is None or not await rate_limit_reject(event, action):
+            return await handler(event, data)
+        return None
+
+
+# ---------------- FSM cache ----------------
+class CachedFSMContext(FSMContext):
+    """
+    FSMContext на время одного апдейта: state и data читаются одним MGET при первом
+    обращении, изменения копятся в памяти и пишутся одним pipeline в flush().
+    Снаружи ведёт себя как обычный FSMContext (get_data отдаёт копию).
+    """
+
+    def __init__(self, storage: RedisStorage, key):
+        super().__init__(storage=storage, key=key)
+        self._loaded = False
+        self._state: Optional[str] = None
+        self._data: Dict[str, Any] = {}
+        self._state_dirty = False
+        self._data_dirty = False
+
+    async def _load(self):
+        if self._loaded:
+            return
+        storage: RedisStorage = self.storage
+        raw_state, raw_data = await storage.redis.mget(
+            storage.key_builder.build(self.key, "state"),
+            storage.key_builder.build(self.key, "data"),
+        )
+        if isinstance(raw_state, bytes):
+            raw_state = raw_state.decode("utf-8")
+        if isinstance(raw_data, bytes):
+            raw_data = raw_data.decode("utf-8")
+        self._state = raw_state
+        self._data = storage.json_loads(raw_data) if raw_data else {}
+        self._loaded = True
+
+    async def get_state(self) -> Optional[str]:
+        await self._load()
+        return self._state
+
+    async def set_state(self, state=None) -> None:
+        await self._load()
+        self._state = state.state if isinstance(state, State) else state
+        self._state_dirty = True
+
+    async def get_data(self) -> Dict[str, Any]:
+        await self._load()
+        return copy.deepcopy(self._data)
+
+    async def get_value(self, key: str, default: Any = None) -> Any:
+        await self._load()
+        return copy.deepcopy(self._data.get(key, default))
+
+    async def set_data(self, data) -> None:
+        if not isinstance(data, dict):
+            raise TypeError(f"Data must be a dict, got {type(data).__name__}")
+        await self._load()
+        self._data = copy.deepcopy(data)
+        self._data_dirty = True
+
+    async def update_data(self, data=None, **kwargs: Any) -> Dict[str, Any]:
+        if data:
+            kwargs.update(data)
+        await self._load()
+        self._data.update(copy.deepcopy(kwargs))
+        self._data_dirty = True
+        return copy.deepcopy(self._data)
+
+    async def flush(self):
+        if not (self._state_dirty or self._data_dirty):
+            return
+        storage: RedisStorage = self.storage
+        pipe = storage.redis.pipeline(transaction=True)
+        if self._state_dirty:
+            state_key = storage.key_builder.build(self.key, "state")
+            if self._state is None:
+                pipe.delete(state_key)
+            else:
+                pipe.set(state_key, self._state, ex=storage.state_ttl)
+        if self._data_dirty:
+            data_key = storage.key_builder.build(self.key, "data")
+            if not self._data:
+                pipe.delete(data_key)
+            else:
+                pipe.set(data_key, storage.json_dumps(self._data), ex=storage.data_ttl)
+        await pipe.execute()
+        self._state_dirty = self._data_dirty = False
+
+
+class CachedFSMContextMiddleware(FSMContextMiddleware):
+    """
+    FSM-middleware, которое отдаёт хендлерам CachedFSMContext и сбрасывает изменения
+    после обработки апдейта: ~2 round trip к Redis на апдейт вместо одного на каждый
+    get_data/update_data/set_state. get_context() для чужих ключей остаётся обычным.
+    """
+
+    async def __call__(self, handler, event, data: Dict[str, Any]) -> Any:
+        context = self.resolve_event_context(data["bot"], data)
+        data["fsm_storage"] = self.storage
+        if context is None or not isinstance(self.storage, RedisStorage):
+            return await super().__call__(handler, event, data)
+
+        context = CachedFSMContext(self.storage, context.key)
+        async with self.events_isolation.lock(key=context.key):
+            data.update({"state": context, "raw_state": await context.get_state()})
+            try:
+                return await handler(event, data)
+            finally:
+                await context.flush()
+
+
 # ---------------- States ----------------
 class OrderStates(StatesGroup):
     waiting_for_quantity = State()
@@ -353,6 +1367,11 @@ class PaylinksStates(StatesGroup):
     waiting_for_preview_approve = State()
 
 
+class BroadcastStates(StatesGroup):
+    waiting_for_text = State()
+    waiting_for_confirmation = State()
+
+
 # =========================
 # PAYLINKS FLOW
 # =========================
@@ -385,7 +1404,6 @@ async def paylinks_send_to_client_callback(callback: CallbackQuery, state: FSMCo
         try:
             r = await get_redis_client()
             raw = await r.get(paydraft_key(draft_id))
-            await r.aclose()
         except Exception as e:
             logger.exception(f"PAYLINKS DEBUG 2 redis read error draft_id={draft_id}: {e}")
             await callback.answer("Ошибка Redis", show_alert=True)
@@ -474,7 +1492,6 @@ async def paylinks_cafe_id_input(message: Message, state: FSMContext):
         r = await get_redis_client()
         raw = await r.get(_pay_draft_key(draft_id))
         if not raw:
-            await r.aclose()
             logger.info(f"PAYLINKS DEBUG 5B draft expired draft_id={draft_id}")
             await state.clear()
             await message.answer("Draft не найден или истёк.")
@@ -486,7 +1503,6 @@ async def paylinks_cafe_id_input(message: Message, state: FSMContext):
         product = payload.get("product") or "cafebotify_start_month"
         amount_value = payload.get("amount_value") or ""
         amount_currency = payload.get("amount_currency") or ""
-        await r.aclose()
     except Exception as e:
         logger.exception(f"PAYLINKS DEBUG 5C redis read error draft_id={draft_id}: {e}")
         await state.clear()
@@ -595,7 +1611,6 @@ async def paylinks_preview_approve_message(message: Message, state: FSMContext):
             7 * 86400,
             json.dumps(payload, ensure_ascii=False),
         )
-        await r.aclose()
     except Exception as e:
         logger.exception(f"PAYLINKS DEBUG 7D redis update error draft_id={draft_id}: {e}")
         await state.clear()
@@ -657,6 +1672,25 @@ async def paylinks_preview_approve_message(message: Message, state: FSMContext):
     )
     
 
+# ---------------- Render cache ----------------
+# Готовые клавиатуры и тексты, зависящие от MENU / профиля кафе.
+# Ключ включает MENU_VERSION; при правке меню или /set_profile кэш сбрасывается.
+_render_cache: Dict[Tuple[Any, ...], Any] = {}
+
+
+def invalidate_render_cache():
+    _render_cache.clear()
+
+
+def _cached_render(key: Tuple[Any, ...], build):
+    full_key = (MENU_VERSION,) + key
+    value = _render_cache.get(full_key)
+    if value is None:
+        value = build()
+        _render_cache[full_key] = value
+    return value
+
+
 # ---------------- Working hours ----------------
 def is_cafe_open() -> bool:
     return WORK_START <= get_moscow_time().hour < WORK_END
@@ -674,6 +1708,10 @@ def _address_line() -> str:
 
 
 def get_closed_message() -> str:
+    return _cached_render(("closed_message", is_cafe_open()), _build_closed_message)
+
+
+def _build_closed_message() -> str:
     menu_text = " • ".join([f"<b>{html.quote(d)}</b> {p}₽" for d, p in MENU.items()])
     return (
         f"🔒 <b>{html.quote(CAFE_NAME)} сейчас закрыто!</b>\n\n"
@@ -688,66 +1726,395 @@ def get_user_name(message: Message) -> str:
 
 
 # ---------------- Admin notify ----------------
-async def send_admin_only(bot: Bot, text: str):
-    try:
-        await bot.send_message(ADMIN_ID, text, disable_web_page_preview=True)
-    except Exception:
-        pass
+def _admin_notification_target(user_id: int, text: str) -> Tuple[int, str]:
+    """В DEMO уведомление админа показываем самому клиенту."""
+    if DEMO_MODE:
+        return user_id, "ℹ️ <b>DEMO</b>: так это увидит админ:\n\n" + text
+    return ADMIN_ID, text
 
 
-async def send_admin_demo_to_user(bot: Bot, user_id: int, admin_like_text: str):
-    if not DEMO_MODE:
-        return
-    demo_text = "ℹ️ <b>DEMO</b>: так это увидит админ:\n\n" + admin_like_text
-    try:
-        await bot.send_message(user_id, demo_text, disable_web_page_preview=True)
-    except Exception:
-        pass
+# ---------------- Outbound sender ----------------
+SEND_OK = "ok"
+SEND_BLOCKED = "blocked"  # получатель недоступен навсегда: бот заблокирован, чат удалён
+SEND_FAILED = "failed"  # временная ошибка не прошла за OUTBOUND_MAX_RETRIES или кривое сообщение
 
+_PERMANENT_BAD_REQUEST_MARKERS = ("chat not found", "user is deactivated", "peer_id_invalid", "user not found")
 
-# ---------------- Menu sync ----------------
-async def sync_menu_from_redis():
-    global MENU
-    try:
-        r = await get_redis_client()
-        data = await r.hgetall(MENU_REDIS_KEY)
-        if data:
-            new_menu: Dict[str, int] = {}
-            for k, v in data.items():
-                try:
-                    new_menu[str(k)] = int(v)
-                except Exception:
-                    continue
-            if new_menu:
-                MENU = new_menu
-        else:
-            if MENU:
-                await r.hset(MENU_REDIS_KEY, mapping={k: str(v) for k, v in MENU.items()})
-        await r.aclose()
-    except Exception as e:
-        logger.error(f"sync_menu_from_redis: {e}")
 
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
 
-async def menu_set_item(drink: str, price: int):
-    global MENU
-    MENU[drink] = price
-    try:
-        r = await get_redis_client()
-        await r.hset(MENU_REDIS_KEY, drink, str(price))
-        await r.aclose()
-    except Exception:
-        pass
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
 
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
 
-async def menu_delete_item(drink: str):
-    global MENU
+
+class OutboundSender:
+    """
+    Отправка рассылок: общий token bucket, пауза на чат, ограниченное число
+    одновременных отправок, backoff с учётом RetryAfter и разделение ошибок
+    на постоянные (SEND_BLOCKED) и временные (SEND_FAILED).
+    """
+
+    def __init__(self, rate_per_second: float, concurrency: int, per_chat_interval: float, max_retries: int):
+        self.bucket = TokenBucket(rate_per_second, capacity=max(1.0, rate_per_second))
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._chat_next_at: Dict[int, float] = {}
+
+    async def _wait_chat(self, chat_id: int):
+        now = time.monotonic()
+        next_at = self._chat_next_at.get(chat_id, 0.0)
+        self._chat_next_at[chat_id] = max(now, next_at) + self.per_chat_interval
+        if next_at > now:
+            await asyncio.sleep(next_at - now)
+        if len(self._chat_next_at) > 10000:
+            self._chat_next_at = {k: v for k, v in self._chat_next_at.items() if v > now}
+
+    async def send(self, bot: Bot, chat_id: int, text: str, **kwargs) -> str:
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self._wait_chat(chat_id)
+                await self.bucket.acquire()
+                try:
+                    await bot.send_message(chat_id, text, **kwargs)
+                    return SEND_OK
+                except TelegramRetryAfter as e:
+                    logger.warning(f"outbound RetryAfter chat_id={chat_id} retry_after={e.retry_after}")
+                    self.bucket.pause(e.retry_after)
+                    continue
+                except (TelegramForbiddenError, TelegramNotFound):
+                    return SEND_BLOCKED
+                except TelegramBadRequest as e:
+                    if any(m in str(e).lower() for m in _PERMANENT_BAD_REQUEST_MARKERS):
+                        return SEND_BLOCKED
+                    logger.error(f"outbound bad request chat_id={chat_id}: {e}")
+                    return SEND_FAILED
+                except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+                    logger.warning(f"outbound transient error chat_id={chat_id} attempt={attempt}: {e}")
+                    await asyncio.sleep(min(30.0, 2 ** attempt))
+                except Exception as e:
+                    logger.error(f"outbound send error chat_id={chat_id}: {e}")
+                    return SEND_FAILED
+            return SEND_FAILED
+
+    async def send_many(self, bot: Bot, messages: list[Tuple[int, str]], **kwargs) -> Dict[int, str]:
+        results = await asyncio.gather(*(self.send(bot, chat_id, text, **kwargs) for chat_id, text in messages))
+        return {chat_id: result for (chat_id, _), result in zip(messages, results)}
+
+
+outbound = OutboundSender(
+    rate_per_second=OUTBOUND_RATE_PER_SECOND,
+    concurrency=OUTBOUND_CONCURRENCY,
+    per_chat_interval=OUTBOUND_PER_CHAT_INTERVAL,
+    max_retries=OUTBOUND_MAX_RETRIES,
+)
+# отдельная полоса для outbox: рассылка не занимает её токены и слоты
+notify_outbound = OutboundSender(
+    rate_per_second=OUTBOX_RATE_PER_SECOND,
+    concurrency=OUTBOX_CONCURRENCY,
+    per_chat_interval=OUTBOUND_PER_CHAT_INTERVAL,
+    max_retries=OUTBOUND_MAX_RETRIES,
+)
+
+
+# ---------------- Notification outbox ----------------
+OUTBOX_CLAIM_LUA = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+for _, id in ipairs(ids) do
+    redis.call('ZADD', KEYS[1], ARGV[2], id)
+end
+return ids
+"""
+
+
+def _outbox_item_key(item_id: str) -> str:
+    return f"{OUTBOX_ITEM_PREFIX}{item_id}"
+
+
+def outbox_add(pipe, chat_id: int, text: str, item_id: Optional[str] = None) -> str:
+    """Кладёт уведомление в outbox в составе чужой транзакции (pipe)."""
+    item_id = item_id or uuid.uuid4().hex
+    now_ts = int(time.time())
+    pipe.hset(
+        _outbox_item_key(item_id),
+        mapping={"chat_id": chat_id, "text": text, "attempts": 0, "created_ts": now_ts},
+    )
+    pipe.zadd(OUTBOX_PENDING_KEY, {item_id: now_ts})
+    return item_id
+
+
+async def outbox_enqueue(chat_id: int, text: str, item_id: Optional[str] = None) -> str:
+    r = await get_redis_client()
+    pipe = r.pipeline(transaction=True)
+    item_id = outbox_add(pipe, chat_id, text, item_id)
+    await pipe.execute()
+    return item_id
+
+
+async def notify_admin(bot: Bot, user_id: int, text: str):
+    """Уведомление админу через outbox; если Redis недоступен — сразу напрямую."""
+    chat_id, text = _admin_notification_target(user_id, text)
+    try:
+        await outbox_enqueue(chat_id, text)
+    except Exception as e:
+        logger.error(f"outbox_enqueue failed, sending directly: {e}")
+        try:
+            await bot.send_message(chat_id, text, disable_web_page_preview=True)
+        except Exception:
+            pass
+
+
+async def _outbox_renew_lease(r: redis.Redis, ids: list):
+    # ZADD XX: уже удалённые записи не воскрешаются
+    while True:
+        await asyncio.sleep(OUTBOX_LEASE_RENEW_SECONDS)
+        lease_until = int(time.time()) + OUTBOX_LEASE_SECONDS
+        await r.zadd(OUTBOX_PENDING_KEY, {item_id: lease_until for item_id in ids}, xx=True)
+
+
+async def outbox_process_batch(bot: Bot) -> int:
+    """
+    Берёт до OUTBOX_BATCH готовых к отправке уведомлений (с арендой на OUTBOX_LEASE_SECONDS,
+    которая продлевается, пока пачка в работе) и отправляет через notify_outbound. Временная ошибка —
+    повтор с экспоненциальной паузой, постоянная или исчерпанные попытки — outbox:dead.
+    """
+    r = await get_redis_client()
+    now_ts = int(time.time())
+    ids = await redis_script(OUTBOX_CLAIM_LUA)(
+        keys=[OUTBOX_PENDING_KEY],
+        args=[now_ts, now_ts + OUTBOX_LEASE_SECONDS, OUTBOX_BATCH],
+    )
+    if not ids:
+        return 0
+
+    pipe = r.pipeline(transaction=False)
+    for item_id in ids:
+        pipe.hgetall(_outbox_item_key(item_id))
+    items = await pipe.execute()
+
+    sendable = [(item_id, item) for item_id, item in zip(ids, items) if item]
+    # отправка пачки может идти дольше аренды (ретраи, flood wait): без продления
+    # записи вернулись бы в очередь и ушли бы второй раз
+    renew = asyncio.create_task(_outbox_renew_lease(r, ids))
+    try:
+        results = await asyncio.gather(*(
+            notify_outbound.send(bot, int(item["chat_id"]), item["text"], disable_web_page_preview=True)
+            for _, item in sendable
+        ))
+    finally:
+        renew.cancel()
+
+    pipe = r.pipeline(transaction=True)
+    for item_id, item in zip(ids, items):
+        if not item:
+            pipe.zrem(OUTBOX_PENDING_KEY, item_id)
+    for (item_id, item), result in zip(sendable, results):
+        key = _outbox_item_key(item_id)
+        attempts = int(item.get("attempts") or 0) + 1
+        if result == SEND_OK:
+            pipe.zrem(OUTBOX_PENDING_KEY, item_id)
+            pipe.delete(key)
+        elif result == SEND_BLOCKED or attempts >= OUTBOX_MAX_ATTEMPTS:
+            logger.error(f"outbox {item_id} dead after {attempts} attempts: {result}")
+            pipe.zrem(OUTBOX_PENDING_KEY, item_id)
+            pipe.hset(key, mapping={"attempts": attempts, "last_error": result, "dead_ts": now_ts})
+            pipe.expire(key, OUTBOX_DEAD_KEEP_SECONDS)
+            pipe.lpush(OUTBOX_DEAD_KEY, item_id)
+            pipe.ltrim(OUTBOX_DEAD_KEY, 0, OUTBOX_DEAD_MAX - 1)
+        else:
+            pipe.hset(key, mapping={"attempts": attempts, "last_error": result})
+            pipe.zadd(OUTBOX_PENDING_KEY, {item_id: now_ts + OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1)})
+    await pipe.execute()
+    return len(ids)
+
+
+async def outbox_requeue_dead() -> int:
+    """Возвращает всё из outbox:dead в очередь со сброшенным счётчиком попыток."""
+    r = await get_redis_client()
+    count = 0
+    while True:
+        item_id = await r.rpop(OUTBOX_DEAD_KEY)
+        if not item_id:
+            return count
+        key = _outbox_item_key(item_id)
+        if not await r.exists(key):
+            continue
+        pipe = r.pipeline(transaction=True)
+        pipe.hset(key, "attempts", 0)
+        pipe.hdel(key, "dead_ts")
+        pipe.persist(key)
+        pipe.zadd(OUTBOX_PENDING_KEY, {item_id: int(time.time())})
+        await pipe.execute()
+        count += 1
+
+
+async def outbox_loop(bot: Bot):
+    while True:
+        processed = 0
+        try:
+            processed = await outbox_process_batch(bot)
+        except Exception as e:
+            logger.error(f"outbox_loop: {e}")
+        if processed < OUTBOX_BATCH:
+            await asyncio.sleep(OUTBOX_POLL_SECONDS)
+
+
+# ---------------- Menu sync ----------------
+# MENU — локальный кэш hash menu:items. Он перечитывается только когда меняется
+# menu:version; об изменениях реплики узнают через канал MENU_CHANNEL.
+# Из процесса в Redis меню пишется только правками владельца и один раз — при
+# первом запуске на пустом Redis (seed_menu_if_missing): пустой hash при живой
+# версии означает, что меню очистили, а не что его нужно заполнить заново.
+MENU_SEED_LUA = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+if redis.call('EXISTS', KEYS[1]) == 0 and #ARGV > 0 then
+    redis.call('HSET', KEYS[1], unpack(ARGV))
+end
+redis.call('SET', KEYS[2], 1)
+return 1
+"""
+
+
+async def seed_menu_if_missing() -> bool:
+    """Меню из config.json -> Redis, только если menu:version ещё ни разу не выставлялась."""
+    args = []
+    for name, price in MENU.items():
+        args += [name, str(price)]
+    seeded = await redis_script(MENU_SEED_LUA)(keys=[MENU_REDIS_KEY, MENU_VERSION_KEY], args=args)
+    return bool(seeded)
+
+
+async def sync_menu_from_redis():
+    global MENU, MENU_VERSION
+    try:
+        r = await get_redis_client()
+        pipe = r.pipeline(transaction=True)
+        pipe.get(MENU_VERSION_KEY)
+        pipe.hgetall(MENU_REDIS_KEY)
+        raw_version, data = await pipe.execute()
+        if data:
+            new_menu: Dict[str, int] = {}
+            for k, v in data.items():
+                try:
+                    new_menu[str(k)] = int(v)
+                except Exception:
+                    continue
+            if new_menu:
+                MENU = new_menu
+                invalidate_render_cache()
+        elif raw_version is not None and MENU:
+            # меню очищено владельцем — локальную копию не возвращаем в Redis
+            MENU = {}
+            invalidate_render_cache()
+        MENU_VERSION = int(raw_version or 0)
+    except Exception as e:
+        logger.error(f"sync_menu_from_redis: {e}")
+
+
+async def refresh_menu_if_stale(version: Optional[int] = None):
+    """Перечитывает меню, только если версия в Redis отличается от локальной."""
+    if version is None:
+        try:
+            r = await get_redis_client()
+            version = int(await r.get(MENU_VERSION_KEY) or 0)
+        except Exception as e:
+            logger.error(f"refresh_menu_if_stale: {e}")
+            return
+    if version != MENU_VERSION:
+        await sync_menu_from_redis()
+
+
+async def _menu_commit(pipe) -> None:
+    global MENU_VERSION
+    pipe.incr(MENU_VERSION_KEY)
+    results = await pipe.execute()
+    new_version = int(results[-1])
+
+    # если между нашими версиями вклинилась чужая правка — перечитываем целиком
+    if MENU_VERSION is not None and new_version == MENU_VERSION + 1:
+        MENU_VERSION = new_version
+    else:
+        await sync_menu_from_redis()
+
+    r = await get_redis_client()
+    await r.publish(MENU_CHANNEL, str(new_version))
+
+
+async def menu_set_item(drink: str, price: int):
+    global MENU
+    MENU[drink] = price
+    invalidate_render_cache()
+    try:
+        r = await get_redis_client()
+        pipe = r.pipeline(transaction=True)
+        pipe.hset(MENU_REDIS_KEY, drink, str(price))
+        await _menu_commit(pipe)
+    except Exception as e:
+        logger.error(f"menu_set_item: {e}")
+
+
+async def menu_delete_item(drink: str):
+    global MENU
     MENU.pop(drink, None)
+    invalidate_render_cache()
     try:
         r = await get_redis_client()
-        await r.hdel(MENU_REDIS_KEY, drink)
-        await r.aclose()
-    except Exception:
-        pass
+        pipe = r.pipeline(transaction=True)
+        pipe.hdel(MENU_REDIS_KEY, drink)
+        await _menu_commit(pipe)
+    except Exception as e:
+        logger.error(f"menu_delete_item: {e}")
+
+
+async def menu_invalidation_loop():
+    while True:
+        pubsub = None
+        try:
+            r = await get_redis_client()
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            await pubsub.subscribe(MENU_CHANNEL)
+            # пока не были подписаны, могли пропустить публикацию
+            await refresh_menu_if_stale()
+            async for msg in pubsub.listen():
+                try:
+                    version = int(msg.get("data") or 0)
+                except Exception:
+                    version = None
+                await refresh_menu_if_stale(version)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"menu_invalidation_loop: {e}")
+        finally:
+            if pubsub is not None:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+        await asyncio.sleep(MENU_LISTENER_RETRY_SECONDS)
 
 
 # ---------------- Repeat last order offer ----------------
@@ -755,6 +2122,7 @@ BTN_REPEAT_LAST = "🔁 Повторить последний заказ"
 BTN_REPEAT_NO = "❌ Нет, спасибо"
 
 
+@functools.lru_cache(maxsize=None)
 def create_repeat_offer_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text=BTN_REPEAT_LAST), KeyboardButton(text=BTN_REPEAT_NO)]],
@@ -763,66 +2131,140 @@ def create_repeat_offer_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
-async def set_last_seen(user_id: int):
+@dataclass
+class StartContext:
+    menu_version: int = 0
+    last_seen_ts: Optional[float] = None
+    last_order: Optional[dict] = None
+
+    @property
+    def offer_repeat(self) -> bool:
+        if not self.last_order or self.last_seen_ts is None:
+            return False
+        last_seen_dt = datetime.fromtimestamp(self.last_seen_ts, tz=MSK_TZ)
+        return last_seen_dt.date() != get_moscow_time().date()
+
+
+async def load_start_context(user_id: int) -> StartContext:
+    """
+    Всё, что нужно /start, за один round trip: версия меню, last_seen,
+    снимок последнего заказа и обновление last_seen.
+    """
     try:
         r = await get_redis_client()
-        await r.set(_last_seen_key(user_id), str(time.time()))
-        await r.aclose()
+        pipe = r.pipeline(transaction=False)
+        pipe.get(MENU_VERSION_KEY)
+        pipe.get(_last_seen_key(user_id))
+        pipe.get(_last_order_key(user_id))
+        pipe.set(_last_seen_key(user_id), str(time.time()))
+        raw_version, raw_seen, raw_order, _ = await pipe.execute()
+    except Exception as e:
+        logger.error(f"load_start_context: {e}")
+        return StartContext(menu_version=MENU_VERSION or 0)
+
+    ctx = StartContext()
+    try:
+        ctx.menu_version = int(raw_version or 0)
     except Exception:
         pass
-
-
-async def should_offer_repeat(user_id: int) -> bool:
     try:
-        r = await get_redis_client()
-        last_seen = await r.get(_last_seen_key(user_id))
-        last_order = await r.get(_last_order_key(user_id))
-        await r.aclose()
+        ctx.last_seen_ts = float(raw_seen) if raw_seen else None
     except Exception:
-        return False
-
-    if not last_order or not last_seen:
-        return False
-
+        pass
     try:
-        last_seen_dt = datetime.fromtimestamp(float(last_seen), tz=MSK_TZ)
+        snap = json.loads(raw_order) if raw_order else None
+        ctx.last_order = snap if isinstance(snap, dict) else None
     except Exception:
-        return False
-
-    return last_seen_dt.date() != get_moscow_time().date()
+        pass
+    return ctx
 
 
 async def get_last_order_snapshot(user_id: int) -> Optional[dict]:
     try:
         r = await get_redis_client()
         raw = await r.get(_last_order_key(user_id))
-        await r.aclose()
         return json.loads(raw) if raw else None
     except Exception:
         return None
 
 
-async def set_last_order_snapshot(user_id: int, snapshot: dict):
-    try:
-        r = await get_redis_client()
-        await r.set(_last_order_key(user_id), json.dumps(snapshot, ensure_ascii=False))
-        await r.aclose()
-    except Exception:
-        pass
+# ---------------- Cart store ----------------
+# Корзина — отдельный hash на пользователя, не часть FSM data: правки O(1)
+# (HINCRBY/HDEL), переживает state.clear(), сама истекает через CART_TTL_SECONDS.
+CART_CHANGE_LUA = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    if redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2]) <= 0 then
+        redis.call('HDEL', KEYS[1], ARGV[1])
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+return redis.call('HGETALL', KEYS[1])
+"""
 
 
-# ---------------- Cart helpers ----------------
-def _get_cart(data: Dict[str, Any]) -> Dict[str, int]:
-    cart = data.get("cart")
-    if isinstance(cart, dict):
-        out: Dict[str, int] = {}
-        for k, v in cart.items():
+def _cart_key(user_id: int) -> str:
+    return f"{CART_KEY_PREFIX}{user_id}"
+
+
+def _parse_cart(raw: Any) -> Dict[str, int]:
+    if isinstance(raw, list):  # HGETALL из Lua приходит плоским списком
+        raw = dict(zip(raw[::2], raw[1::2]))
+    out: Dict[str, int] = {}
+    if isinstance(raw, dict):
+        for k, v in raw.items():
             try:
-                out[str(k)] = int(v)
+                q = int(v)
             except Exception:
                 continue
-        return out
-    return {}
+            if q > 0:
+                out[str(k)] = q
+    return out
+
+
+async def cart_get(user_id: int) -> Dict[str, int]:
+    r = await get_redis_client()
+    return _parse_cart(await r.hgetall(_cart_key(user_id)))
+
+
+async def cart_add(user_id: int, drink: str, qty: int) -> Dict[str, int]:
+    r = await get_redis_client()
+    pipe = r.pipeline(transaction=True)
+    pipe.hincrby(_cart_key(user_id), drink, qty)
+    pipe.expire(_cart_key(user_id), CART_TTL_SECONDS)
+    pipe.hgetall(_cart_key(user_id))
+    return _parse_cart((await pipe.execute())[-1])
+
+
+async def cart_change(user_id: int, drink: str, delta: int) -> Dict[str, int]:
+    """+delta к позиции, если она есть в корзине; дошло до нуля — позиция удаляется."""
+    raw = await redis_script(CART_CHANGE_LUA)(keys=[_cart_key(user_id)], args=[drink, delta, CART_TTL_SECONDS])
+    return _parse_cart(raw)
+
+
+async def cart_remove(user_id: int, drink: str) -> Dict[str, int]:
+    r = await get_redis_client()
+    pipe = r.pipeline(transaction=True)
+    pipe.hdel(_cart_key(user_id), drink)
+    pipe.hgetall(_cart_key(user_id))
+    return _parse_cart((await pipe.execute())[-1])
+
+
+async def cart_replace(user_id: int, cart: Dict[str, int]):
+    r = await get_redis_client()
+    pipe = r.pipeline(transaction=True)
+    pipe.delete(_cart_key(user_id))
+    if cart:
+        pipe.hset(_cart_key(user_id), mapping=cart)
+        pipe.expire(_cart_key(user_id), CART_TTL_SECONDS)
+    await pipe.execute()
+
+
+async def cart_clear(user_id: int):
+    r = await get_redis_client()
+    await r.delete(_cart_key(user_id))
+
+
+# ---------------- Cart helpers ----------------
 
 
 def _cart_total(cart: Dict[str, int]) -> int:
@@ -843,10 +2285,10 @@ def _cart_text(cart: Dict[str, int]) -> str:
     return "🛒 <b>Ваш заказ:</b>\n" + "\n".join(_cart_lines(cart)) + f"\n\n💰 Итого: <b>{_cart_total(cart)}₽</b>"
 
 
-async def _show_cart(message: Message, state: FSMContext):
-    cart = _get_cart(await state.get_data())
+async def _show_cart(message: Message, state: FSMContext, cart: Optional[Dict[str, int]] = None):
+    if cart is None:
+        cart = await cart_get(message.from_user.id)
     await state.set_state(OrderStates.cart_view)
-    await state.update_data(cart=cart)
     await message.answer(_cart_text(cart), reply_markup=create_cart_keyboard(bool(cart)))
 
 
@@ -899,6 +2341,7 @@ BTN_PAY_YEAR = "💳 Оплатить 360 дней"
 
 
 # ---------------- Keyboards ----------------
+@functools.lru_cache(maxsize=None)
 def create_start_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -913,6 +2356,10 @@ def create_start_keyboard() -> ReplyKeyboardMarkup:
 
 
 def create_client_menu_keyboard() -> ReplyKeyboardMarkup:
+    return _cached_render(("client_menu_kb",), _build_client_menu_keyboard)
+
+
+def _build_client_menu_keyboard() -> ReplyKeyboardMarkup:
     kb: list[list[KeyboardButton]] = []
 
     for drink in MENU.keys():
@@ -936,6 +2383,7 @@ def create_client_menu_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
+@functools.lru_cache(maxsize=None)
 def create_owner_menu_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -953,6 +2401,13 @@ def create_owner_menu_keyboard() -> ReplyKeyboardMarkup:
 
 
 def create_cart_keyboard(cart_has_items: bool) -> ReplyKeyboardMarkup:
+    return _cached_render(
+        ("cart_kb", bool(cart_has_items)),
+        lambda: _build_cart_keyboard(bool(cart_has_items)),
+    )
+
+
+def _build_cart_keyboard(cart_has_items: bool) -> ReplyKeyboardMarkup:
     kb: list[list[KeyboardButton]] = []
 
     kb.append([KeyboardButton(text=BTN_CART), KeyboardButton(text=BTN_CHECKOUT)])
@@ -983,6 +2438,7 @@ def create_cart_keyboard(cart_has_items: bool) -> ReplyKeyboardMarkup:
     )
 
 
+@functools.lru_cache(maxsize=None)
 def create_quantity_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -994,6 +2450,7 @@ def create_quantity_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
+@functools.lru_cache(maxsize=None)
 def create_confirm_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -1005,6 +2462,7 @@ def create_confirm_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
+@functools.lru_cache(maxsize=None)
 def create_ready_time_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -1022,6 +2480,7 @@ def create_cart_pick_item_keyboard(cart: Dict[str, int]) -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True, one_time_keyboard=True)
 
 
+@functools.lru_cache(maxsize=None)
 def create_cart_edit_actions_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -1034,6 +2493,7 @@ def create_cart_edit_actions_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
+@functools.lru_cache(maxsize=None)
 def create_booking_cancel_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text=BTN_CANCEL)]],
@@ -1042,6 +2502,16 @@ def create_booking_cancel_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
+@functools.lru_cache(maxsize=None)
+def create_broadcast_confirm_keyboard() -> ReplyKeyboardMarkup:
+    return ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text=BTN_CONFIRM), KeyboardButton(text=BTN_CANCEL)]],
+        resize_keyboard=True,
+        one_time_keyboard=True,
+    )
+
+
+@functools.lru_cache(maxsize=None)
 def create_booking_people_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -1054,6 +2524,7 @@ def create_booking_people_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
+@functools.lru_cache(maxsize=None)
 def create_menu_edit_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -1065,6 +2536,7 @@ def create_menu_edit_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
+@functools.lru_cache(maxsize=None)
 def create_menu_edit_cancel_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text=BTN_BACK)]],
@@ -1074,6 +2546,10 @@ def create_menu_edit_cancel_keyboard() -> ReplyKeyboardMarkup:
 
 
 def create_pick_menu_item_keyboard() -> ReplyKeyboardMarkup:
+    return _cached_render(("pick_menu_item_kb",), _build_pick_menu_item_keyboard)
+
+
+def _build_pick_menu_item_keyboard() -> ReplyKeyboardMarkup:
     rows = [[KeyboardButton(text=k)] for k in MENU.keys()]
     rows.append([KeyboardButton(text=BTN_BACK)])
     return ReplyKeyboardMarkup(
@@ -1087,7 +2563,6 @@ def create_pick_menu_item_keyboard() -> ReplyKeyboardMarkup:
 @router.message(F.text == BTN_CLIENT_MENU)
 async def open_client_menu(message: Message, state: FSMContext):
     await state.clear()
-    await sync_menu_from_redis()
 
     await message.answer(
         "🍽 <b>Меню клиента</b>\n\n"
@@ -1113,7 +2588,6 @@ async def open_owner_menu(message: Message, state: FSMContext):
 @router.message(F.text == BTN_TO_START)
 async def back_to_start(message: Message, state: FSMContext):
     await state.clear()
-    await sync_menu_from_redis()
 
     await message.answer(
         "🏠 Вы вернулись в главное меню.\n\n"
@@ -1303,14 +2777,13 @@ FINISH_VARIANTS = [
 @router.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
     await state.clear()
-    await sync_menu_from_redis()
 
     user_id = message.from_user.id
     name = html.quote(get_user_name(message))
     welcome = random.choice(WELCOME_VARIANTS).format(name=name)
 
-    offer_repeat = await should_offer_repeat(user_id)
-    await set_last_seen(user_id)
+    ctx = await load_start_context(user_id)
+    await refresh_menu_if_stale(ctx.menu_version)
 
     if not is_cafe_open():
         await message.answer(
@@ -1319,8 +2792,8 @@ async def cmd_start(message: Message, state: FSMContext):
         )
         return
 
-    if offer_repeat:
-        snap = await get_last_order_snapshot(user_id)
+    if ctx.offer_repeat:
+        snap = ctx.last_order
         if snap and isinstance(snap.get("cart"), dict) and snap.get("cart"):
             cart_preview = snap["cart"]
             lines = []
@@ -1359,6 +2832,101 @@ async def webhookinfo(message: Message):
     )
 
 
+@router.message(Command("poolstats"))
+async def poolstats_cmd(message: Message):
+    if message.from_user.id != SUPERADMIN_ID:
+        return
+
+    stats = redis_pool_stats()
+    if not stats:
+        await message.answer("Пул Redis ещё не создан.")
+        return
+
+    text = "<b>Redis pool</b>\n" + "\n".join(f"{k}: <code>{v}</code>" for k, v in stats.items())
+    if update_executor is not None:
+        text += "\n\n<b>Update executor</b>\n" + "\n".join(
+            f"{k}: <code>{v}</code>" for k, v in update_executor.stats().items()
+        )
+    text += (
+        "\n\n<b>Event loop</b>\n"
+        f"lag_ms: <code>{round(loop_monitor.lag * 1000, 1)}</code>\n"
+        f"max_lag_5s_ms: <code>{round(loop_monitor.recent_max_lag() * 1000, 1)}</code>\n"
+        f"blocked_total: <code>{loop_monitor.blocked_total}</code>"
+    )
+    for where, count in loop_monitor.top_offenders():
+        text += f"\n  <code>{html.quote(where)}</code> × {count}"
+    await message.answer(text, parse_mode="HTML")
+
+
+@router.message(Command("profile"))
+async def profile_cmd(message: Message):
+    """/profile [секунды] [sample|cpu] — профиль живого процесса файлом."""
+    if message.from_user.id != SUPERADMIN_ID:
+        return
+
+    try:
+        seconds, mode = parse_profile_args((message.text or "").split()[1:])
+    except ValueError:
+        await message.answer(
+            f"Формат: <code>/profile [секунды до {PROFILE_MAX_SECONDS}] [sample|cpu]</code>"
+        )
+        return
+
+    global profile_task
+    if profile_task is not None and not profile_task.done():
+        await message.answer("Профилировщик уже запущен.")
+        return
+
+    # в фоне: хендлер не должен держать шард executor'а на всё время профиля
+    await message.answer(f"⏱ Профилирую {seconds:g} с, режим <b>{mode}</b>…")
+    profile_task = asyncio.create_task(_profile_and_report(message.bot, message.chat.id, seconds, mode))
+
+
+async def _profile_and_report(bot: Bot, chat_id: int, seconds: float, mode: str):
+    try:
+        result = await run_profile(seconds, mode)
+        data = await asyncio.to_thread(_read_file_bytes, result.path)
+        caption = f"{mode}, {seconds:g} с" + (f", {result.samples} сэмплов" if result.samples else "")
+        await bot.send_document(chat_id, BufferedInputFile(data, os.path.basename(result.path)), caption=caption)
+        if result.summary:
+            await bot.send_message(chat_id, f"<pre>{html.quote(result.summary[:3500])}</pre>", parse_mode="HTML")
+        else:
+            await bot.send_message(chat_id, "Сэмплов нет — процесс простаивал.")
+    except ProfilerBusy:
+        await bot.send_message(chat_id, "Профилировщик уже запущен.")
+    except Exception as e:
+        logger.error(f"profile_cmd: {e}")
+        try:
+            await bot.send_message(chat_id, f"Не удалось снять профиль: {html.quote(str(e))}")
+        except Exception:
+            pass
+
+
+@router.message(Command("outbox"))
+async def outbox_cmd(message: Message):
+    """/outbox — очередь уведомлений; /outbox retry — вернуть dead-letter в очередь."""
+    if message.from_user.id != SUPERADMIN_ID:
+        return
+
+    if (message.text or "").split()[1:2] == ["retry"]:
+        requeued = await outbox_requeue_dead()
+        await message.answer(f"Возвращено в очередь: <b>{requeued}</b>")
+        return
+
+    r = await get_redis_client()
+    pipe = r.pipeline(transaction=False)
+    pipe.zcard(OUTBOX_PENDING_KEY)
+    pipe.zcount(OUTBOX_PENDING_KEY, "-inf", int(time.time()))
+    pipe.llen(OUTBOX_DEAD_KEY)
+    pending, due, dead = await pipe.execute()
+    await message.answer(
+        "<b>Outbox</b>\n"
+        f"pending: <code>{pending}</code>\n"
+        f"due: <code>{due}</code>\n"
+        f"dead: <code>{dead}</code>"
+    )
+
+
 @router.message(Command("myid"))
 async def myid_cmd(message: Message):
     user_id = message.from_user.id
@@ -1403,20 +2971,13 @@ async def repeat_last(message: Message, state: FSMContext):
         await message.answer("Не нашёл последний заказ.", reply_markup=create_start_keyboard())
         return
 
-    cart = {}
-    for k, v in snap["cart"].items():
-        try:
-            cart[str(k)] = int(v)
-        except Exception:
-            continue
-
-    filtered = {d: q for d, q in cart.items() if d in MENU and q > 0}
+    filtered = {d: q for d, q in _parse_cart(snap["cart"]).items() if d in MENU}
     if not filtered:
         await message.answer("Позиции из прошлого заказа сейчас отсутствуют в меню.", reply_markup=create_start_keyboard())
         return
 
-    await state.update_data(cart=filtered)
-    await _show_cart(message, state)
+    await cart_replace(message.from_user.id, filtered)
+    await _show_cart(message, state, filtered)
 
 
 @router.message(F.text == BTN_ABOUT_ASSISTANT)
@@ -1503,59 +3064,175 @@ async def owner_ads(message: Message):
 
 
 @router.message(F.text == BTN_BROADCAST)
-async def owner_broadcast(message: Message):
-    await message.answer(owner_broadcast_text(), reply_markup=create_owner_menu_keyboard())
+async def owner_broadcast(message: Message, state: FSMContext):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer(owner_broadcast_text(), reply_markup=create_owner_menu_keyboard())
+        return
 
+    active = await get_active_broadcast()
+    if active:
+        await message.answer(
+            broadcast_progress_text(active) + "\n\nОстановить: /broadcast_stop",
+            reply_markup=create_owner_menu_keyboard(),
+        )
+        return
 
-@router.message(F.text == BTN_TO_CLIENT_MODE)
-async def owner_client_mode_info(message: Message):
+    await state.clear()
+    await state.set_state(BroadcastStates.waiting_for_text)
     await message.answer(
-        owner_client_mode_text(),
-        reply_markup=create_owner_menu_keyboard(),
+        owner_broadcast_text() + "\n\nОтправьте текст рассылки одним сообщением.",
+        reply_markup=create_booking_cancel_keyboard(),
     )
 
 
-@router.message(F.text == BTN_SUBSCRIPTION)
-async def owner_subscription(message: Message):
-    await message.answer(owner_subscription_text(), reply_markup=create_owner_menu_keyboard())
-
+@router.message(StateFilter(BroadcastStates.waiting_for_text))
+async def owner_broadcast_text_received(message: Message, state: FSMContext):
+    if message.from_user.id != ADMIN_ID or message.text == BTN_CANCEL:
+        await state.clear()
+        await message.answer("Рассылка отменена.", reply_markup=create_owner_menu_keyboard())
+        return
 
-@router.message(F.text == BTN_ADMIN_HELP)
-async def owner_admin_help(message: Message):
-    await message.answer(owner_admin_help_text(), reply_markup=create_owner_menu_keyboard())
+    text = (message.html_text or "").strip()
+    if not text:
+        await message.answer("Нужен текст сообщения.", reply_markup=create_booking_cancel_keyboard())
+        return
 
+    data = await state.get_data()
+    if data.get("broadcast_segment"):
+        _, audience = await build_segment(AudienceSegment(**data["broadcast_segment"]))
+    else:
+        r = await get_redis_client()
+        audience = await r.scard(CUSTOMERS_SET_KEY)
+    await state.update_data(broadcast_text=text)
+    await state.set_state(BroadcastStates.waiting_for_confirmation)
+    await message.answer("👀 Так клиенты увидят сообщение:")
+    await message.answer(text)
+    await message.answer(
+        f"Получателей: <b>{audience}</b>. Запускаем рассылку?",
+        reply_markup=create_broadcast_confirm_keyboard(),
+    )
 
-@router.message(F.text == BTN_SUPPORT)
-async def owner_support(message: Message):
-    await message.answer(owner_support_text(), reply_markup=create_owner_menu_keyboard())
 
+@router.message(StateFilter(BroadcastStates.waiting_for_confirmation))
+async def owner_broadcast_confirm(message: Message, state: FSMContext):
+    if message.from_user.id != ADMIN_ID or message.text == BTN_CANCEL:
+        await state.clear()
+        await message.answer("Рассылка отменена.", reply_markup=create_owner_menu_keyboard())
+        return
 
-# ---------------- Menu edit entry (DEMO preview for non-admin) ----------------
-@router.message(F.text == BTN_MENU_EDIT)
-async def menu_edit_entry(message: Message, state: FSMContext):
-    if message.from_user.id != ADMIN_ID:
-        if DEMO_MODE:
-            await message.answer(demo_menu_edit_preview_text(), reply_markup=create_menu_edit_keyboard())
-            await message.answer("🔒 Редактирование доступно только администратору.", reply_markup=create_owner_menu_keyboard())
-        else:
-            await message.answer("🔒 Редактирование доступно только администратору.", reply_markup=create_owner_menu_keyboard())
+    if message.text != BTN_CONFIRM:
+        await message.answer("Подтвердите или отмените рассылку.", reply_markup=create_broadcast_confirm_keyboard())
         return
 
-    await sync_menu_from_redis()
+    data = await state.get_data()
     await state.clear()
-    await state.set_state(MenuEditStates.waiting_for_action)
-    await message.answer("🛠 Управление меню: выберите действие", reply_markup=create_menu_edit_keyboard())
+    text = data.get("broadcast_text")
+    if not text:
+        await message.answer("Текст рассылки потерян, начните заново.", reply_markup=create_owner_menu_keyboard())
+        return
 
+    segment = AudienceSegment(**data["broadcast_segment"]) if data.get("broadcast_segment") else None
+    job_id = await create_broadcast_job(text, message.chat.id, segment)
+    progress = await get_broadcast_progress(job_id)
+    sent = await message.answer(broadcast_progress_text(progress), reply_markup=create_owner_menu_keyboard())
+    r = await get_redis_client()
+    await r.hset(_broadcast_job_key(job_id), "progress_message_id", sent.message_id)
 
-@router.message(StateFilter(MenuEditStates.waiting_for_action))
-async def menu_edit_choose_action(message: Message, state: FSMContext):
+
+@router.message(Command("segment"))
+async def owner_segment(message: Message, state: FSMContext):
+    """/segment Латте, Раф inactive=14 orders=3 — размер аудитории и рассылка по ней."""
     if message.from_user.id != ADMIN_ID:
-        await state.clear()
         return
 
-    if message.text == BTN_BACK:
-        await state.clear()
-        await message.answer("Ок.", reply_markup=create_owner_menu_keyboard())
+    raw = (message.text or "").partition(" ")[2]
+    try:
+        segment = parse_segment_args(raw)
+    except ValueError:
+        await message.answer(
+            "Формат: /segment Латте, Раф inactive=14 active=30 orders=3 spent=1000 all",
+            reply_markup=create_owner_menu_keyboard(),
+        )
+        return
+
+    _, size = await build_segment(segment)
+    if not size or await get_active_broadcast():
+        await message.answer(f"👥 {segment.describe()}: <b>{size}</b>", reply_markup=create_owner_menu_keyboard())
+        return
+
+    await state.clear()
+    await state.set_state(BroadcastStates.waiting_for_text)
+    await state.update_data(broadcast_segment=asdict(segment))
+    await message.answer(
+        f"👥 {segment.describe()}: <b>{size}</b>\n\nОтправьте текст рассылки для этой аудитории.",
+        reply_markup=create_booking_cancel_keyboard(),
+    )
+
+
+@router.message(Command("broadcast_stop"))
+async def owner_broadcast_stop(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    active = await get_active_broadcast()
+    if not active:
+        await message.answer("Активных рассылок нет.", reply_markup=create_owner_menu_keyboard())
+        return
+
+    await cancel_broadcast(active.job_id)
+    active.status = "cancelled"
+    await message.answer(broadcast_progress_text(active), reply_markup=create_owner_menu_keyboard())
+
+
+@router.message(F.text == BTN_TO_CLIENT_MODE)
+async def owner_client_mode_info(message: Message):
+    await message.answer(
+        owner_client_mode_text(),
+        reply_markup=create_owner_menu_keyboard(),
+    )
+
+
+@router.message(F.text == BTN_SUBSCRIPTION)
+async def owner_subscription(message: Message):
+    await message.answer(owner_subscription_text(), reply_markup=create_owner_menu_keyboard())
+
+
+@router.message(F.text == BTN_ADMIN_HELP)
+async def owner_admin_help(message: Message):
+    await message.answer(owner_admin_help_text(), reply_markup=create_owner_menu_keyboard())
+
+
+@router.message(F.text == BTN_SUPPORT)
+async def owner_support(message: Message):
+    await message.answer(owner_support_text(), reply_markup=create_owner_menu_keyboard())
+
+
+# ---------------- Menu edit entry (DEMO preview for non-admin) ----------------
+@router.message(F.text == BTN_MENU_EDIT)
+async def menu_edit_entry(message: Message, state: FSMContext):
+    if message.from_user.id != ADMIN_ID:
+        if DEMO_MODE:
+            await message.answer(demo_menu_edit_preview_text(), reply_markup=create_menu_edit_keyboard())
+            await message.answer("🔒 Редактирование доступно только администратору.", reply_markup=create_owner_menu_keyboard())
+        else:
+            await message.answer("🔒 Редактирование доступно только администратору.", reply_markup=create_owner_menu_keyboard())
+        return
+
+    await refresh_menu_if_stale()
+    await state.clear()
+    await state.set_state(MenuEditStates.waiting_for_action)
+    await message.answer("🛠 Управление меню: выберите действие", reply_markup=create_menu_edit_keyboard())
+
+
+@router.message(StateFilter(MenuEditStates.waiting_for_action))
+async def menu_edit_choose_action(message: Message, state: FSMContext):
+    if message.from_user.id != ADMIN_ID:
+        await state.clear()
+        return
+
+    if message.text == BTN_BACK:
+        await state.clear()
+        await message.answer("Ок.", reply_markup=create_owner_menu_keyboard())
         return
 
     if message.text == MENU_EDIT_ADD:
@@ -1721,6 +3398,147 @@ async def testcb_handler(callback: CallbackQuery):
         await callback.message.answer("✅ test_cb handler сработал")
 
 
+# ---------------- Sales analytics (time buckets) ----------------
+def _stats_hour_key(dt: datetime) -> str:
+    return f"{STATS_HOUR_PREFIX}{dt:%Y%m%d%H}"
+
+
+def _stats_day_key(dt: datetime) -> str:
+    return f"{STATS_DAY_PREFIX}{dt:%Y%m%d}"
+
+
+@dataclass
+class SalesSummary:
+    orders: int = 0
+    revenue: int = 0
+    drinks: Dict[str, int] = field(default_factory=dict)
+    drinks_revenue: Dict[str, int] = field(default_factory=dict)
+    orders_by_hour: Dict[int, int] = field(default_factory=dict)  # час суток (МСК) -> заказов
+
+    @property
+    def busiest_hour(self) -> Optional[int]:
+        if not self.orders_by_hour:
+            return None
+        return max(self.orders_by_hour, key=self.orders_by_hour.get)
+
+
+def _bucket_keys_for_range(start: datetime, end: datetime) -> list[str]:
+    """
+    Ключи бакетов, покрывающие [start, end) в МСК: целые сутки берутся дневным
+    бакетом, неполные — часовыми. Начало округляется вниз до часа.
+    """
+    keys: list[str] = []
+    cur = start.astimezone(MSK_TZ).replace(minute=0, second=0, microsecond=0)
+    end = end.astimezone(MSK_TZ)
+    while cur < end:
+        day_start = cur.replace(hour=0)
+        next_day = day_start + timedelta(days=1)
+        if cur == day_start and next_day <= end:
+            keys.append(_stats_day_key(cur))
+            cur = next_day
+        else:
+            keys.append(_stats_hour_key(cur))
+            cur += timedelta(hours=1)
+    return keys
+
+
+def _merge_buckets(buckets: Dict[str, Dict[str, str]], keys: list[str]) -> SalesSummary:
+    summary = SalesSummary()
+    for key in keys:
+        is_hour_bucket = key.startswith(STATS_HOUR_PREFIX)
+        for name, raw in (buckets.get(key) or {}).items():
+            try:
+                value = int(raw)
+            except Exception:
+                continue
+            if name == "orders":
+                summary.orders += value
+                if is_hour_bucket:
+                    hour = int(key[-2:])
+                    summary.orders_by_hour[hour] = summary.orders_by_hour.get(hour, 0) + value
+            elif name == "revenue":
+                summary.revenue += value
+            elif name.startswith("qty:"):
+                drink = name[4:]
+                summary.drinks[drink] = summary.drinks.get(drink, 0) + value
+            elif name.startswith("rev:"):
+                drink = name[4:]
+                summary.drinks_revenue[drink] = summary.drinks_revenue.get(drink, 0) + value
+            elif name.startswith("hour:") and not is_hour_bucket:
+                hour = int(name[5:])
+                summary.orders_by_hour[hour] = summary.orders_by_hour.get(hour, 0) + value
+    return summary
+
+
+async def get_sales_summaries(ranges: list[Tuple[datetime, datetime]]) -> list[SalesSummary]:
+    """Сводки по нескольким диапазонам; все нужные бакеты читаются одним pipeline."""
+    keys_per_range = [_bucket_keys_for_range(start, end) for start, end in ranges]
+    unique_keys = list(dict.fromkeys(k for keys in keys_per_range for k in keys))
+
+    r = await get_redis_client()
+    pipe = r.pipeline(transaction=False)
+    for key in unique_keys:
+        pipe.hgetall(key)
+    buckets = dict(zip(unique_keys, await pipe.execute()))
+
+    return [_merge_buckets(buckets, keys) for keys in keys_per_range]
+
+
+async def get_sales_summary(start: datetime, end: datetime) -> SalesSummary:
+    return (await get_sales_summaries([(start, end)]))[0]
+
+
+SALES_PERIOD_TITLES = {
+    "today": "Сегодня",
+    "week": "7 дней",
+    "month": "30 дней",
+}
+
+
+def _sales_periods() -> Dict[str, Tuple[datetime, datetime]]:
+    now = get_moscow_time()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return {
+        "today": (today, now),
+        "week": (today - timedelta(days=6), now),
+        "month": (today - timedelta(days=29), now),
+    }
+
+
+@router.message(Command("sales"))
+async def sales_cmd(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    parts = (message.text or "").split()
+    period = parts[1].lower() if len(parts) > 1 else "today"
+    periods = _sales_periods()
+    if period not in periods:
+        await message.answer("Формат: /sales [today|week|month]")
+        return
+
+    try:
+        summary = await get_sales_summary(*periods[period])
+    except Exception as e:
+        logger.error(f"sales_cmd: {e}")
+        await message.answer("❌ Ошибка статистики", reply_markup=create_owner_menu_keyboard())
+        return
+
+    lines = [
+        f"• {html.quote(drink)}: <b>{qty}</b> шт., <b>{summary.drinks_revenue.get(drink, 0)}₽</b>"
+        for drink, qty in sorted(summary.drinks.items(), key=lambda kv: -kv[1])
+    ]
+    busiest = summary.busiest_hour
+    text = (
+        f"📈 <b>Продажи: {SALES_PERIOD_TITLES[period]}</b>\n\n"
+        f"Заказов: <b>{summary.orders}</b>\n"
+        f"Выручка: <b>{summary.revenue}₽</b>"
+        + (f"\nПиковый час: <b>{busiest:02d}:00</b>" if busiest is not None else "")
+        + ("\n\n<b>По позициям:</b>\n" + "\n".join(lines) if lines else "")
+    )
+    await message.answer(text, reply_markup=create_owner_menu_keyboard())
+
+
 # ---------------- Stats button (DEMO preview for non-admin) ----------------
 @router.message(F.text == BTN_STATS)
 async def stats_button(message: Message):
@@ -1733,21 +3551,36 @@ async def stats_button(message: Message):
 
     try:
         r = await get_redis_client()
-        total_orders = int(await r.get(STATS_TOTAL_ORDERS) or 0)
-        total_rev = int(await r.get(STATS_TOTAL_REVENUE) or 0)
+        pipe = r.pipeline(transaction=False)
+        pipe.get(STATS_TOTAL_ORDERS)
+        pipe.get(STATS_TOTAL_REVENUE)
+        pipe.hgetall(STATS_DRINKS_KEY)
+        pipe.hgetall(STATS_DRINKS_REV_KEY)
+        raw_orders, raw_rev, counts, revenues = await pipe.execute()
+        total_orders = int(raw_orders or 0)
+        total_rev = int(raw_rev or 0)
 
         lines = []
         for drink in MENU.keys():
-            cnt = int(await r.get(f"{STATS_DRINK_PREFIX}{drink}") or 0)
-            rev = int(await r.get(f"{STATS_DRINK_REV_PREFIX}{drink}") or 0)
+            cnt = int(counts.get(drink) or 0)
+            rev = int(revenues.get(drink) or 0)
             lines.append(f"• {html.quote(drink)}: <b>{cnt}</b> шт., <b>{rev}₽</b>")
 
-        await r.aclose()
+        periods = _sales_periods()
+        summaries = await get_sales_summaries(list(periods.values()))
+        period_lines = [
+            f"{SALES_PERIOD_TITLES[name]}: <b>{summary.orders}</b> заказов, <b>{summary.revenue}₽</b>"
+            for name, summary in zip(periods, summaries)
+        ]
+        busiest = summaries[-1].busiest_hour
+        if busiest is not None:
+            period_lines.append(f"Пиковый час (30 дней): <b>{busiest:02d}:00</b>")
 
         text = (
             "📊 <b>Статистика</b>\n\n"
             f"Всего заказов: <b>{total_orders}</b>\n"
             f"Выручка всего: <b>{total_rev}₽</b>\n\n"
+            + "\n".join(period_lines) + "\n\n"
             "<b>По позициям:</b>\n" + "\n".join(lines)
         )
         await message.answer(text, reply_markup=create_owner_menu_keyboard())
@@ -1755,6 +3588,48 @@ async def stats_button(message: Message):
         await message.answer("❌ Ошибка статистики", reply_markup=create_owner_menu_keyboard())
 
 
+# Переносит значения из строковых ключей в hash и удаляет их, атомарно по пачке.
+# KEYS — старые ключи, ARGV[1] — hash, ARGV[2..] — имена полей.
+STATS_MIGRATE_LUA = """
+for i = 1, #KEYS do
+    local v = redis.call('GET', KEYS[i])
+    if v then
+        redis.call('HINCRBY', ARGV[1], ARGV[i + 1], v)
+        redis.call('DEL', KEYS[i])
+    end
+end
+return #KEYS
+"""
+
+
+async def migrate_drink_stats_to_hash():
+    r = await get_redis_client()
+    if await r.exists(STATS_MIGRATED_KEY):
+        return
+
+    moved = 0
+    for prefix, hash_key in (
+        (STATS_DRINK_PREFIX, STATS_DRINKS_KEY),
+        (STATS_DRINK_REV_PREFIX, STATS_DRINKS_REV_KEY),
+    ):
+        batch: list[str] = []
+        async for key in r.scan_iter(match=f"{prefix}*", count=500):
+            batch.append(key)
+            if len(batch) >= 200:
+                moved += await _migrate_stats_batch(batch, prefix, hash_key)
+                batch = []
+        if batch:
+            moved += await _migrate_stats_batch(batch, prefix, hash_key)
+
+    await r.set(STATS_MIGRATED_KEY, str(int(time.time())))
+    logger.info(f"migrate_drink_stats_to_hash: moved {moved} keys")
+
+
+async def _migrate_stats_batch(keys: list[str], prefix: str, hash_key: str) -> int:
+    fields = [k[len(prefix):] for k in keys]
+    return int(await redis_script(STATS_MIGRATE_LUA)(keys=keys, args=[hash_key, *fields]))
+
+
 # ---------------- Cart show/clear/cancel ----------------
 @router.message(F.text == BTN_CART)
 async def cart_button(message: Message, state: FSMContext):
@@ -1766,12 +3641,13 @@ async def cart_button(message: Message, state: FSMContext):
 
 @router.message(F.text == BTN_CLEAR_CART)
 async def clear_cart(message: Message, state: FSMContext):
-    await state.update_data(cart={})
-    await _show_cart(message, state)
+    await cart_clear(message.from_user.id)
+    await _show_cart(message, state, {})
 
 
 @router.message(F.text == BTN_CANCEL_ORDER)
 async def cancel_order(message: Message, state: FSMContext):
+    await cart_clear(message.from_user.id)
     await state.clear()
     await message.answer("❌ Заказ отменён.", reply_markup=create_client_menu_keyboard())
 
@@ -1779,7 +3655,7 @@ async def cancel_order(message: Message, state: FSMContext):
 # ---------------- Cart edit ----------------
 @router.message(F.text == BTN_EDIT_CART)
 async def edit_cart(message: Message, state: FSMContext):
-    cart = _get_cart(await state.get_data())
+    cart = await cart_get(message.from_user.id)
     if not cart:
         await message.answer("Корзина пустая.", reply_markup=create_client_menu_keyboard())
         return
@@ -1794,7 +3670,7 @@ async def pick_item_to_edit(message: Message, state: FSMContext):
         await _show_cart(message, state)
         return
 
-    cart = _get_cart(await state.get_data())
+    cart = await cart_get(message.from_user.id)
     if text not in cart:
         await message.answer("Выберите позицию кнопкой.", reply_markup=create_cart_pick_item_keyboard(cart))
         return
@@ -1811,32 +3687,24 @@ async def cart_edit_action(message: Message, state: FSMContext):
         await _show_cart(message, state)
         return
 
-    data = await state.get_data()
-    cart = _get_cart(data)
-    item = str(data.get("edit_item") or "")
+    item = str((await state.get_data()).get("edit_item") or "")
 
-    if action == CART_ACT_DONE:
-        await _show_cart(message, state)
-        return
-
-    if not item or item not in cart:
+    if action == CART_ACT_DONE or not item:
         await _show_cart(message, state)
         return
 
+    user_id = message.from_user.id
     if action == CART_ACT_PLUS:
-        cart[item] = int(cart.get(item, 0)) + 1
+        cart = await cart_change(user_id, item, 1)
     elif action == CART_ACT_MINUS:
-        cart[item] = int(cart.get(item, 0)) - 1
-        if cart[item] <= 0:
-            cart.pop(item, None)
+        cart = await cart_change(user_id, item, -1)
     elif action == CART_ACT_DEL:
-        cart.pop(item, None)
+        cart = await cart_remove(user_id, item)
     else:
         await message.answer("Выберите действие кнопкой.", reply_markup=create_cart_edit_actions_keyboard())
         return
 
-    await state.update_data(cart=cart)
-    await _show_cart(message, state)
+    await _show_cart(message, state, cart)
 
 
 # ---- Хендлер: кнопка «🍽 Меню клиента» ----
@@ -1848,9 +3716,8 @@ async def _start_add_item(message: Message, state: FSMContext, drink: str):
         await message.answer("Этой позиции уже нет.", reply_markup=create_client_menu_keyboard())
         return
 
-    cart = _get_cart(await state.get_data())
     await state.set_state(OrderStates.waiting_for_quantity)
-    await state.update_data(current_drink=drink, cart=cart)
+    await state.update_data(current_drink=drink)
 
     await message.answer(
         f"{random.choice(CHOICE_VARIANTS)}\n\n"
@@ -1863,7 +3730,7 @@ async def _start_add_item(message: Message, state: FSMContext, drink: str):
 async def process_quantity(message: Message, state: FSMContext):
     if message.text == BTN_CANCEL:
         await state.clear()
-        cart = _get_cart(await state.get_data())
+        cart = await cart_get(message.from_user.id)
         await message.answer(
             "Ок.",
             reply_markup=create_cart_keyboard(bool(cart)) if cart else create_client_menu_keyboard()
@@ -1878,17 +3745,14 @@ async def process_quantity(message: Message, state: FSMContext):
         await message.answer("Нажмите 1–5.", reply_markup=create_quantity_keyboard())
         return
 
-    data = await state.get_data()
-    drink = str(data.get("current_drink") or "")
-    cart = _get_cart(data)
+    drink = str((await state.get_data()).get("current_drink") or "")
 
     if not drink or drink not in MENU:
         await state.clear()
         await message.answer("Ошибка. Нажмите /start.", reply_markup=create_client_menu_keyboard())
         return
 
-    cart[drink] = int(cart.get(drink, 0)) + qty
-    await state.update_data(cart=cart)
+    cart = await cart_add(message.from_user.id, drink, qty)
     await state.set_state(OrderStates.cart_view)
 
     await message.answer(
@@ -1904,7 +3768,7 @@ async def checkout(message: Message, state: FSMContext):
         await message.answer(get_closed_message(), reply_markup=create_client_menu_keyboard())
         return
 
-    cart = _get_cart(await state.get_data())
+    cart = await cart_get(message.from_user.id)
     if not cart:
         await message.answer("Корзина пустая.", reply_markup=create_client_menu_keyboard())
         return
@@ -1919,6 +3783,7 @@ async def checkout(message: Message, state: FSMContext):
 @router.message(StateFilter(OrderStates.waiting_for_confirmation))
 async def confirm_order(message: Message, state: FSMContext):
     if message.text == BTN_CANCEL_ORDER:
+        await cart_clear(message.from_user.id)
         await state.clear()
         await message.answer("❌ Отменено.", reply_markup=create_client_menu_keyboard())
         return
@@ -1935,69 +3800,491 @@ async def confirm_order(message: Message, state: FSMContext):
     await message.answer("Когда забрать?", reply_markup=create_ready_time_keyboard())
 
 
+# ---------------- Order log ----------------
+# Заказ фиксируется одним коротким скриптом: корзина забирается (только если она
+# не изменилась с момента показа), уникальный номер (INCR orders:seq), снимок
+# последнего заказа и запись в поток orders:stream. Статистику, профиль
+# клиента и уведомление админа применяют группы потребителей потока в фоне,
+# каждая в своём темпе. Лимит частоты заказов (политика "order") проверяется и
+# списывается в том же скрипте: слот тратится только на реально записанный заказ.
+# ARGV[2..5] — скользящее окно rate limit (как в RATE_LIMIT_LUA), ARGV[6] — число
+# позиций, дальше пары позиция/количество, дальше поля записи потока.
+# Номер заказа; 0 — корзина уже не та (изменена или оформлена); < 0 — сработал
+# rate limit, по модулю — сколько миллисекунд ждать.
+ORDER_COMMIT_LUA = """
+local n = tonumber(ARGV[6])
+if redis.call('HLEN', KEYS[1]) ~= n then
+    return 0
+end
+for i = 7, 6 + n * 2, 2 do
+    if redis.call('HGET', KEYS[1], ARGV[i]) ~= ARGV[i + 1] then
+        return 0
+    end
+end
+
+local now = tonumber(ARGV[2])
+local window = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[5], '-inf', now - window)
+if redis.call('ZCARD', KEYS[5]) >= tonumber(ARGV[4]) then
+    local oldest = redis.call('ZRANGE', KEYS[5], 0, 0, 'WITHSCORES')
+    return -math.max(1, tonumber(oldest[2]) + window - now)
+end
+redis.call('ZADD', KEYS[5], now, ARGV[5])
+redis.call('PEXPIRE', KEYS[5], window)
+
+redis.call('DEL', KEYS[1])
+local order_id = redis.call('INCR', KEYS[3])
+redis.call('SET', KEYS[2], ARGV[1])
+redis.call('XADD', KEYS[4], '*', 'order_id', order_id, unpack(ARGV, 7 + n * 2))
+return order_id
+"""
+
+# Потребители stats/profile применяют заказ и делают XACK в одном скрипте:
+# если XACK вернул 0, запись уже учтена — повторная доставка ничего не удвоит.
+ORDER_STATS_LUA = """
+if redis.call('XACK', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+redis.call('INCR', KEYS[2])
+redis.call('INCRBY', KEYS[3], ARGV[3])
+for _, bucket in ipairs({KEYS[6], KEYS[7]}) do
+    redis.call('HINCRBY', bucket, 'orders', 1)
+    redis.call('HINCRBY', bucket, 'revenue', ARGV[3])
+end
+redis.call('HINCRBY', KEYS[7], 'hour:' .. ARGV[4], 1)
+redis.call('EXPIRE', KEYS[6], ARGV[5])
+redis.call('EXPIRE', KEYS[7], ARGV[6])
+
+for i = 7, #ARGV, 3 do
+    local drink, qty, revenue = ARGV[i], ARGV[i + 1], ARGV[i + 2]
+    redis.call('HINCRBY', KEYS[4], drink, qty)
+    redis.call('HINCRBY', KEYS[5], drink, revenue)
+    for _, bucket in ipairs({KEYS[6], KEYS[7]}) do
+        redis.call('HINCRBY', bucket, 'qty:' .. drink, qty)
+        redis.call('HINCRBY', bucket, 'rev:' .. drink, revenue)
+    end
+end
+return 1
+"""
+
+# Профиль клиента и индексы сегментов; KEYS[9..] — seg:drink:* в том же порядке, что и пары ARGV.
+ORDER_PROFILE_LUA = """
+if redis.call('XACK', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+redis.call('SADD', KEYS[2], ARGV[4])
+redis.call('HSETNX', KEYS[3], 'first_order_ts', ARGV[5])
+redis.call('HSETNX', KEYS[3], 'offers_opt_out', '0')
+redis.call('HSETNX', KEYS[3], 'last_trigger_ts', '0')
+redis.call('HSET', KEYS[3], 'firstname', ARGV[6], 'username', ARGV[7])
+local last_order_ts = tonumber(redis.call('HGET', KEYS[3], 'last_order_ts') or '') or 0
+if tonumber(ARGV[5]) >= last_order_ts then
+    last_order_ts = tonumber(ARGV[5])
+    redis.call('HSET', KEYS[3],
+        'last_order_ts', ARGV[5],
+        'last_order_sum', ARGV[3],
+        'last_drink', ARGV[8])
+end
+local total_orders = redis.call('HINCRBY', KEYS[3], 'total_orders', 1)
+local total_spent = redis.call('HINCRBY', KEYS[3], 'total_spent', ARGV[3])
+redis.call('ZADD', KEYS[6], total_spent, ARGV[4])
+redis.call('ZADD', KEYS[7], total_orders, ARGV[4])
+redis.call('ZADD', KEYS[8], last_order_ts, ARGV[4])
+
+local due = last_order_ts + tonumber(ARGV[9])
+local last_trigger = tonumber(redis.call('HGET', KEYS[3], 'last_trigger_ts') or '') or 0
+if last_trigger > 0 then
+    due = math.max(due, last_trigger + tonumber(ARGV[10]))
+end
+if redis.call('HGET', KEYS[3], 'offers_opt_out') ~= '1' then
+    redis.call('ZADD', KEYS[5], due, ARGV[4])
+end
+
+local drink_key = 9
+for i = 11, #ARGV, 2 do
+    local drink, qty = ARGV[i], ARGV[i + 1]
+    redis.call('SADD', KEYS[drink_key], ARGV[4])
+    drink_key = drink_key + 1
+    local drink_count = redis.call('HINCRBY', KEYS[4], drink, qty)
+    if drink_count > (tonumber(redis.call('HGET', KEYS[3], 'favorite_count') or '') or 0) then
+        redis.call('HSET', KEYS[3], 'favorite_drink', drink, 'favorite_count', drink_count)
+    end
+end
+return 1
+"""
+
+
+@dataclass
+class OrderRecord:
+    order_id: int
+    user_id: int
+    firstname: str
+    username: str
+    items: list[Tuple[str, int, int]]  # (позиция, количество, цена за штуку)
+    total: int
+    ready_in_min: int
+    ts: int
+
+    @property
+    def cart(self) -> Dict[str, int]:
+        return {drink: qty for drink, qty, _ in self.items}
+
+    def stream_fields(self) -> list[Any]:
+        return [
+            "user_id", self.user_id,
+            "firstname", self.firstname,
+            "username", self.username,
+            "items", json.dumps(self.items, ensure_ascii=False),
+            "total", self.total,
+            "ready_in_min", self.ready_in_min,
+            "ts", self.ts,
+        ]
+
+    @classmethod
+    def from_stream(cls, fields: Dict[str, str]) -> "OrderRecord":
+        return cls(
+            order_id=int(fields["order_id"]),
+            user_id=int(fields["user_id"]),
+            firstname=fields.get("firstname") or "",
+            username=fields.get("username") or "",
+            items=[(str(d), int(q), int(p)) for d, q, p in json.loads(fields.get("items") or "[]")],
+            total=int(fields.get("total") or 0),
+            ready_in_min=int(fields.get("ready_in_min") or 0),
+            ts=int(fields.get("ts") or 0),
+        )
+
+
+class OrderRateLimited(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+async def commit_order(
+    user_id: int,
+    firstname: str,
+    username: str,
+    cart: Dict[str, int],
+    total: int,
+    ready_in_min: int,
+) -> Optional[OrderRecord]:
+    """
+    Проверяет лимит частоты заказов, забирает корзину, присваивает заказу номер и
+    пишет его в orders:stream за один round trip. None — корзина в Redis уже не
+    совпадает с cart; OrderRateLimited — лимит исчерпан. В обоих случаях ничего не записано.
+    """
+    now_ts = int(time.time())
+    order = OrderRecord(
+        order_id=0,
+        user_id=user_id,
+        firstname=firstname or "",
+        username=username or "",
+        items=[(drink, int(qty), int(MENU.get(drink, 0))) for drink, qty in cart.items()],
+        total=int(total),
+        ready_in_min=ready_in_min,
+        ts=now_ts,
+    )
+    snapshot = {"cart": cart, "total": total, "ts": now_ts}
+
+    cart_pairs = []
+    for drink, qty in cart.items():
+        cart_pairs += [drink, str(int(qty))]
+
+    policy = RATE_LIMIT_POLICIES["order"]
+    now_ms = int(time.time() * 1000)
+    result = int(await redis_script(ORDER_COMMIT_LUA)(
+        keys=[
+            _cart_key(user_id),
+            _last_order_key(user_id),
+            ORDER_SEQ_KEY,
+            ORDER_STREAM_KEY,
+            _rate_limit_key("order", user_id),
+        ],
+        args=[
+            json.dumps(snapshot, ensure_ascii=False),
+            now_ms,
+            policy.window_seconds * 1000,
+            policy.limit,
+            f"{now_ms}:{uuid.uuid4().hex[:8]}",
+            len(cart),
+            *cart_pairs,
+            *order.stream_fields(),
+        ],
+    ))
+    if result < 0:
+        raise OrderRateLimited(-result / 1000)
+    if result == 0:
+        return None
+    order.order_id = result
+    return order
+
+
+async def _apply_order_stats(bot: Bot, msg_id: str, order: OrderRecord):
+    at = datetime.fromtimestamp(order.ts, tz=MSK_TZ)
+    keys = [
+        ORDER_STREAM_KEY,
+        STATS_TOTAL_ORDERS,
+        STATS_TOTAL_REVENUE,
+        STATS_DRINKS_KEY,
+        STATS_DRINKS_REV_KEY,
+        _stats_hour_key(at),
+        _stats_day_key(at),
+    ]
+    args = [
+        ORDER_GROUP_STATS,
+        msg_id,
+        order.total,
+        f"{at.hour:02d}",
+        STATS_HOUR_TTL_SECONDS,
+        STATS_DAY_TTL_SECONDS,
+    ]
+    for drink, qty, price in order.items:
+        args += [drink, qty, qty * price]
+    await redis_script(ORDER_STATS_LUA)(keys=keys, args=args)
+
+
+async def _apply_order_profile(bot: Bot, msg_id: str, order: OrderRecord):
+    keys = [
+        ORDER_STREAM_KEY,
+        CUSTOMERS_SET_KEY,
+        f"{CUSTOMER_KEY_PREFIX}{order.user_id}",
+        f"{CUSTOMER_DRINKS_PREFIX}{order.user_id}",
+        CUSTOMERS_DUE_KEY,
+        SEGMENT_SPEND_KEY,
+        SEGMENT_ORDERS_KEY,
+        SEGMENT_RECENCY_KEY,
+    ]
+    args = [
+        ORDER_GROUP_PROFILE,
+        msg_id,
+        order.total,
+        order.user_id,
+        order.ts,
+        order.firstname,
+        order.username,
+        order.items[0][0] if order.items else "",
+        RETURN_CYCLE_DAYS * 86400,
+        RETURN_COOLDOWN_DAYS * 86400,
+    ]
+    for drink, qty, _ in order.items:
+        args += [drink, qty]
+        keys.append(_segment_drink_key(drink))
+    await redis_script(ORDER_PROFILE_LUA)(keys=keys, args=args)
+
+
+def _order_ready_line(order: OrderRecord) -> str:
+    if order.ready_in_min <= 0:
+        return "как можно скорее"
+    ready_at = datetime.fromtimestamp(order.ts, tz=MSK_TZ) + timedelta(minutes=order.ready_in_min)
+    return f"через {order.ready_in_min} мин (к {ready_at.strftime('%H:%M')} МСК)"
+
+
+def _order_admin_text(order: OrderRecord) -> str:
+    lines = [f"• {html.quote(d)} × {q} = <b>{p * q}₽</b>" for d, q, p in order.items]
+    return (
+        f"🔔 <b>НОВЫЙ ЗАКАЗ #{order.order_id}</b> | {html.quote(CAFE_NAME)}\n\n"
+        f"<a href=\"tg://user?id={order.user_id}\">{html.quote(order.username or order.firstname or 'Клиент')}</a>\n"
+        f"<code>{order.user_id}</code>\n\n"
+        + "\n".join(lines)
+        + f"\n\n💰 Итого: <b>{order.total}₽</b>\n⏱ Готовность: <b>{html.quote(_order_ready_line(order))}</b>"
+    )
+
+
+async def _notify_order(bot: Bot, msg_id: str, order: OrderRecord):
+    # постановка в outbox и XACK — одна транзакция: уведомление не потеряется и не задвоится
+    chat_id, text = _admin_notification_target(order.user_id, _order_admin_text(order))
+    r = await get_redis_client()
+    pipe = r.pipeline(transaction=True)
+    outbox_add(pipe, chat_id, text, item_id=f"order-{order.order_id}")
+    pipe.xack(ORDER_STREAM_KEY, ORDER_GROUP_NOTIFY, msg_id)
+    await pipe.execute()
+
+
+ORDER_CONSUMERS = {
+    ORDER_GROUP_STATS: _apply_order_stats,
+    ORDER_GROUP_PROFILE: _apply_order_profile,
+    ORDER_GROUP_NOTIFY: _notify_order,
+}
+
+
+async def ensure_order_groups(r: redis.Redis):
+    for group in ORDER_CONSUMERS:
+        try:
+            await r.xgroup_create(ORDER_STREAM_KEY, group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+
+async def _order_deliveries(r: redis.Redis, group: str, entries) -> Dict[str, int]:
+    """Счётчики доставок (XPENDING) для подобранных записей — одним pipeline."""
+    pipe = r.pipeline(transaction=False)
+    for msg_id, _ in entries:
+        pipe.xpending_range(ORDER_STREAM_KEY, group, msg_id, msg_id, 1)
+    deliveries = {}
+    for msg_id, pending in zip((msg_id for msg_id, _ in entries), await pipe.execute()):
+        deliveries[msg_id] = int(pending[0]["times_delivered"]) if pending else 0
+    return deliveries
+
+
+async def _dead_letter_order(r: redis.Redis, group: str, msg_id: str, fields, deliveries: int):
+    # копия в orders:dead и XACK — одна транзакция, чтобы запись не потерялась и не вернулась
+    logger.error(f"order_consumer_loop[{group}] {msg_id}: dead after {deliveries} deliveries")
+    pipe = r.pipeline(transaction=True)
+    if fields:
+        pipe.xadd(
+            ORDER_DEAD_STREAM_KEY,
+            {**fields, "dead_group": group, "dead_msg_id": msg_id, "dead_deliveries": deliveries},
+            maxlen=ORDER_DEAD_MAXLEN,
+            approximate=True,
+        )
+    pipe.xack(ORDER_STREAM_KEY, group, msg_id)
+    await pipe.execute()
+
+
+async def order_consume_batch(bot: Bot, group: str) -> int:
+    """
+    Одна пачка orders:stream для группы. Сначала подбирает зависшие записи
+    (XAUTOCLAIM, в т.ч. свои же после рестарта), затем ждёт новые (XREADGROUP BLOCK).
+    Запись, на которой хендлер упал, остаётся в pending и повторяется через ORDER_CLAIM_IDLE_MS;
+    после ORDER_MAX_DELIVERIES доставок она переносится в orders:dead.
+    """
+    handler = ORDER_CONSUMERS[group]
+    r = await get_redis_client()
+    claimed = await r.xautoclaim(
+        ORDER_STREAM_KEY,
+        group,
+        ORDER_CONSUMER_NAME,
+        min_idle_time=ORDER_CLAIM_IDLE_MS,
+        start_id="0-0",
+        count=ORDER_READ_COUNT,
+    )
+    entries = claimed[1]
+    deliveries = await _order_deliveries(r, group, entries) if entries else {}
+    if not entries:
+        resp = await r.xreadgroup(
+            group,
+            ORDER_CONSUMER_NAME,
+            {ORDER_STREAM_KEY: ">"},
+            count=ORDER_READ_COUNT,
+            block=ORDER_BLOCK_MS,
+        )
+        entries = resp[0][1] if resp else []
+
+    for msg_id, fields in entries:
+        try:
+            if not fields or deliveries.get(msg_id, 0) > ORDER_MAX_DELIVERIES:
+                await _dead_letter_order(r, group, msg_id, fields, deliveries.get(msg_id, 0))
+                continue
+            await handler(bot, msg_id, OrderRecord.from_stream(fields))
+        except Exception as e:
+            logger.error(f"order_consumer_loop[{group}] {msg_id}: {e}")
+    return len(entries)
+
+
+def _stream_id(value: str) -> Tuple[int, int]:
+    ms, _, seq = value.partition("-")
+    return int(ms), int(seq or 0)
+
+
+async def order_trim_stream(r: redis.Redis) -> int:
+    """
+    XTRIM MINID по самой отстающей группе: граница — самая старая pending-запись группы,
+    а без pending — её last-delivered-id. Заодно удаляет консьюмеров прошлых процессов,
+    у которых нет pending. Возвращает число удалённых записей.
+    """
+    groups = {g["name"]: g for g in await r.xinfo_groups(ORDER_STREAM_KEY)}
+    if not groups or any(group not in groups for group in ORDER_CONSUMERS):
+        return 0
+
+    pipe = r.pipeline(transaction=False)
+    for group in groups:
+        pipe.xpending(ORDER_STREAM_KEY, group)
+        pipe.xinfo_consumers(ORDER_STREAM_KEY, group)
+    replies = await pipe.execute()
+
+    min_id = None
+    stale = []
+    for (group, info), pending, consumers in zip(groups.items(), replies[::2], replies[1::2]):
+        bound = pending["min"] if pending["pending"] else info["last-delivered-id"]
+        if min_id is None or _stream_id(bound) < _stream_id(min_id):
+            min_id = bound
+        stale += [
+            (group, c["name"]) for c in consumers
+            if not c["pending"] and c["idle"] > ORDER_CONSUMER_IDLE_DELETE_MS and c["name"] != ORDER_CONSUMER_NAME
+        ]
+
+    pipe = r.pipeline(transaction=False)
+    pipe.xtrim(ORDER_STREAM_KEY, minid=min_id, approximate=False)
+    for group, consumer in stale:
+        pipe.xgroup_delconsumer(ORDER_STREAM_KEY, group, consumer)
+    return int((await pipe.execute())[0])
+
+
+async def order_consumer_loop(bot: Bot, group: str):
+    trimmed_at = time.monotonic()
+    while True:
+        try:
+            await order_consume_batch(bot, group)
+            # обрезку ведёт одна группа: границу всё равно задаёт самая отстающая
+            if group == ORDER_GROUP_STATS and time.monotonic() - trimmed_at >= ORDER_TRIM_INTERVAL_SECONDS:
+                trimmed_at = time.monotonic()
+                await order_trim_stream(await get_redis_client())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"order_consumer_loop[{group}]: {e}")
+            await asyncio.sleep(ORDER_RETRY_SECONDS)
+
+
 async def _finalize_order(message: Message, state: FSMContext, ready_in_min: int):
     user_id = message.from_user.id
-    cart = _get_cart(await state.get_data())
+    cart = await cart_get(user_id)
 
     if not cart:
         await state.clear()
         await message.answer("Корзина пустая.", reply_markup=create_client_menu_keyboard())
         return
 
-    try:
-        r = await get_redis_client()
-        last_order = await r.get(_rate_limit_key(user_id))
-        if last_order and time.time() - float(last_order) < RATE_LIMIT_SECONDS:
-            await r.aclose()
-            await state.clear()
-            await message.answer(
-                f"⏳ Подождите {RATE_LIMIT_SECONDS} секунд между заказами.",
-                reply_markup=create_client_menu_keyboard(),
-            )
-            return
-        await r.setex(_rate_limit_key(user_id), RATE_LIMIT_SECONDS, str(time.time()))
-        await r.aclose()
-    except Exception:
-        pass
-
     total = _cart_total(cart)
-    order_num = str(int(time.time()))[-6:]
-    ready_at_str = (get_moscow_time() + timedelta(minutes=max(0, ready_in_min))).strftime("%H:%M")
-    ready_line = "как можно скорее" if ready_in_min <= 0 else f"через {ready_in_min} мин (к {ready_at_str} МСК)"
-
-    await set_last_order_snapshot(user_id, {"cart": cart, "total": total, "ts": int(time.time())})
 
     try:
-        r = await get_redis_client()
-        await r.incr(STATS_TOTAL_ORDERS)
-        await r.incrby(STATS_TOTAL_REVENUE, int(total))
-        for drink, qty in cart.items():
-            qty_i = int(qty)
-            price = int(MENU.get(drink, 0))
-            await r.incrby(f"{STATS_DRINK_PREFIX}{drink}", qty_i)
-            await r.incrby(f"{STATS_DRINK_REV_PREFIX}{drink}", qty_i * price)
-        await r.aclose()
-    except Exception:
-        pass
-
-    admin_msg = (
-        f"🔔 <b>НОВЫЙ ЗАКАЗ #{order_num}</b> | {html.quote(CAFE_NAME)}\n\n"
-        f"<a href=\"tg://user?id={user_id}\">{html.quote(message.from_user.username or message.from_user.first_name or 'Клиент')}</a>\n"
-        f"<code>{user_id}</code>\n\n"
-        + "\n".join(_cart_lines(cart))
-        + f"\n\n💰 Итого: <b>{total}₽</b>\n⏱ Готовность: <b>{html.quote(ready_line)}</b>"
-    )
+        order = await commit_order(
+            user_id,
+            message.from_user.first_name or "",
+            message.from_user.username or "",
+            cart,
+            total,
+            ready_in_min,
+        )
+    except OrderRateLimited as e:
+        logger.info(f"RATE LIMIT action=order user_id={user_id} retry_after={e.retry_after:.1f}s")
+        await message.answer(
+            f"⏳ Подождите {max(1, math.ceil(e.retry_after))} сек. — между заказами нужна пауза "
+            f"{RATE_LIMIT_SECONDS} секунд. Корзина сохранена.",
+            reply_markup=create_ready_time_keyboard(),
+        )
+        return
+    except Exception as e:
+        # заказ не записан: корзина и состояние остаются, клиент повторит нажатие
+        logger.error(f"commit_order user_id={user_id}: {e}")
+        await message.answer(
+            "⚠️ Не удалось оформить заказ, корзина сохранена. Попробуйте ещё раз через минуту.",
+            reply_markup=create_ready_time_keyboard(),
+        )
+        return
 
-    if DEMO_MODE:
-        await send_admin_demo_to_user(message.bot, user_id, admin_msg)
-    else:
-        await send_admin_only(message.bot, admin_msg)
+    if order is None:
+        # корзину успели изменить — показываем актуальную, подтверждать заново
+        await _show_cart(message, state)
+        return
 
     finish = random.choice(FINISH_VARIANTS).format(name=html.quote(get_user_name(message)))
 
     await state.clear()
     await message.answer(
-        f"🎉 <b>Заказ принят!</b>\n\n{_cart_text(cart)}\n\n⏱ Готовность: {html.quote(ready_line)}\n\n{finish}",
+        f"🎉 <b>Заказ #{order.order_id} принят!</b>\n\n{_cart_text(cart)}\n\n"
+        f"⏱ Готовность: {html.quote(_order_ready_line(order))}\n\n{finish}",
         reply_markup=create_client_menu_keyboard(),
     )
 
@@ -2094,6 +4381,11 @@ async def booking_finish(message: Message, state: FSMContext):
     booking_id = str(int(time.time()))[-6:]
     user_id = message.from_user.id
 
+    # слот списывается здесь, вместе с отправкой брони, а не на кнопке BTN_BOOKING
+    if await rate_limit_reject(message, "booking"):
+        await state.clear()
+        return
+
     await message.answer("✅ Бронь отправлена админу.", reply_markup=create_start_keyboard())
 
     admin_msg = (
@@ -2105,11 +4397,7 @@ async def booking_finish(message: Message, state: FSMContext):
         f"💬 Комментарий: {html.quote(comment)}"
     )
 
-    if DEMO_MODE:
-        await send_admin_demo_to_user(message.bot, user_id, admin_msg)
-    else:
-        await send_admin_only(message.bot, admin_msg)
-
+    await notify_admin(message.bot, user_id, admin_msg)
     await state.clear()
 
 
@@ -2177,127 +4465,315 @@ def _in_send_window_msk() -> bool:
     return RETURN_SEND_FROM_HOUR <= h < RETURN_SEND_TO_HOUR
 
 
-async def _get_favorite_drink(user_id: int) -> str:
-    key = f"{CUSTOMER_DRINKS_PREFIX}{user_id}"
-    try:
-        r = await get_redis_client()
-        data = await r.hgetall(key)
-        await r.aclose()
-        best_name, best_cnt = "", -1
-        for k, v in data.items():
-            try:
-                cnt = int(v)
-                if cnt > best_cnt:
-                    best_cnt = cnt
-                    best_name = str(k)
-            except Exception:
-                continue
-        return best_name
-    except Exception:
-        return ""
-
+def _favorite_drink_from_counts(data: Dict[str, str]) -> str:
+    best_name, best_cnt = "", -1
+    for k, v in data.items():
+        try:
+            cnt = int(v)
+            if cnt > best_cnt:
+                best_cnt = cnt
+                best_name = str(k)
+        except Exception:
+            continue
+    return best_name
 
-async def customer_mark_order(user_id: int, firstname: str, username: str, cart: Dict[str, int], total_sum: int):
-    now_ts = int(time.time())
-    customer_key = f"{CUSTOMER_KEY_PREFIX}{user_id}"
-    drinks_key = f"{CUSTOMER_DRINKS_PREFIX}{user_id}"
-    last_drink = next(iter(cart.keys()), "")
 
+def _customer_due_ts(profile: Dict[str, str]) -> Optional[int]:
+    """Когда клиенту можно отправить напоминание; None — никогда (нет профиля или отписан)."""
+    if not profile or str(profile.get("offers_opt_out", 0)) == "1":
+        return None
     try:
-        r = await get_redis_client()
-        pipe = r.pipeline()
-        pipe.sadd(CUSTOMERS_SET_KEY, user_id)
-        pipe.hsetnx(customer_key, "first_order_ts", now_ts)
-        pipe.hsetnx(customer_key, "offers_opt_out", 0)
-        pipe.hsetnx(customer_key, "last_trigger_ts", 0)
-        pipe.hset(
-            customer_key,
-            mapping={
-                "firstname": firstname or "",
-                "username": username or "",
-                "last_order_ts": now_ts,
-                "last_order_sum": int(total_sum),
-                "last_drink": last_drink,
-            },
-        )
-        pipe.hincrby(customer_key, "total_orders", 1)
-        pipe.hincrby(customer_key, "total_spent", int(total_sum))
-        for drink, qty in cart.items():
-            pipe.hincrby(drinks_key, drink, int(qty))
-        await pipe.execute()
-        await r.aclose()
+        last_order_ts = int(float(profile.get("last_order_ts", 0) or 0))
     except Exception:
-        pass
-
-
-async def smart_return_check_and_send(bot: Bot):
-    if not _in_send_window_msk():
-        return
-
-    now_ts = int(time.time())
+        return None
     try:
-        r = await get_redis_client()
-        ids = await r.smembers(CUSTOMERS_SET_KEY)
-        await r.aclose()
-        ids = [int(x) for x in ids]
+        last_trigger_ts = int(float(profile.get("last_trigger_ts", 0) or 0))
     except Exception:
-        ids = []
+        last_trigger_ts = 0
+
+    due = last_order_ts + RETURN_CYCLE_DAYS * 86400
+    if last_trigger_ts:
+        due = max(due, last_trigger_ts + RETURN_COOLDOWN_DAYS * 86400)
+    return due
+
+
+async def _for_each_customer_batch(r: redis.Redis, flush) -> int:
+    """SSCAN по customers:set пачками по RETURN_BATCH; flush(ids) возвращает число обработанных."""
+    count = 0
+    batch: list[str] = []
+    async for user_id in r.sscan_iter(CUSTOMERS_SET_KEY, count=500):
+        batch.append(user_id)
+        if len(batch) >= RETURN_BATCH:
+            count += await flush(batch)
+            batch = []
+    if batch:
+        count += await flush(batch)
+    return count
+
+
+async def backfill_customers_due(r: redis.Redis, force: bool = False) -> int:
+    """Первичное заполнение customers:due из customers:set (SSCAN, пачками)."""
+    if not force and await r.exists(CUSTOMERS_DUE_INDEXED_KEY):
+        return 0
+
+    async def flush(ids: list[str]) -> int:
+        pipe = r.pipeline(transaction=False)
+        for user_id in ids:
+            pipe.hgetall(f"{CUSTOMER_KEY_PREFIX}{user_id}")
+        profiles = await pipe.execute()
+        scores = {}
+        for user_id, profile in zip(ids, profiles):
+            due = _customer_due_ts(profile)
+            if due is not None:
+                scores[user_id] = due
+        if scores:
+            await r.zadd(CUSTOMERS_DUE_KEY, scores)
+        return len(scores)
+
+    count = await _for_each_customer_batch(r, flush)
+    await r.set(CUSTOMERS_DUE_INDEXED_KEY, str(int(time.time())))
+    return count
+
+
+async def backfill_favorite_drinks(r: redis.Redis, force: bool = False) -> int:
+    """Первичное заполнение favorite_drink/favorite_count в профилях из customer:drinks:*."""
+    if not force and await r.exists(CUSTOMERS_FAVORITES_INDEXED_KEY):
+        return 0
+
+    async def flush(ids: list[str]) -> int:
+        pipe = r.pipeline(transaction=False)
+        for user_id in ids:
+            pipe.hgetall(f"{CUSTOMER_DRINKS_PREFIX}{user_id}")
+        drinks_list = await pipe.execute()
+
+        pipe = r.pipeline(transaction=False)
+        indexed = 0
+        for user_id, drinks in zip(ids, drinks_list):
+            favorite = _favorite_drink_from_counts(drinks)
+            if not favorite:
+                continue
+            pipe.hset(
+                f"{CUSTOMER_KEY_PREFIX}{user_id}",
+                mapping={"favorite_drink": favorite, "favorite_count": int(drinks[favorite])},
+            )
+            indexed += 1
+        await pipe.execute()
+        return indexed
+
+    count = await _for_each_customer_batch(r, flush)
+    await r.set(CUSTOMERS_FAVORITES_INDEXED_KEY, str(int(time.time())))
+    return count
+
+
+def _forget_customers(pipe, user_ids: list[int]):
+    """Клиент недоступен (заблокировал бота): убираем из списка и всех индексов, кроме seg:drink:*."""
+    pipe.srem(CUSTOMERS_SET_KEY, *user_ids)
+    pipe.zrem(CUSTOMERS_DUE_KEY, *user_ids)
+    pipe.zrem(SEGMENT_SPEND_KEY, *user_ids)
+    pipe.zrem(SEGMENT_ORDERS_KEY, *user_ids)
+    pipe.zrem(SEGMENT_RECENCY_KEY, *user_ids)
+
+
+# ---------------- Audience segments ----------------
+@dataclass
+class AudienceSegment:
+    drinks: list[str] = field(default_factory=list)
+    match_all_drinks: bool = False  # True — брал все позиции, иначе хотя бы одну
+    min_orders: int = 0
+    min_spent: int = 0
+    inactive_days: Optional[int] = None  # не заказывал N+ дней
+    active_days: Optional[int] = None  # заказывал за последние N дней
+
+    def describe(self) -> str:
+        parts = []
+        if self.drinks:
+            parts.append((" и " if self.match_all_drinks else " или ").join(self.drinks))
+        if self.min_orders:
+            parts.append(f"заказов от {self.min_orders}")
+        if self.min_spent:
+            parts.append(f"потратили от {self.min_spent} ₽")
+        if self.inactive_days is not None:
+            parts.append(f"не заказывали {self.inactive_days}+ дн.")
+        if self.active_days is not None:
+            parts.append(f"заказывали за {self.active_days} дн.")
+        return ", ".join(parts) or "все клиенты"
+
+
+def _segment_drink_key(drink: str) -> str:
+    return f"{SEGMENT_DRINK_PREFIX}{drink}"
+
+
+async def build_segment(segment: AudienceSegment, dest: Optional[str] = None, ttl: int = SEGMENT_RESULT_TTL_SECONDS) -> Tuple[str, int]:
+    """
+    Собирает аудиторию в zset dest (score = last_order_ts) одной транзакцией:
+    SUNIONSTORE/SINTERSTORE по позициям, затем ZINTERSTORE с seg:orders / seg:spend /
+    seg:recency и отсечение по порогам через ZREMRANGEBYSCORE. Возвращает (dest, размер).
+    """
+    r = await get_redis_client()
+    dest = dest or f"{SEGMENT_RESULT_PREFIX}{uuid.uuid4().hex}"
+    now_ts = int(time.time())
 
-    for user_id in ids:
-        customer_key = f"{CUSTOMER_KEY_PREFIX}{user_id}"
-        try:
-            r = await get_redis_client()
-            profile = await r.hgetall(customer_key)
-            await r.aclose()
-        except Exception:
-            profile = {}
+    pipe = r.pipeline(transaction=True)
+    base: Optional[str] = None
+    if segment.drinks:
+        drink_keys = [_segment_drink_key(d) for d in segment.drinks]
+        if segment.match_all_drinks:
+            pipe.sinterstore(dest, drink_keys)
+        else:
+            pipe.sunionstore(dest, drink_keys)
+        base = dest
 
-        if not profile or str(profile.get("offers_opt_out", 0)) == "1":
+    for index_key, threshold in ((SEGMENT_ORDERS_KEY, segment.min_orders), (SEGMENT_SPEND_KEY, segment.min_spent)):
+        if threshold <= 0:
             continue
+        pipe.zinterstore(dest, {index_key: 1, base: 0} if base else {index_key: 1})
+        pipe.zremrangebyscore(dest, "-inf", f"({threshold}")
+        base = dest
+
+    # последним шагом — recency: он отсекает забытых клиентов и задаёт итоговый score
+    pipe.zinterstore(dest, {SEGMENT_RECENCY_KEY: 1, base: 0} if base else {SEGMENT_RECENCY_KEY: 1})
+    if segment.inactive_days is not None:
+        pipe.zremrangebyscore(dest, f"({now_ts - segment.inactive_days * 86400}", "+inf")
+    if segment.active_days is not None:
+        pipe.zremrangebyscore(dest, "-inf", f"({now_ts - segment.active_days * 86400}")
+    pipe.expire(dest, ttl)
+    pipe.zcard(dest)
+    results = await pipe.execute()
+    return dest, int(results[-1])
+
+
+def parse_segment_args(raw: str) -> AudienceSegment:
+    """
+    «Латте, Раф inactive=14 orders=3 spent=1000 active=30 all»:
+    ключ=значение — пороги, all — все позиции сразу, остальное — позиции через запятую.
+    """
+    segment = AudienceSegment()
+    rest = []
+    for token in (raw or "").split():
+        key, sep, value = token.partition("=")
+        key = key.lower()
+        if sep and key in {"inactive", "active", "orders", "spent"}:
+            n = int(value)
+            if key == "inactive":
+                segment.inactive_days = n
+            elif key == "active":
+                segment.active_days = n
+            elif key == "orders":
+                segment.min_orders = n
+            else:
+                segment.min_spent = n
+        elif not sep and key == "all":
+            segment.match_all_drinks = True
+        else:
+            rest.append(token)
+    segment.drinks = [d.strip() for d in " ".join(rest).split(",") if d.strip()]
+    return segment
+
+
+async def backfill_customer_segments(r: redis.Redis, force: bool = False) -> int:
+    """Первичное заполнение seg:* из профилей клиентов (SSCAN, пачками)."""
+    if not force and await r.exists(SEGMENTS_INDEXED_KEY):
+        return 0
+
+    async def flush(ids: list[str]) -> int:
+        pipe = r.pipeline(transaction=False)
+        for user_id in ids:
+            pipe.hgetall(f"{CUSTOMER_KEY_PREFIX}{user_id}")
+            pipe.hkeys(f"{CUSTOMER_DRINKS_PREFIX}{user_id}")
+        results = await pipe.execute()
+
+        pipe = r.pipeline(transaction=False)
+        indexed = 0
+        for i, user_id in enumerate(ids):
+            profile, drinks = results[2 * i], results[2 * i + 1]
+            if not profile:
+                continue
+            try:
+                spent = int(profile.get("total_spent") or 0)
+                orders = int(profile.get("total_orders") or 0)
+                last_order_ts = int(float(profile.get("last_order_ts") or 0))
+            except Exception:
+                continue
+            pipe.zadd(SEGMENT_SPEND_KEY, {user_id: spent})
+            pipe.zadd(SEGMENT_ORDERS_KEY, {user_id: orders})
+            pipe.zadd(SEGMENT_RECENCY_KEY, {user_id: last_order_ts})
+            for drink in drinks:
+                pipe.sadd(_segment_drink_key(drink), user_id)
+            indexed += 1
+        await pipe.execute()
+        return indexed
 
-        try:
-            last_order_ts = int(float(profile.get("last_order_ts", 0) or 0))
-        except Exception:
-            continue
+    count = await _for_each_customer_batch(r, flush)
+    await r.set(SEGMENTS_INDEXED_KEY, str(int(time.time())))
+    return count
 
-        days_since = (now_ts - last_order_ts) / 86400
-        if days_since < RETURN_CYCLE_DAYS:
-            continue
 
-        try:
-            last_trigger_ts = int(float(profile.get("last_trigger_ts", 0) or 0))
-        except Exception:
-            last_trigger_ts = 0
+async def smart_return_check_and_send(bot: Bot):
+    """
+    Берёт из customers:due только тех, у кого подошёл срок, пачками по RETURN_BATCH.
+    Каждый обработанный клиент либо переносится в будущее, либо удаляется из индекса.
+    """
+    if not _in_send_window_msk():
+        return
 
-        if last_trigger_ts and (now_ts - last_trigger_ts) < RETURN_COOLDOWN_DAYS * 86400:
-            continue
+    r = await get_redis_client()
+    if not await r.set(RETURN_LOCK_KEY, str(int(time.time())), nx=True, ex=RETURN_CHECK_EVERY_SECONDS - 60):
+        return
 
-        firstname = profile.get("firstname") or ""
-        favorite = await _get_favorite_drink(user_id) or profile.get("last_drink") or ""
-        promo = _promo_code_for_user(user_id)
-        text = (
-            f"{html.quote(str(firstname) or 'Друзья')},\n\n"
-            f"Скучаете по <b>{html.quote(str(favorite))}</b>? "
-            f"Дарим <b>{RETURN_DISCOUNT_PERCENT}% скидку</b> на него по промокоду:\n\n"
-            f"<code>{promo}</code>\n\n"
-            "Покажите этот код при заказе. Ждём вас!"
-        )
+    while _in_send_window_msk():
+        now_ts = int(time.time())
+        ids = await r.zrangebyscore(CUSTOMERS_DUE_KEY, "-inf", now_ts, start=0, num=RETURN_BATCH)
+        if not ids:
+            break
+
+        pipe = r.pipeline(transaction=False)
+        for user_id in ids:
+            pipe.hgetall(f"{CUSTOMER_KEY_PREFIX}{user_id}")
+        results = await pipe.execute()
+
+        messages: list[Tuple[int, str]] = []
+        profiles: Dict[int, Dict[str, str]] = {}
+        pipe = r.pipeline(transaction=False)
+        for user_id_raw, profile in zip(ids, results):
+            user_id = int(user_id_raw)
+
+            due = _customer_due_ts(profile)
+            if due is None:
+                pipe.zrem(CUSTOMERS_DUE_KEY, user_id)
+                continue
+            if due > now_ts:
+                pipe.zadd(CUSTOMERS_DUE_KEY, {user_id: due})
+                continue
 
-        try:
-            await bot.send_message(user_id, text)
-            try:
-                r = await get_redis_client()
-                await r.hset(customer_key, "last_trigger_ts", str(now_ts))
-                await r.aclose()
-            except Exception:
-                pass
-        except Exception:
-            try:
-                r = await get_redis_client()
-                await r.srem(CUSTOMERS_SET_KEY, user_id)
-                await r.aclose()
-            except Exception:
-                pass
+            firstname = profile.get("firstname") or ""
+            favorite = profile.get("favorite_drink") or profile.get("last_drink") or ""
+            promo = _promo_code_for_user(user_id)
+            text = (
+                f"{html.quote(str(firstname) or 'Друзья')},\n\n"
+                f"Скучаете по <b>{html.quote(str(favorite))}</b>? "
+                f"Дарим <b>{RETURN_DISCOUNT_PERCENT}% скидку</b> на него по промокоду:\n\n"
+                f"<code>{promo}</code>\n\n"
+                "Покажите этот код при заказе. Ждём вас!"
+            )
+            messages.append((user_id, text))
+            profiles[user_id] = profile
+
+        sent = await outbound.send_many(bot, messages)
+
+        for user_id, result in sent.items():
+            if result == SEND_OK:
+                profile = profiles[user_id]
+                profile["last_trigger_ts"] = str(now_ts)
+                pipe.hset(f"{CUSTOMER_KEY_PREFIX}{user_id}", "last_trigger_ts", str(now_ts))
+                pipe.zadd(CUSTOMERS_DUE_KEY, {user_id: _customer_due_ts(profile)})
+            elif result == SEND_BLOCKED:
+                _forget_customers(pipe, [user_id])
+            else:
+                pipe.zadd(CUSTOMERS_DUE_KEY, {user_id: now_ts + RETURN_RETRY_SECONDS})
+        await pipe.execute()
+
+        if len(ids) < RETURN_BATCH:
+            break
 
 
 async def smart_return_loop(bot: Bot):
@@ -2310,71 +4786,119 @@ async def smart_return_loop(bot: Bot):
 
 
 # ---------------- Subscriptions loop: remind & block ----------------
-async def subs_check_and_notify(bot: Bot):
-    now_ts = int(time.time())
-    try:
-        r = await get_redis_client()
-        keys = await r.keys("user:*")
-        await r.aclose()
-    except Exception:
-        keys = []
+# Сканер читает только окно cafes:active_subs (score = cafebotify_valid_until):
+# подписки, которые скоро истекают, и уже истёкшие. Стоимость O(k), а не O(всех кафе).
+SUB_EXPIRE_LUA = """
+local valid_until = tonumber(redis.call('HGET', KEYS[1], 'cafebotify_valid_until') or '') or 0
+if valid_until > tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'cafebotify_paid', '0')
+return 1
+"""
+
+
+async def _subs_window(r: redis.Redis, min_score, max_score):
+    offset = 0
+    while True:
+        batch = await r.zrangebyscore(
+            CAFES_ACTIVE_SUBS_KEY, min_score, max_score,
+            start=offset, num=SUBS_SCAN_BATCH, withscores=True,
+        )
+        if not batch:
+            return
+        yield batch
+        if len(batch) < SUBS_SCAN_BATCH:
+            return
+        offset += len(batch)
 
-    for key in keys:
-        try:
-            r = await get_redis_client()
-            data = await r.hgetall(key)
-            await r.aclose()
-        except Exception:
-            continue
 
+async def _subs_admin_ids(r: redis.Redis, cafe_ids: list[str]) -> Dict[str, Optional[int]]:
+    pipe = r.pipeline(transaction=False)
+    for cafe_id in cafe_ids:
+        pipe.hget(k_cafe_profile(cafe_id), "admin_id")
+    out: Dict[str, Optional[int]] = {}
+    for cafe_id, raw in zip(cafe_ids, await pipe.execute()):
         try:
-            paid_flag = int(data.get("cafebotify_paid", 0))
-            valid_until = int(data.get("cafebotify_valid_until", 0))
+            out[cafe_id] = int(raw) if raw and str(raw).strip() not in ("", "0") else None
         except Exception:
-            continue
+            out[cafe_id] = None
+    return out
 
-        if not valid_until:
-            continue
 
-        user_id_str = key.split("user:")[-1]
-        try:
-            user_id = int(user_id_str)
-        except Exception:
-            continue
+async def subs_check_and_notify(bot: Bot):
+    now_ts = int(time.time())
+    r = await get_redis_client()
+
+    # несколько реплик: сканирует только одна
+    if not await r.set(SUBS_SCAN_LOCK_KEY, str(now_ts), nx=True, ex=max(60, SUBS_CHECK_EVERY_SECONDS - 10)):
+        return
 
-        days_left = (valid_until - now_ts) / 86400
+    # напоминание
+    remind_from = now_ts + int((SUBS_REMIND_DAYS_BEFORE - 0.5) * 86400)
+    remind_to = now_ts + int((SUBS_REMIND_DAYS_BEFORE + 0.5) * 86400)
+    async for batch in _subs_window(r, remind_from, remind_to):
+        cafe_ids = [cafe_id for cafe_id, _ in batch]
+        admins = await _subs_admin_ids(r, cafe_ids)
+
+        pipe = r.pipeline(transaction=False)
+        for cafe_id in cafe_ids:
+            pipe.hget(k_admin_subscription(cafe_id), "reminded_until")
+        reminded = dict(zip(cafe_ids, await pipe.execute()))
+
+        for cafe_id, score in batch:
+            valid_until = int(score)
+            admin_id = admins.get(cafe_id)
+            if not admin_id or reminded.get(cafe_id) == str(valid_until):
+                continue
 
-        # напоминание
-        if SUBS_REMIND_DAYS_BEFORE - 0.5 <= days_left <= SUBS_REMIND_DAYS_BEFORE + 0.5:
-            pay_url = f"{PAY_LANDING_URL}?tg_id={user_id}&plan=month"
+            days_left = (valid_until - now_ts) / 86400
+            pay_url = f"{PAY_LANDING_MONTH}?tg_id={admin_id}&cafe_id={cafe_id}"
             try:
                 await bot.send_message(
-                    user_id,
+                    admin_id,
                     "⏰ <b>Скоро заканчивается доступ к CafebotifySTART</b>\n\n"
+                    f"Кафе: <code>{html.quote(cafe_id)}</code>\n"
                     f"Осталось примерно {int(days_left)} дней.\n"
                     f"Продлите по ссылке:\n<a href=\"{html.quote(pay_url)}\">Оплатить ещё месяц</a>",
                     disable_web_page_preview=True,
                 )
             except Exception:
                 pass
+            await r.hset(k_admin_subscription(cafe_id), "reminded_until", str(valid_until))
 
-        # блокировка (можно добавить флаг в Redis и проверять его в боте)
-        if days_left < 0 and paid_flag == 1:
-            try:
-                r = await get_redis_client()
-                await r.hset(key, mapping={"cafebotify_paid": "0"})
-                await r.aclose()
-            except Exception:
-                pass
+    # блокировка истёкших; index_cafe убирает кафе из zset, поэтому окно каждый раз с начала
+    while True:
+        batch = await r.zrangebyscore(
+            CAFES_ACTIVE_SUBS_KEY, "-inf", now_ts, start=0, num=SUBS_SCAN_BATCH, withscores=True,
+        )
+        if not batch:
+            break
+
+        cafe_ids = [cafe_id for cafe_id, _ in batch]
+        admins = await _subs_admin_ids(r, cafe_ids)
+
+        for cafe_id in cafe_ids:
+            expired = await redis_script(SUB_EXPIRE_LUA)(
+                keys=[k_admin_subscription(cafe_id)], args=[now_ts],
+            )
+            await index_cafe(r, cafe_id)
+            admin_id = admins.get(cafe_id)
+            if not int(expired) or not admin_id:
+                continue
             try:
                 await bot.send_message(
-                    user_id,
+                    admin_id,
                     "🔒 Срок действия CafebotifySTART закончился.\n\n"
+                    f"Кафе: <code>{html.quote(cafe_id)}</code>\n"
                     "Оплатите продление, чтобы снова пользоваться ботом.",
                 )
             except Exception:
                 pass
 
+        if len(batch) < SUBS_SCAN_BATCH:
+            break
+
 
 async def subs_loop(bot: Bot):
     while True:
@@ -2385,6 +4909,228 @@ async def subs_loop(bot: Bot):
         await asyncio.sleep(SUBS_CHECK_EVERY_SECONDS)
 
 
+# ---------------- Broadcasts ----------------
+BROADCAST_STATUS_TITLES = {
+    "queued": "⏳ в очереди",
+    "running": "🚀 идёт",
+    "done": "✅ завершена",
+    "cancelled": "⛔ остановлена",
+}
+
+
+@dataclass
+class BroadcastProgress:
+    job_id: str
+    status: str
+    total: int
+    sent: int
+    failed: int
+    blocked: int
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.total - self.sent - self.failed - self.blocked)
+
+
+def _broadcast_job_key(job_id: str) -> str:
+    return f"{BROADCAST_JOB_PREFIX}{job_id}"
+
+
+def _broadcast_done_key(job_id: str) -> str:
+    # кому уже отправляли: SSCAN может вернуть элемент повторно, а после рестарта повторяется последняя пачка
+    return f"{BROADCAST_JOB_PREFIX}{job_id}:done"
+
+
+def _broadcast_progress(job_id: str, job: Dict[str, str]) -> BroadcastProgress:
+    return BroadcastProgress(
+        job_id=job_id,
+        status=job.get("status") or "queued",
+        total=int(job.get("total") or 0),
+        sent=int(job.get("sent") or 0),
+        failed=int(job.get("failed") or 0),
+        blocked=int(job.get("blocked") or 0),
+    )
+
+
+def broadcast_progress_text(progress: BroadcastProgress) -> str:
+    return (
+        f"📣 <b>Рассылка #{progress.job_id}</b>: {BROADCAST_STATUS_TITLES.get(progress.status, progress.status)}\n\n"
+        f"Отправлено: <b>{progress.sent}</b>\n"
+        f"Не доставлено: <b>{progress.failed + progress.blocked}</b>\n"
+        f"Осталось: <b>{progress.remaining}</b>"
+    )
+
+
+async def create_broadcast_job(text: str, owner_chat_id: int, segment: Optional[AudienceSegment] = None) -> str:
+    r = await get_redis_client()
+    job_id = str(await r.incr(BROADCAST_SEQ_KEY))
+    audience = ""
+    if segment is not None:
+        audience, total = await build_segment(segment, dest=f"{_broadcast_job_key(job_id)}:audience", ttl=BROADCAST_KEEP_SECONDS)
+    else:
+        total = await r.scard(CUSTOMERS_SET_KEY)
+
+    pipe = r.pipeline(transaction=True)
+    pipe.hset(
+        _broadcast_job_key(job_id),
+        mapping={
+            "text": text,
+            "status": "queued",
+            "cursor": "0",
+            "audience": audience,
+            "total": total,
+            "sent": 0,
+            "failed": 0,
+            "blocked": 0,
+            "owner_chat_id": owner_chat_id,
+            "created_ts": int(time.time()),
+        },
+    )
+    pipe.rpush(BROADCAST_QUEUE_KEY, job_id)
+    await pipe.execute()
+    logger.info(f"broadcast job {job_id} queued, audience={total}")
+    return job_id
+
+
+async def get_broadcast_progress(job_id: str) -> Optional[BroadcastProgress]:
+    r = await get_redis_client()
+    job = await r.hgetall(_broadcast_job_key(job_id))
+    return _broadcast_progress(job_id, job) if job else None
+
+
+async def get_active_broadcast() -> Optional[BroadcastProgress]:
+    r = await get_redis_client()
+    job_id = await r.lindex(BROADCAST_QUEUE_KEY, 0)
+    return await get_broadcast_progress(job_id) if job_id else None
+
+
+async def cancel_broadcast(job_id: str):
+    r = await get_redis_client()
+    pipe = r.pipeline(transaction=True)
+    pipe.hset(_broadcast_job_key(job_id), "status", "cancelled")
+    pipe.lrem(BROADCAST_QUEUE_KEY, 0, job_id)
+    pipe.expire(_broadcast_job_key(job_id), BROADCAST_KEEP_SECONDS)
+    pipe.expire(_broadcast_done_key(job_id), BROADCAST_KEEP_SECONDS)
+    pipe.delete(f"{_broadcast_job_key(job_id)}:audience")
+    await pipe.execute()
+
+
+async def _broadcast_report(bot: Bot, job_id: str, job: Dict[str, str], progress: BroadcastProgress):
+    chat_id, message_id = job.get("owner_chat_id"), job.get("progress_message_id")
+    if not chat_id or not message_id:
+        return
+    try:
+        await bot.edit_message_text(broadcast_progress_text(progress), chat_id=int(chat_id), message_id=int(message_id))
+    except Exception as e:
+        logger.warning(f"broadcast {job_id} progress edit failed: {e}")
+
+
+async def _broadcast_run_chunk(bot: Bot, r: redis.Redis, job_id: str, job: Dict[str, str]) -> bool:
+    """Одна пачка из SSCAN. Курсор и счётчики сохраняются вместе, поэтому после рестарта продолжаем с места."""
+    job_key, done_key = _broadcast_job_key(job_id), _broadcast_done_key(job_id)
+    audience = job.get("audience")
+    if audience:
+        cursor, scored = await r.zscan(audience, cursor=int(job.get("cursor") or 0), count=BROADCAST_CHUNK)
+        ids = [user_id for user_id, _ in scored]
+    else:
+        cursor, ids = await r.sscan(CUSTOMERS_SET_KEY, cursor=int(job.get("cursor") or 0), count=BROADCAST_CHUNK)
+
+    results: Dict[int, str] = {}
+    if ids:
+        already = await r.smismember(done_key, ids)
+        pending = [int(user_id) for user_id, done in zip(ids, already) if not done]
+        results = await outbound.send_many(bot, [(user_id, job["text"]) for user_id in pending])
+
+    sent = sum(1 for res in results.values() if res == SEND_OK)
+    blocked = [user_id for user_id, res in results.items() if res == SEND_BLOCKED]
+    failed = len(results) - sent - len(blocked)
+
+    finished = cursor == 0
+    pipe = r.pipeline(transaction=True)
+    if results:
+        pipe.sadd(done_key, *results.keys())
+        pipe.hincrby(job_key, "sent", sent)
+        pipe.hincrby(job_key, "failed", failed)
+        pipe.hincrby(job_key, "blocked", len(blocked))
+    if blocked:
+        _forget_customers(pipe, blocked)
+    pipe.hset(job_key, "cursor", cursor)
+    if finished:
+        pipe.hset(job_key, mapping={"status": "done", "finished_ts": int(time.time())})
+        pipe.lrem(BROADCAST_QUEUE_KEY, 0, job_id)
+        pipe.expire(job_key, BROADCAST_KEEP_SECONDS)
+        pipe.expire(done_key, BROADCAST_KEEP_SECONDS)
+        if audience:
+            pipe.delete(audience)
+    await pipe.execute()
+    return finished
+
+
+# Лок воркера хранит случайный токен владельца: продлить и снять его может только тот,
+# кто взял. Иначе после истечения TTL старый воркер снял бы чужой лок.
+LOCK_EXTEND_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+LOCK_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+async def broadcast_process_queue(bot: Bot):
+    """Разбирает очередь рассылок по одной, пачками по BROADCAST_CHUNK, с отчётом владельцу после каждой пачки."""
+    r = await get_redis_client()
+    if not await r.llen(BROADCAST_QUEUE_KEY):
+        return
+    token = uuid.uuid4().hex
+    if not await r.set(BROADCAST_LOCK_KEY, token, nx=True, ex=BROADCAST_LOCK_TTL_SECONDS):
+        return
+
+    try:
+        while True:
+            job_id = await r.lindex(BROADCAST_QUEUE_KEY, 0)
+            if not job_id:
+                return
+
+            job = await r.hgetall(_broadcast_job_key(job_id))
+            if not job or job.get("status") in ("done", "cancelled"):
+                await r.lrem(BROADCAST_QUEUE_KEY, 0, job_id)
+                continue
+            if job.get("status") == "queued":
+                await r.hset(_broadcast_job_key(job_id), mapping={"status": "running", "started_ts": int(time.time())})
+
+            await _broadcast_run_chunk(bot, r, job_id, job)
+            extended = await redis_script(LOCK_EXTEND_LUA)(
+                keys=[BROADCAST_LOCK_KEY], args=[token, BROADCAST_LOCK_TTL_SECONDS * 1000],
+            )
+            if not int(extended):
+                logger.warning(f"broadcast lock lost while running job {job_id}, stopping")
+                return
+
+            job = await r.hgetall(_broadcast_job_key(job_id))
+            progress = _broadcast_progress(job_id, job)
+            await _broadcast_report(bot, job_id, job, progress)
+            if progress.status == "done":
+                logger.info(f"broadcast job {job_id} done: sent={progress.sent} failed={progress.failed} blocked={progress.blocked}")
+    finally:
+        await redis_script(LOCK_RELEASE_LUA)(keys=[BROADCAST_LOCK_KEY], args=[token])
+
+
+async def broadcast_loop(bot: Bot):
+    while True:
+        try:
+            await broadcast_process_queue(bot)
+        except Exception as e:
+            logger.error(f"broadcast_loop: {e}")
+        await asyncio.sleep(BROADCAST_POLL_SECONDS)
+
+
 # ---------------- ЮKassa HTTP ----------------
 async def create_payment(amount: str, description: str, metadata: dict) -> str:
     if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
@@ -2528,13 +5274,10 @@ async def yookassa_webhook(request: web.Request):
         sub_key = k_admin_subscription(cafe_id)
         try:
             r = await get_redis_client()
-            try:
-                raw_until = await r.hget(sub_key, "cafebotify_valid_until")
-                current_until = int(raw_until) if raw_until else 0
-                if current_until > now_ts:
-                    base_ts = current_until
-            finally:
-                await r.aclose()
+            raw_until = await r.hget(sub_key, "cafebotify_valid_until")
+            current_until = int(raw_until) if raw_until else 0
+            if current_until > now_ts:
+                base_ts = current_until
         except Exception:
             logger.exception(
                 f"yookassa_webhook read current cafe subscription failed "
@@ -2547,23 +5290,21 @@ async def yookassa_webhook(request: web.Request):
     if cafe_id:
         try:
             r = await get_redis_client()
-            try:
-                eff_admin = await get_effective_admin_id(r, cafe_id)
-                await r.hset(
-                    k_admin_subscription(cafe_id),
-                    mapping={
-                        "cafebotify_valid_until": str(valid_until),
-                        "cafebotify_paid": "1",
-                        "admin_id": str(eff_admin or 0),
-                        "last_payment_id": str(payment_id or ""),
-                        "last_product": str(product),
-                        "last_amount_value": str(amount_value or ""),
-                        "last_amount_currency": str(amount_currency or ""),
-                        "last_paid_at": str(now_ts),
-                    },
-                )
-            finally:
-                await r.aclose()
+            eff_admin = await get_effective_admin_id(r, cafe_id)
+            await r.hset(
+                k_admin_subscription(cafe_id),
+                mapping={
+                    "cafebotify_valid_until": str(valid_until),
+                    "cafebotify_paid": "1",
+                    "admin_id": str(eff_admin or 0),
+                    "last_payment_id": str(payment_id or ""),
+                    "last_product": str(product),
+                    "last_amount_value": str(amount_value or ""),
+                    "last_amount_currency": str(amount_currency or ""),
+                    "last_paid_at": str(now_ts),
+                },
+            )
+            await index_cafe(r, cafe_id)
         except Exception:
             logger.exception(
                 f"yookassa_webhook failed to update cafe subscription "
@@ -2587,7 +5328,6 @@ async def yookassa_webhook(request: web.Request):
     try:
         r = await get_redis_client()
         await r.setex(_pay_draft_key(draft_id), 7 * 86400, json.dumps(payload, ensure_ascii=False))
-        await r.aclose()
     except Exception as e:
         logger.error(f"yookassa_webhook draft redis error: {e}")
         return web.json_response({"status": "redis_error"})
@@ -2767,6 +5507,8 @@ async def set_profile_cmd(message: Message):
         except Exception:
             pass
 
+    invalidate_render_cache()
+
     # сохранить профиль в CONFIG_PATH (/data/config.json), чтобы переживало рестарт
     try:
         with open(CONFIG_PATH, "r", encoding="utf-8") as f:
@@ -2796,6 +5538,20 @@ async def set_profile_cmd(message: Message):
         )
 
 
+@router.message(Command("reindex_cafes"))
+async def reindex_cafes_cmd(message: Message):
+    if message.from_user.id != SUPERADMIN_ID:
+        return
+
+    try:
+        count = await rebuild_cafe_indexes(await get_redis_client(), force=True)
+    except Exception as e:
+        await message.answer(f"Redis error: {e}")
+        return
+
+    await message.answer(f"✅ Индексы кафе перестроены: {count}")
+
+
 @router.message(Command("checkpaid"))
 async def check_paid_cmd(message: Message):
     if message.from_user.id != SUPERADMIN_ID:
@@ -2805,7 +5561,6 @@ async def check_paid_cmd(message: Message):
         r = await get_redis_client()
         key = f"user:{message.from_user.id}"
         data = await r.hgetall(key)
-        await r.aclose()
     except Exception as e:
         await message.answer(f"Redis error: {e}")
         return
@@ -2831,19 +5586,25 @@ async def set_paid_cmd(message: Message):
     parts = (message.text or "").split()
     if len(parts) < 3:
         await message.answer(
-            "Формат: /set_paid <tg_id> <YYYY-MM-DD> [month|year]\n"
-            "Пример: /set_paid 1471275603 2026-05-01 month"
+            "Формат: /set_paid <tg_id|cafe_id> <YYYY-MM-DD> [month|year]\n"
+            "Пример: /set_paid 1471275603 2026-05-01 month\n"
+            "Пример: /set_paid cafe_023 2026-05-01 year"
         )
         return
 
     tg_id_str, date_str = parts[1], parts[2]
     plan = parts[3] if len(parts) >= 4 else "month"
 
-    try:
-        tg_id_int = int(tg_id_str)
-    except Exception:
-        await message.answer("tg_id должен быть числом.")
-        return
+    cafe_id: Optional[str] = None
+    tg_id_int: Optional[int] = None
+    if tg_id_str.lower().startswith("cafe_"):
+        cafe_id = tg_id_str.lower()
+    else:
+        try:
+            tg_id_int = int(tg_id_str)
+        except Exception:
+            await message.answer("tg_id должен быть числом (или код кафе cafe_XXX).")
+            return
 
     try:
         dt = datetime.strptime(date_str, "%Y-%m-%d").replace(tzinfo=MSK_TZ)
@@ -2863,73 +5624,92 @@ async def set_paid_cmd(message: Message):
 
     try:
         r = await get_redis_client()
-        await r.hset(
-            f"user:{tg_id_int}",
-            mapping={
-                "cafebotify_paid": "1",
-                "cafebotify_paid_at": str(int(time.time())),
-                "cafebotify_valid_until": str(valid_until),
-                "cafebotify_product": product,
-            },
-        )
-        await r.aclose()
+        if tg_id_int is not None:
+            await r.hset(
+                f"user:{tg_id_int}",
+                mapping={
+                    "cafebotify_paid": "1",
+                    "cafebotify_paid_at": str(int(time.time())),
+                    "cafebotify_valid_until": str(valid_until),
+                    "cafebotify_product": product,
+                },
+            )
+            cafe_id = await get_cafe_id_by_admin(r, tg_id_int)
+
+        # подписка кафе + индекс cafes:active_subs для сканера подписок
+        if cafe_id:
+            await r.hset(
+                k_admin_subscription(cafe_id),
+                mapping={
+                    "cafebotify_paid": "1",
+                    "cafebotify_valid_until": str(valid_until),
+                    "last_product": product,
+                    "last_paid_at": str(int(time.time())),
+                },
+            )
+            await index_cafe(r, cafe_id)
     except Exception as e:
         await message.answer(f"Redis error: {e}")
         return
 
+    target = html.quote(str(tg_id_int if tg_id_int is not None else cafe_id))
+    cafe_note = f" (кафе <code>{html.quote(cafe_id)}</code>)" if cafe_id and tg_id_int is not None else ""
     await message.answer(
-        f"✅ Подписка для <code>{tg_id_int}</code> выставлена до {date_str} ({plan})."
+        f"✅ Подписка для <code>{target}</code>{cafe_note} выставлена до {date_str} ({plan})."
     )
 
 
 # ---------------- Fallback drink pick ----------------
+# кнопки, у которых есть свои хендлеры: fallback их молча пропускает
+FALLBACK_KNOWN_BUTTONS = frozenset({
+    BTN_CLIENT_MENU,
+    BTN_OWNER_MENU,
+    BTN_TO_START,
+    BTN_ABOUT_ASSISTANT,
+    BTN_PAY_MONTH,
+    BTN_PAY_YEAR,
+    BTN_CART,
+    BTN_CHECKOUT,
+    BTN_BOOKING,
+    BTN_CALL,
+    BTN_HOURS,
+    BTN_STATS,
+    BTN_MENU_EDIT,
+    BTN_STAFF_GROUP,
+    BTN_LINKS,
+    BTN_RENEW_SUB,
+    BTN_SUBSCRIPTION,
+    BTN_ADS,
+    BTN_BROADCAST,
+    BTN_ADMIN_HELP,
+    BTN_SUPPORT,
+    BTN_CONFIRM,
+    BTN_CANCEL,
+    BTN_CANCEL_ORDER,
+    BTN_READY_NOW,
+    BTN_READY_20,
+    BTN_EDIT_CART,
+    BTN_CLEAR_CART,
+    BTN_BACK,
+    BTN_TO_CLIENT_MODE,
+    CART_ACT_PLUS,
+    CART_ACT_MINUS,
+    CART_ACT_DEL,
+    CART_ACT_DONE,
+    MENU_EDIT_ADD,
+    MENU_EDIT_EDIT,
+    MENU_EDIT_DEL,
+    BTN_REPEAT_LAST,
+    BTN_REPEAT_NO,
+})
+
+
 @router.message(F.text)
 async def any_text_message(message: Message, state: FSMContext):
     text = (message.text or "").strip()
 
-    known_buttons = {
-        BTN_CLIENT_MENU,
-        BTN_OWNER_MENU,
-        BTN_TO_START,
-        BTN_ABOUT_ASSISTANT,
-        BTN_PAY_MONTH,
-        BTN_PAY_YEAR,
-        BTN_CART,
-        BTN_CHECKOUT,
-        BTN_BOOKING,
-        BTN_CALL,
-        BTN_HOURS,
-        BTN_STATS,
-        BTN_MENU_EDIT,
-        BTN_STAFF_GROUP,
-        BTN_LINKS,
-        BTN_RENEW_SUB,
-        BTN_SUBSCRIPTION,
-        BTN_ADS,
-        BTN_BROADCAST,
-        BTN_ADMIN_HELP,
-        BTN_SUPPORT,
-        BTN_CONFIRM,
-        BTN_CANCEL,
-        BTN_CANCEL_ORDER,
-        BTN_READY_NOW,
-        BTN_READY_20,
-        BTN_EDIT_CART,
-        BTN_CLEAR_CART,
-        BTN_BACK,
-        BTN_TO_CLIENT_MODE,
-        CART_ACT_PLUS,
-        CART_ACT_MINUS,
-        CART_ACT_DEL,
-        CART_ACT_DONE,
-        MENU_EDIT_ADD,
-        MENU_EDIT_EDIT,
-        MENU_EDIT_DEL,
-        BTN_REPEAT_LAST,
-        BTN_REPEAT_NO,
-    }
 
-    if text in known_buttons:
+    if text in FALLBACK_KNOWN_BUTTONS:
         return
 
     if text in MENU:
@@ -2961,20 +5741,79 @@ async def any_text_message(message: Message, state: FSMContext):
 # ---------------- Startup / webhook ----------------
 smart_task: Optional[asyncio.Task] = None
 subs_task: Optional[asyncio.Task] = None
+menu_task: Optional[asyncio.Task] = None
+broadcast_task: Optional[asyncio.Task] = None
+order_tasks: list[asyncio.Task] = []
+outbox_task: Optional[asyncio.Task] = None
 
 
 async def on_startup_bot(bot: Bot):
-    global smart_task, subs_task
+    global smart_task, subs_task, menu_task, broadcast_task, order_tasks, outbox_task
+    loop_monitor.start()
+    try:
+        if await seed_menu_if_missing():
+            logger.info("seed_menu_if_missing: menu seeded from config")
+    except Exception as e:
+        logger.error(f"seed_menu_if_missing: {e}")
     await sync_menu_from_redis()
-    
+
+    try:
+        await migrate_drink_stats_to_hash()
+    except Exception as e:
+        logger.error(f"migrate_drink_stats_to_hash: {e}")
+
+    try:
+        indexed = await rebuild_cafe_indexes(await get_redis_client())
+        if indexed:
+            logger.info(f"rebuild_cafe_indexes: indexed {indexed} cafes")
+    except Exception as e:
+        logger.error(f"rebuild_cafe_indexes: {e}")
+
+    try:
+        indexed = await backfill_customers_due(await get_redis_client())
+        if indexed:
+            logger.info(f"backfill_customers_due: indexed {indexed} customers")
+    except Exception as e:
+        logger.error(f"backfill_customers_due: {e}")
+
+    try:
+        indexed = await backfill_favorite_drinks(await get_redis_client())
+        if indexed:
+            logger.info(f"backfill_favorite_drinks: indexed {indexed} customers")
+    except Exception as e:
+        logger.error(f"backfill_favorite_drinks: {e}")
+
+    try:
+        indexed = await backfill_customer_segments(await get_redis_client())
+        if indexed:
+            logger.info(f"backfill_customer_segments: indexed {indexed} customers")
+    except Exception as e:
+        logger.error(f"backfill_customer_segments: {e}")
+
+    if menu_task is None or menu_task.done():
+        menu_task = asyncio.create_task(menu_invalidation_loop())
+
     if smart_task is None or smart_task.done():
         smart_task = asyncio.create_task(smart_return_loop(bot))
         
-    # Временно отключено: старый subs_loop читает user:* и старые поля
-    # cafebotify_paid / cafebotify_valid_until, что конфликтует с новой
-    # моделью подписок по cafe:* / admin_subscription.
-    # if subs_task is None or subs_task.done():
-    #     subs_task = asyncio.create_task(subs_loop(bot))
+    if subs_task is None or subs_task.done():
+        subs_task = asyncio.create_task(subs_loop(bot))
+
+    if broadcast_task is None or broadcast_task.done():
+        broadcast_task = asyncio.create_task(broadcast_loop(bot))
+
+    if outbox_task is None or outbox_task.done():
+        outbox_task = asyncio.create_task(outbox_loop(bot))
+
+    try:
+        await ensure_order_groups(await get_redis_client())
+    except Exception as e:
+        logger.error(f"ensure_order_groups: {e}")
+
+    if not order_tasks or any(t.done() for t in order_tasks):
+        for task in order_tasks:
+            task.cancel()
+        order_tasks = [asyncio.create_task(order_consumer_loop(bot, group)) for group in ORDER_CONSUMERS]
 
     try:
         await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
@@ -2982,6 +5821,579 @@ async def on_startup_bot(bot: Bot):
         logger.error(f"Webhook set error: {e}")
 
 
+# ---------------- Request logging ----------------
+class UpdateLogMiddleware(BaseMiddleware):
+    """Выборочный дамп апдейтов вместо полного model_dump_json на каждый апдейт."""
+
+    async def __call__(self, handler, event: Update, data: Dict[str, Any]) -> Any:
+        if log_sampled(LOG_UPDATES_SAMPLE_RATE):
+            logger.info(
+                "update sample",
+                extra={"fields": {
+                    "update_id": event.update_id,
+                    "type": event.event_type,
+                    "payload": LazyPayload(lambda: event.model_dump(mode="json", exclude_none=True, by_alias=True)),
+                }},
+            )
+        return await handler(event, data)
+
+
+def _log_path(path: str) -> str:
+    # секрет вебхука — часть пути, в логи он попадать не должен
+    return path.replace(WEBHOOK_SECRET, "***") if WEBHOOK_SECRET else path
+
+
+@web.middleware
+async def http_log_middleware(request: web.Request, handler):
+    """
+    Метод, путь, статус и время — выборочно, 5xx — всегда; трейсбек пишет сам aiohttp.
+    Заменяет access log aiohttp (там путь с секретом вебхука). Тело запроса не читается.
+    """
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        if status >= 500 or log_sampled(LOG_HTTP_SAMPLE_RATE):
+            logger.info(
+                "http",
+                extra={"fields": {
+                    "method": request.method,
+                    "path": _log_path(request.path),
+                    "status": status,
+                    "ms": round((time.perf_counter() - started) * 1000, 1),
+                    "bytes_in": request.content_length or 0,
+                }},
+            )
+
+
+# ---------------- Update executor ----------------
+# Вместо задачи на каждый апдейт (handle_in_background) — фиксированное число шардов:
+# у каждого своя ограниченная очередь и UPDATE_SHARD_WORKERS воркеров. Апдейты одного
+# чата всегда попадают в один шард и обрабатываются строго по очереди: пока чат занят,
+# его следующие апдейты откладываются в backlog чата и их дорабатывает тот же воркер.
+# Поэтому два быстрых нажатия не затирают друг другу корзину в FSM, а медленный хендлер
+# (ретрай Bot API, долгий вызов Redis) держит только свой чат, а не весь шард.
+# Общий лимит параллельной обработки — шарды × воркеры. Переполненный шард отвечает
+# Telegram 503 — апдейт не теряется, Telegram пришлёт его повторно.
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 16))
+UPDATE_SHARD_WORKERS = int(os.getenv("UPDATE_SHARD_WORKERS", 4))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 100))  # на шард
+
+_UPDATE_CHAT_FIELDS = (
+    "message",
+    "edited_message",
+    "channel_post",
+    "edited_channel_post",
+    "business_message",
+    "edited_business_message",
+)
+_UPDATE_USER_FIELDS = (
+    "callback_query",
+    "inline_query",
+    "chosen_inline_result",
+    "shipping_query",
+    "pre_checkout_query",
+    "my_chat_member",
+    "chat_member",
+    "chat_join_request",
+)
+
+
+def update_shard_key(update: Dict[str, Any]) -> int:
+    """chat_id (или id пользователя) из сырого апдейта; для прочих типов — update_id."""
+    for name in _UPDATE_CHAT_FIELDS:
+        chat = (update.get(name) or {}).get("chat")
+        if chat:
+            return int(chat["id"])
+    for name in _UPDATE_USER_FIELDS:
+        event = update.get(name)
+        if not event:
+            continue
+        chat = (event.get("message") or {}).get("chat") or event.get("chat")
+        if chat:
+            return int(chat["id"])
+        user = event.get("from")
+        if user:
+            return int(user["id"])
+    return int(update.get("update_id") or 0)
+
+
+class UpdateExecutor:
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        workers: int,
+        queue_size: int,
+        shard_workers: int = UPDATE_SHARD_WORKERS,
+        **data: Any,
+    ):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.data = data
+        self.shard_workers = max(1, shard_workers)
+        self._queues = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._workers: list[asyncio.Task] = []
+        # чаты в обработке -> их отложенные апдейты (по порядку поступления)
+        self._chat_backlog: Dict[int, deque] = {}
+        self.processed = 0
+        self.rejected = 0
+        self.errors = 0
+
+    def start(self):
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._worker(q)) for q in self._queues for _ in range(self.shard_workers)
+            ]
+
+    async def stop(self, timeout: float = 10.0):
+        """Даём шардам дообработать очередь, затем останавливаем воркеры."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"update executor: {self.queued()} updates left unprocessed on shutdown")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, update: Dict[str, Any]) -> bool:
+        key = update_shard_key(update)
+        queue = self._queues[key % len(self._queues)]
+        # отложенные апдейты чата уже вышли из очереди шарда — их лимит тот же
+        if len(self._chat_backlog.get(key, ())) >= queue.maxsize > 0:
+            self.rejected += 1
+            return False
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        return True
+
+    def queued(self) -> int:
+        return sum(q.qsize() for q in self._queues) + sum(len(b) for b in self._chat_backlog.values())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": len(self._queues),
+            "shard_workers": self.shard_workers,
+            "queued": self.queued(),
+            "max_shard_queue": max(q.qsize() for q in self._queues),
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "errors": self.errors,
+        }
+
+    async def _process(self, update: Dict[str, Any]):
+        try:
+            result = await self.dispatcher.feed_raw_update(bot=self.bot, update=update, **self.data)
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(bot=self.bot, result=result)
+            self.processed += 1
+        except Exception as e:
+            self.errors += 1
+            logger.exception(f"update executor: update_id={update.get('update_id')} failed: {e}")
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            update = await queue.get()
+            key = update_shard_key(update)
+            backlog = self._chat_backlog.get(key)
+            if backlog is not None:
+                # чат занят другим воркером: он и обработает апдейт следом, по порядку
+                backlog.append(update)
+                continue
+            backlog = self._chat_backlog[key] = deque()
+            try:
+                while True:
+                    try:
+                        await self._process(update)
+                    finally:
+                        queue.task_done()
+                    if not backlog:
+                        break
+                    update = backlog.popleft()
+            finally:
+                del self._chat_backlog[key]
+
+
+update_executor: Optional[UpdateExecutor] = None
+
+
+@metrics.collector
+def _update_executor_metrics():
+    if update_executor is None:
+        return []
+    stats = update_executor.stats()
+    return [
+        ("bot_executor_queued", "gauge", "Апдейты в очередях шардов", {(): stats["queued"]}, ()),
+        ("bot_executor_max_shard_queue", "gauge", "Самая длинная очередь шарда", {(): stats["max_shard_queue"]}, ()),
+        ("bot_executor_updates_total", "counter", "Апдейты по итогу обработки",
+         {("processed",): stats["processed"], ("rejected",): stats["rejected"], ("error",): stats["errors"]}, ("result",)),
+    ]
+
+
+class ExecutorRequestHandler(BaseRequestHandler):
+    """
+    Webhook-хендлер на публичном интерфейсе BaseRequestHandler (handle / resolve_bot /
+    verify_secret / close): апдейт кладётся в UpdateExecutor, ответ Telegram — сразу.
+    """
+
+    def __init__(
+        self,
+        executor: UpdateExecutor,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        secret_token: Optional[str] = None,
+        **data: Any,
+    ):
+        super().__init__(dispatcher=dispatcher, handle_in_background=True, **data)
+        self.executor = executor
+        self.bot = bot
+        self.secret_token = secret_token
+
+    def register(self, app: web.Application, /, path: str, **kwargs: Any) -> None:
+        app.on_startup.append(self._handle_start)
+        super().register(app, path=path, **kwargs)
+
+    async def _handle_start(self, *a: Any, **kw: Any) -> None:
+        self.executor.start()
+
+    def verify_secret(self, telegram_secret_token: str, bot: Bot) -> bool:
+        if self.secret_token:
+            return hmac.compare_digest(telegram_secret_token, self.secret_token)
+        return True
+
+    async def resolve_bot(self, request: web.Request) -> Bot:
+        return self.bot
+
+    async def close(self) -> None:
+        await self.executor.stop()
+        await self.bot.session.close()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+        update = await request.json(loads=bot.session.json_loads)
+        if not self.executor.submit(update):
+            logger.warning(f"update executor: shard full, update_id={update.get('update_id')} deferred to Telegram retry")
+            return web.Response(status=503)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    __call__ = handle
+
+
+# ---------------- Health ----------------
+# /healthcheck — liveness: процесс жив и loop отвечает, зависимости не трогаем
+# (иначе платформа начнёт перезапускать контейнер из-за чужой аварии).
+# /ready — readiness: Redis RTT, лаг loop, очередь executor и доступность Bot API
+# сверяются с порогами; при деградации — 503, балансировщик снимает трафик.
+# Результат кэшируется, одновременные запросы ждут одну и ту же проверку.
+READY_CACHE_SECONDS = float(os.getenv("READY_CACHE_SECONDS", 2))
+READY_REDIS_MAX_MS = float(os.getenv("READY_REDIS_MAX_MS", 250))
+READY_LOOP_LAG_MAX_MS = float(os.getenv("READY_LOOP_LAG_MAX_MS", 500))
+READY_SHARD_QUEUE_MAX = int(os.getenv("READY_SHARD_QUEUE_MAX", max(1, UPDATE_QUEUE_SIZE * 8 // 10)))
+READY_BOT_API_TIMEOUT_SECONDS = float(os.getenv("READY_BOT_API_TIMEOUT_SECONDS", 5))
+READY_BOT_API_CACHE_SECONDS = float(os.getenv("READY_BOT_API_CACHE_SECONDS", 30))  # getMe — не чаще
+
+METRIC_READY_CHECK = metrics.gauge("bot_ready_check_ok", "Результат проверки readiness (1 — ok)", ("check",))
+
+
+async def _probe_redis() -> Dict[str, Any]:
+    started = time.perf_counter()
+    try:
+        r = await get_redis_client()
+        await asyncio.wait_for(r.ping(), READY_REDIS_MAX_MS / 1000 * 4)
+    except Exception as e:
+        return {"ok": False, "error": type(e).__name__}
+    ms = (time.perf_counter() - started) * 1000
+    return {"ok": ms <= READY_REDIS_MAX_MS, "ms": round(ms, 1), "limit_ms": READY_REDIS_MAX_MS}
+
+
+async def _probe_loop_lag() -> Dict[str, Any]:
+    # худший лаг пульса за последние секунды; без монитора — сколько ждёт callback сейчас
+    if loop_monitor.running():
+        ms = loop_monitor.recent_max_lag() * 1000
+    else:
+        started = time.perf_counter()
+        await asyncio.sleep(0)
+        ms = (time.perf_counter() - started) * 1000
+    return {"ok": ms <= READY_LOOP_LAG_MAX_MS, "ms": round(ms, 1), "limit_ms": READY_LOOP_LAG_MAX_MS}
+
+
+def _probe_executor() -> Dict[str, Any]:
+    if update_executor is None:
+        return {"ok": False, "error": "not started"}
+    stats = update_executor.stats()
+    return {
+        "ok": stats["max_shard_queue"] <= READY_SHARD_QUEUE_MAX,
+        "max_shard_queue": stats["max_shard_queue"],
+        "queued": stats["queued"],
+        "limit": READY_SHARD_QUEUE_MAX,
+    }
+
+
+async def _probe_bot_api(bot: Bot) -> Dict[str, Any]:
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(bot.get_me(), READY_BOT_API_TIMEOUT_SECONDS)
+    except Exception as e:
+        return {"ok": False, "error": type(e).__name__}
+    return {"ok": True, "ms": round((time.perf_counter() - started) * 1000, 1)}
+
+
+class ReadinessProbe:
+    def __init__(self):
+        self._result: Optional[Dict[str, Any]] = None
+        self._checked_at = 0.0
+        self._running: Optional[asyncio.Task] = None
+        self._bot_api: Optional[Dict[str, Any]] = None
+        self._bot_api_checked_at = 0.0
+
+    async def check(self, bot: Bot) -> Dict[str, Any]:
+        if self._result is not None and time.monotonic() - self._checked_at < READY_CACHE_SECONDS:
+            return self._result
+        if self._running is None or self._running.done():
+            self._running = asyncio.create_task(self._run(bot))
+        # shield: отвалившийся клиент не отменяет проверку для остальных
+        return await asyncio.shield(self._running)
+
+    async def _bot_api_check(self, bot: Bot) -> Dict[str, Any]:
+        now = time.monotonic()
+        if self._bot_api is None or not self._bot_api["ok"] or now - self._bot_api_checked_at >= READY_BOT_API_CACHE_SECONDS:
+            self._bot_api = await _probe_bot_api(bot)
+            self._bot_api_checked_at = time.monotonic()
+        return self._bot_api
+
+    async def _run(self, bot: Bot) -> Dict[str, Any]:
+        redis_check, lag_check, bot_check = await asyncio.gather(
+            _probe_redis(), _probe_loop_lag(), self._bot_api_check(bot)
+        )
+        checks = {
+            "redis": redis_check,
+            "loop_lag": lag_check,
+            "executor": _probe_executor(),
+            "bot_api": bot_check,
+        }
+        for name, check in checks.items():
+            METRIC_READY_CHECK.set(name, value=1 if check["ok"] else 0)
+        ready = all(check["ok"] for check in checks.values())
+        self._result = {"status": "ready" if ready else "degraded", "checks": checks}
+        self._checked_at = time.monotonic()
+        if not ready:
+            logger.warning("readiness degraded", extra={"fields": {"checks": checks}})
+        return self._result
+
+
+readiness = ReadinessProbe()
+
+
+async def healthcheck(request: web.Request) -> web.Response:
+    return web.json_response({"status": "healthy"})
+
+
+async def readiness_handler(request: web.Request) -> web.Response:
+    result = await readiness.check(request.app["bot"])
+    return web.json_response(result, status=200 if result["status"] == "ready" else 503)
+
+
+# ---------------- Profiler ----------------
+# Профилирование живого процесса по запросу: /admin/profile (Bearer ADMIN_HTTP_TOKEN)
+# и /profile у суперадмина. Режим sample — SIGPROF каждые PROFILE_SAMPLE_INTERVAL секунд
+# процессорного времени, обработчик сигнала копит стек прерванного кадра в collapsed
+# stacks (формат flamegraph.pl / speedscope); простой loop в профиль не попадает, нагрузка
+# — один проход по стеку на сэмпл. Режим cpu — cProfile на потоке loop (точнее, но
+# заметно медленнее), результат — pstats-дамп. Файлы пишутся в DATA_DIR/profiles,
+# одновременно идёт один сеанс.
+ADMIN_HTTP_TOKEN = os.getenv("ADMIN_HTTP_TOKEN", "")  # пусто — /admin/* выключены
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")
+PROFILE_DEFAULT_SECONDS = 10
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", 60))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", 0.005))
+PROFILE_SUMMARY_LINES = 25
+PROFILE_MODES = ("sample", "cpu")
+
+
+@dataclass
+class ProfileResult:
+    mode: str
+    seconds: float
+    path: str
+    summary: str
+    samples: int = 0
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+_profile_running = False
+profile_task: Optional[asyncio.Task] = None
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+async def _sample_stacks(seconds: float, interval: float) -> Dict[str, int]:
+    """collapsed stack -> число сэмплов. Сигналы принимает только главный поток — там и живёт loop."""
+    stacks: Dict[str, int] = {}
+
+    def on_sample(signum, frame):
+        names = []
+        while frame is not None:
+            names.append(_frame_label(frame))
+            frame = frame.f_back
+        key = ";".join(reversed(names))
+        stacks[key] = stacks.get(key, 0) + 1
+
+    previous = signal.signal(signal.SIGPROF, on_sample)
+    signal.setitimer(signal.ITIMER_PROF, interval, interval)
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, previous)
+    return stacks
+
+
+def _profile_path(mode: str) -> str:
+    stamp = datetime.now(MSK_TZ).strftime("%Y%m%d-%H%M%S")
+    return os.path.join(PROFILE_DIR, f"profile-{stamp}.{'collapsed' if mode == 'sample' else 'pstats'}")
+
+
+def _read_file_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write_collapsed(path: str, stacks: Dict[str, int]) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for key, count in sorted(stacks.items(), key=lambda kv: kv[1], reverse=True):
+            f.write(f"{key} {count}\n")
+    # сводка: самые частые «листья» — где реально проводится время
+    leaves: Dict[str, int] = {}
+    for key, count in stacks.items():
+        leaf = key.rsplit(";", 1)[-1]
+        leaves[leaf] = leaves.get(leaf, 0) + count
+    total = sum(stacks.values()) or 1
+    top = sorted(leaves.items(), key=lambda kv: kv[1], reverse=True)[:PROFILE_SUMMARY_LINES]
+    return "\n".join(f"{count * 100 / total:5.1f}%  {leaf}" for leaf, count in top)
+
+
+def _write_pstats(path: str, profile: cProfile.Profile) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profile.dump_stats(path)
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(PROFILE_SUMMARY_LINES)
+    return out.getvalue()
+
+
+async def run_profile(seconds: float, mode: str = "sample") -> ProfileResult:
+    """Профилирует поток event loop seconds секунд; файловая запись — вне loop."""
+    global _profile_running
+    if _profile_running:
+        raise ProfilerBusy()
+    _profile_running = True
+    try:
+        if mode == "cpu":
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+            path = _profile_path(mode)
+            summary = await asyncio.to_thread(_write_pstats, path, profile)
+            return ProfileResult(mode, seconds, path, summary)
+        stacks = await _sample_stacks(seconds, PROFILE_SAMPLE_INTERVAL)
+        path = _profile_path(mode)
+        summary = await asyncio.to_thread(_write_collapsed, path, stacks)
+        return ProfileResult(mode, seconds, path, summary, samples=sum(stacks.values()))
+    finally:
+        _profile_running = False
+
+
+def parse_profile_args(args: list[str]) -> Tuple[float, str]:
+    seconds, mode = PROFILE_DEFAULT_SECONDS, "sample"
+    for arg in args:
+        if arg in PROFILE_MODES:
+            mode = arg
+        else:
+            seconds = float(arg)
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise ValueError(f"seconds must be in (0, {PROFILE_MAX_SECONDS}]")
+    return seconds, mode
+
+
+def _admin_authorized(request: web.Request) -> bool:
+    return bool(ADMIN_HTTP_TOKEN) and hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {ADMIN_HTTP_TOKEN}"
+    )
+
+
+async def admin_profile_handler(request: web.Request) -> web.Response:
+    """GET /admin/profile?seconds=10&mode=sample|cpu — тело ответа: collapsed stacks или сводка pstats."""
+    if not _admin_authorized(request):
+        return web.Response(status=401)
+    try:
+        seconds, mode = parse_profile_args(
+            [v for v in (request.query.get("seconds"), request.query.get("mode")) if v]
+        )
+    except ValueError as e:
+        return web.Response(status=400, text=str(e))
+    try:
+        result = await run_profile(seconds, mode)
+    except ProfilerBusy:
+        return web.Response(status=409, text="profiler is already running")
+    headers = {"X-Profile-Path": result.path}
+    if mode == "sample":
+        return web.FileResponse(result.path, headers=headers)
+    return web.Response(text=result.summary, headers=headers)
+
+
+def build_bot(token: str, session: Optional[BaseSession] = None) -> Bot:
+    bot = Bot(
+        token=token,
+        session=session,
+        default=DefaultBotProperties(parse_mode="HTML"),
+    )
+    bot.session.middleware(TelegramMetricsMiddleware())
+    return bot
+
+
+def build_dispatcher(storage: RedisStorage) -> Dispatcher:
+    """Dispatcher с боевым набором middleware и роутером; общий для main() и bench.py."""
+    # FSM-middleware подключаем вручную: CachedFSMContext вместо стандартного контекста
+    dp = Dispatcher(storage=storage, disable_fsm=True)
+    dp.fsm = CachedFSMContextMiddleware(
+        storage=storage,
+        events_isolation=dp.fsm.events_isolation,
+        strategy=dp.fsm.strategy,
+    )
+    dp.update.outer_middleware(MetricsMiddleware())
+    dp.update.outer_middleware(dp.fsm)
+
+    dp.update.outer_middleware(UpdateLogMiddleware())
+
+    # inner-middleware диспетчера видят хендлеры всех вложенных роутеров
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.message.middleware(RateLimitMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    dp.include_router(create_router())
+    return dp
+
+
 async def main():
     if not BOT_TOKEN:
         logger.error("BOT_TOKEN not set")
@@ -2990,101 +6402,60 @@ async def main():
         logger.error("REDIS_URL not set")
         return
 
-    bot = Bot(
-        token=BOT_TOKEN,
-        default=DefaultBotProperties(parse_mode="HTML"),
-    )
-    storage = RedisStorage.from_url(REDIS_URL)
-    dp = Dispatcher(storage=storage)
-
-    @dp.update.outer_middleware()
-    async def log_all_updates(handler, event, data):
-        try:
-            update = data.get("event_update")
-            if update:
-                logger.info(f"RAW UPDATE TYPE: {update.event_type}")
-                logger.info(
-                    f"RAW UPDATE DATA: {update.model_dump_json(exclude_none=True)[:2000]}"
-                )
-        except Exception as e:
-            logger.exception(f"UPDATE LOG ERROR: {e}")
-        return await handler(event, data)
-
-    dp.include_router(router)
+    bot = build_bot(BOT_TOKEN)
+    # FSM-хранилище работает поверх того же пула, что и хелперы
+    storage = RedisStorage(redis=init_redis_pool())
+    dp = build_dispatcher(storage)
     dp.startup.register(on_startup_bot)
 
-    @web.middleware
-    async def raw_log_middleware(request: web.Request, handler):
-        body_text = ""
-        try:
-            body_bytes = await request.read()
-            body_text = body_bytes.decode("utf-8", errors="replace")
-        except Exception as e:
-            body_text = f"<body read error: {e}>"
-
-        logger.info(
-            f"RAW HTTP {request.method} {request.path} "
-            f"content_type={request.content_type!r} "
-            f"ua={request.headers.get('User-Agent')!r} "
-            f"secret={request.headers.get('X-Telegram-Bot-Api-Secret-Token')!r}"
-        )
-        logger.info(f"RAW HTTP BODY: {body_text[:3000]}")
-
-        try:
-            if body_text:
-                request._read_bytes = body_text.encode("utf-8")
-            response = await handler(request)
-            logger.info(f"RAW HTTP DONE {request.method} {request.path} status={response.status}")
-            return response
-        except Exception as e:
-            logger.exception(f"RAW HTTP ERROR {request.method} {request.path}: {e}")
-            raise
-            
-    app = web.Application(middlewares=[raw_log_middleware])
+    app = web.Application(middlewares=[http_log_middleware])
     app["bot"] = bot
 
-    async def healthcheck(request: web.Request):
-        return web.json_response({"status": "healthy"})
-
     app.router.add_get("/", healthcheck)
     app.router.add_get("/healthcheck", healthcheck)
+    app.router.add_get("/ready", readiness_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_get("/admin/profile", admin_profile_handler)
     app.router.add_get("/pay-month", pay_month_handler)
     app.router.add_get("/pay-year", pay_year_handler)
     app.router.add_post("/yookassa_webhook", yookassa_webhook)
 
-    SimpleRequestHandler(
+    global update_executor
+    update_executor = UpdateExecutor(dp, bot, workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE)
+    ExecutorRequestHandler(
+        executor=update_executor,
         dispatcher=dp,
         bot=bot,
         secret_token=WEBHOOK_SECRET,
-        handle_in_background=True,
     ).register(app, path=WEBHOOK_PATH)
 
     setup_application(app, dp, bot=bot)
 
     async def on_shutdown(a: web.Application):
-        global smarttask, substask
-        try:
-            if smarttask and not smarttask.done():
-                smarttask.cancel()
-        except Exception:
-            pass
+        for task in (smart_task, subs_task, menu_task, broadcast_task, outbox_task, profile_task, *order_tasks):
+            try:
+                if task and not task.done():
+                    task.cancel()
+            except Exception:
+                pass
+        loop_monitor.stop()
         try:
-            if substask and not substask.done():
-                substask.cancel()
+            await bot.delete_webhook()
         except Exception:
             pass
         try:
-            await bot.delete_webhook()
+            await storage.close()
         except Exception:
             pass
         try:
-            await storage.close()
+            await close_redis_pool()
         except Exception:
             pass
         try:
             await bot.session.close()
         except Exception:
             pass
+        stop_logging()
 
     app.on_shutdown.append(on_shutdown)
 
@@ -3093,7 +6464,7 @@ async def main():
     except Exception as e:
         logger.error(f"Webhook set error {e}")
 
-    runner = web.AppRunner(app)
+    runner = web.AppRunner(app, access_log=None)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", PORT)
     await site.start()
@@ -0,0 +1,128 @@
+"""
+Тесты на fakeredis[lua]: настоящий пул main.InstrumentedRedisPool поверх FakeServer,
+Lua-скрипты исполняются как в Redis. Каждый тест получает чистый сервер и свой event loop.
+
+    pip install -r requirements-test.txt
+    python -m pytest -q
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict
+
+import fakeredis
+import pytest
+
+# main.py читает окружение и config.json при импорте: данные — во временный каталог,
+# меню и часы работы — из config.json репозитория
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="cafebot-tests-")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+if os.path.exists(os.path.join(_ROOT, "config.json")):
+    shutil.copy(os.path.join(_ROOT, "config.json"), os.environ["DATA_DIR"])
+
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.types import Chat, Message, User  # noqa: E402
+
+import main  # noqa: E402
+
+TEST_TOKEN = "123456:test"
+
+# в новых fakeredis асинхронное соединение переименовано; старое имя работает, но с DeprecationWarning
+FAKE_CONNECTION = getattr(fakeredis.aioredis, "FakeAsyncRedisConnection", fakeredis.aioredis.FakeConnection)
+
+
+def pytest_unconfigure(config):
+    main.stop_logging()
+    shutil.rmtree(os.environ["DATA_DIR"], ignore_errors=True)
+
+
+class RecordingSession(BaseSession):
+    """
+    Bot API без сети: на send*/edit* отвечает фиктивным Message, на остальное — True,
+    и запоминает (метод, chat_id, text) каждого вызова.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+        self._message_id = 0
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        if False:
+            yield b""
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests.append((type(method).__name__, getattr(method, "chat_id", None), getattr(method, "text", None)))
+        returning = method.__returning__
+        if returning is Message:
+            self._message_id += 1
+            chat_id = getattr(method, "chat_id", 0)
+            return Message(
+                message_id=self._message_id,
+                date=datetime.now(),
+                chat=Chat(id=chat_id if isinstance(chat_id, int) else 0, type="private"),
+                text=getattr(method, "text", None),
+            ).as_(bot)
+        if returning is User:
+            return User(id=int(TEST_TOKEN.split(":")[0]), is_bot=True, first_name="test")
+        return True
+
+
+def message_update(update_id: int, user_id: int, text: str) -> Dict[str, Any]:
+    """Сырой Update с текстовым сообщением в личном чате user_id."""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test", "username": f"test{user_id}"},
+            "text": text,
+        },
+    }
+
+
+@pytest.fixture
+def run():
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.run_until_complete(main.close_redis_pool())
+    loop.close()
+
+
+@pytest.fixture
+def r(run):
+    pool = main.InstrumentedRedisPool(
+        connection_class=FAKE_CONNECTION,
+        server=fakeredis.FakeServer(),
+        decode_responses=True,
+        max_connections=main.REDIS_POOL_MAX_CONNECTIONS,
+        timeout=main.REDIS_POOL_TIMEOUT_SECONDS,
+    )
+    return main.init_redis_pool(pool)
+
+
+@pytest.fixture
+def session():
+    return RecordingSession()
+
+
+@pytest.fixture
+def bot(session):
+    return main.build_bot(TEST_TOKEN, session=session)
+
+
+def deliver_orders(run, r, group):
+    """Читает новые записи orders:stream от имени группы, как order_consume_batch до вызова хендлера."""
+    run(main.ensure_order_groups(r))
+    resp = run(r.xreadgroup(group, main.ORDER_CONSUMER_NAME, {main.ORDER_STREAM_KEY: ">"}))
+    return [(msg_id, main.OrderRecord.from_stream(fields)) for msg_id, fields in (resp[0][1] if resp else [])]
@@ -0,0 +1,76 @@
+import pytest
+
+import main
+
+
+class FakeOutbound:
+    def __init__(self, blocked=(), on_send=None):
+        self.blocked = set(blocked)
+        self.on_send = on_send
+        self.sent = []
+
+    async def send_many(self, bot, messages, **kwargs):
+        if self.on_send:
+            await self.on_send()
+        self.sent += [chat_id for chat_id, _ in messages]
+        return {chat_id: main.SEND_BLOCKED if chat_id in self.blocked else main.SEND_OK for chat_id, _ in messages}
+
+
+@pytest.fixture
+def customers(r, run):
+    run(r.sadd(main.CUSTOMERS_SET_KEY, *range(1, 6)))
+
+
+def test_job_runs_to_done_and_releases_lock(r, run, bot, customers, monkeypatch):
+    fake = FakeOutbound(blocked={3})
+    monkeypatch.setattr(main, "outbound", fake)
+    job_id = run(main.create_broadcast_job("Акция!", owner_chat_id=100))
+
+    run(main.broadcast_process_queue(bot))
+
+    assert sorted(fake.sent) == [1, 2, 3, 4, 5]
+    progress = run(main.get_broadcast_progress(job_id))
+    assert (progress.status, progress.sent, progress.blocked, progress.remaining) == ("done", 4, 1, 0)
+    assert not run(r.sismember(main.CUSTOMERS_SET_KEY, 3))
+    assert run(r.llen(main.BROADCAST_QUEUE_KEY)) == 0
+    assert not run(r.exists(main.BROADCAST_LOCK_KEY))
+
+
+def test_worker_skips_queue_while_lock_is_held(r, run, bot, customers, monkeypatch):
+    fake = FakeOutbound()
+    monkeypatch.setattr(main, "outbound", fake)
+    job_id = run(main.create_broadcast_job("Акция!", owner_chat_id=100))
+    run(r.set(main.BROADCAST_LOCK_KEY, "other-worker"))
+
+    run(main.broadcast_process_queue(bot))
+
+    assert fake.sent == []
+    assert run(main.get_broadcast_progress(job_id)).status == "queued"
+    assert run(r.get(main.BROADCAST_LOCK_KEY)) == "other-worker"
+
+
+def test_worker_that_lost_the_lock_leaves_it_alone(r, run, bot, customers, monkeypatch):
+    async def lock_taken_over():
+        await r.set(main.BROADCAST_LOCK_KEY, "new-worker")
+
+    monkeypatch.setattr(main, "outbound", FakeOutbound(on_send=lock_taken_over))
+    monkeypatch.setattr(main, "BROADCAST_CHUNK", 2)
+    run(main.create_broadcast_job("Акция!", owner_chat_id=100))
+
+    run(main.broadcast_process_queue(bot))
+
+    assert run(r.get(main.BROADCAST_LOCK_KEY)) == "new-worker"
+    assert run(r.llen(main.BROADCAST_QUEUE_KEY)) == 1
+
+
+def test_lock_scripts_compare_the_token(r, run):
+    run(r.set(main.BROADCAST_LOCK_KEY, "mine", ex=10))
+    extend = main.redis_script(main.LOCK_EXTEND_LUA)
+    release = main.redis_script(main.LOCK_RELEASE_LUA)
+
+    assert run(extend(keys=[main.BROADCAST_LOCK_KEY], args=["other", 60_000])) == 0
+    assert run(release(keys=[main.BROADCAST_LOCK_KEY], args=["other"])) == 0
+    assert run(extend(keys=[main.BROADCAST_LOCK_KEY], args=["mine", 60_000])) == 1
+    assert run(r.ttl(main.BROADCAST_LOCK_KEY)) > 10
+    assert run(release(keys=[main.BROADCAST_LOCK_KEY], args=["mine"])) == 1
+    assert not run(r.exists(main.BROADCAST_LOCK_KEY))
@@ -0,0 +1,135 @@
+import time
+
+from aiogram.types import Update
+
+import main
+from conftest import message_update
+
+
+def _cafe(run, r, cafe_id, admin_id, paid, valid_until):
+    run(r.hset(main.k_cafe_profile(cafe_id), mapping={"admin_id": admin_id}))
+    run(r.hset(main.k_admin_subscription(cafe_id), mapping={
+        "cafebotify_paid": paid,
+        "cafebotify_valid_until": valid_until,
+    }))
+
+
+def test_index_tracks_admin_and_paid_subscription(r, run):
+    _cafe(run, r, "c1", "42", "1", 1000)
+
+    run(main.index_cafe(r, "c1"))
+    assert run(r.hgetall(main.CAFES_BY_ADMIN_KEY)) == {"42": "c1"}
+    assert run(r.zrange(main.CAFES_ACTIVE_SUBS_KEY, 0, -1, withscores=True)) == [("c1", 1000.0)]
+
+    run(r.hset(main.k_admin_subscription("c1"), "cafebotify_paid", "0"))
+    run(main.index_cafe(r, "c1"))
+    assert run(r.zcard(main.CAFES_ACTIVE_SUBS_KEY)) == 0
+
+
+def test_cafe_without_admin_is_not_indexed_by_admin(r, run):
+    _cafe(run, r, "c1", "0", "1", 1000)
+
+    run(main.index_cafe(r, "c1"))
+
+    assert not run(r.exists(main.CAFES_BY_ADMIN_KEY))
+    assert run(r.zscore(main.CAFES_ACTIVE_SUBS_KEY, "c1")) == 1000
+
+
+def test_rebuild_scans_profiles_once(r, run):
+    _cafe(run, r, "c1", "42", "1", 1000)
+    _cafe(run, r, "c2", "43", "0", 0)
+
+    assert run(main.rebuild_cafe_indexes(r)) == 2
+    assert run(r.hgetall(main.CAFES_BY_ADMIN_KEY)) == {"42": "c1", "43": "c2"}
+    assert run(r.zrange(main.CAFES_ACTIVE_SUBS_KEY, 0, -1)) == ["c1"]
+
+    _cafe(run, r, "c3", "44", "1", 2000)
+    assert run(main.rebuild_cafe_indexes(r)) == 0
+    assert run(main.rebuild_cafe_indexes(r, force=True)) == 3
+
+
+def test_rebinding_admin_drops_the_old_entry(r, run):
+    _cafe(run, r, "c1", "42", "1", 1000)
+    run(main.index_cafe(r, "c1"))
+
+    run(r.hset(main.k_cafe_profile("c1"), "admin_id", "43"))
+    run(main.index_cafe(r, "c1"))
+    assert run(r.hgetall(main.CAFES_BY_ADMIN_KEY)) == {"43": "c1"}
+
+    run(r.hset(main.k_cafe_profile("c1"), "admin_id", "0"))
+    run(main.index_cafe(r, "c1"))
+    assert not run(r.exists(main.CAFES_BY_ADMIN_KEY))
+    assert run(r.hget(main.k_cafe_profile("c1"), "indexed_admin_id")) is None
+
+
+def test_rebinding_keeps_an_entry_that_moved_to_another_cafe(r, run):
+    _cafe(run, r, "c1", "42", "1", 1000)
+    run(main.index_cafe(r, "c1"))
+    _cafe(run, r, "c2", "42", "1", 1000)
+    run(main.index_cafe(r, "c2"))
+
+    run(r.hset(main.k_cafe_profile("c1"), "admin_id", "0"))
+    run(main.index_cafe(r, "c1"))
+
+    assert run(r.hgetall(main.CAFES_BY_ADMIN_KEY)) == {"42": "c2"}
+
+
+def test_lookup_by_admin_checks_the_profile(r, run):
+    _cafe(run, r, "c1", "42", "1", int(time.time()) + 3600)
+    run(main.index_cafe(r, "c1"))
+    assert run(main.get_cafe_id_by_admin(r, 42)) == "c1"
+    assert run(main.get_bound_active_cafe_id_by_admin(r, 42)) == "c1"
+    assert run(main.has_active_bound_cafe_by_admin(r, 42))
+
+    # профиль переписан без переиндексации: индекс не доверяем и чиним
+    run(r.hset(main.k_cafe_profile("c1"), "admin_id", "43"))
+    assert run(main.get_cafe_id_by_admin(r, 42)) is None
+    assert run(r.hgetall(main.CAFES_BY_ADMIN_KEY)) == {"43": "c1"}
+
+
+def test_bound_cafe_requires_active_subscription(r, run):
+    _cafe(run, r, "c1", "42", "1", int(time.time()) - 1)
+    run(main.index_cafe(r, "c1"))
+    assert run(main.get_bound_active_cafe_id_by_admin(r, 42)) is None
+    assert not run(main.has_active_bound_cafe_by_admin(r, 42))
+    assert run(main.get_bound_active_cafe_id_by_admin(r, 99)) is None
+
+
+def test_free_pool_spop_and_release(r, run):
+    _cafe(run, r, "c1", "0", "0", 0)
+    _cafe(run, r, "c2", "42", "0", 0)
+    _cafe(run, r, "c3", "", "1", int(time.time()) + 3600)
+    for cafe_id in ("c1", "c2", "c3"):
+        run(main.index_cafe(r, cafe_id))
+    assert run(r.smembers(main.CAFES_FREE_KEY)) == {"c1"}
+
+    assert run(main.find_free_cafe_id(r)) == "c1"
+    assert run(main.find_free_cafe_id(r)) is None
+
+    run(main.release_free_cafe_id(r, "c1"))
+    assert run(r.smembers(main.CAFES_FREE_KEY)) == {"c1"}
+
+
+def test_free_pool_skips_stale_candidates(r, run):
+    _cafe(run, r, "c1", "0", "0", 0)
+    run(main.index_cafe(r, "c1"))
+    run(r.hset(main.k_cafe_profile("c1"), "admin_id", "42"))
+
+    assert run(main.find_free_cafe_id(r)) is None
+    assert run(r.hgetall(main.CAFES_BY_ADMIN_KEY)) == {"42": "c1"}
+    assert not run(r.exists(main.CAFES_FREE_KEY))
+
+
+def test_set_paid_ignores_a_former_admin(r, run, bot, session, monkeypatch):
+    monkeypatch.setattr(main, "SUPERADMIN_ID", 1)
+    _cafe(run, r, "c1", "42", "0", 0)
+    run(main.index_cafe(r, "c1"))
+    # клиентский бот перепривязал кафе, не вызвав index_cafe
+    run(r.hset(main.k_cafe_profile("c1"), "admin_id", "43"))
+
+    message = Update.model_validate(message_update(1, 1, "/set_paid 42 2030-01-01")).message.as_(bot)
+    run(main.set_paid_cmd(message))
+
+    assert run(r.hget(main.k_admin_subscription("c1"), "cafebotify_paid")) == "0"
+    assert run(r.hget("user:42", "cafebotify_paid")) == "1"
+    assert run(r.hgetall(main.CAFES_BY_ADMIN_KEY)) == {"43": "c1"}
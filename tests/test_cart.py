@@ -0,0 +1,38 @@
+import main
+
+
+def test_add_accumulates_and_sets_ttl(r, run):
+    run(main.cart_add(1, "Латте", 2))
+
+    assert run(main.cart_add(1, "Латте", 1)) == {"Латте": 3}
+    assert 0 < run(r.ttl(main._cart_key(1))) <= main.CART_TTL_SECONDS
+
+
+def test_change_is_atomic_and_drops_empty_items(r, run):
+    run(main.cart_replace(1, {"Латте": 2, "Раф": 1}))
+
+    assert run(main.cart_change(1, "Латте", -1)) == {"Латте": 1, "Раф": 1}
+    assert run(main.cart_change(1, "Раф", -1)) == {"Латте": 1}
+    assert not run(r.hexists(main._cart_key(1), "Раф"))
+
+
+def test_change_does_not_resurrect_removed_items(r, run):
+    run(main.cart_replace(1, {"Латте": 1}))
+
+    assert run(main.cart_change(1, "Раф", 1)) == {"Латте": 1}
+    run(main.cart_clear(1))
+    assert run(main.cart_change(1, "Латте", 1)) == {}
+    assert not run(r.exists(main._cart_key(1)))
+
+
+def test_remove_and_replace(r, run):
+    run(main.cart_replace(1, {"Латте": 1, "Раф": 2}))
+
+    assert run(main.cart_remove(1, "Латте")) == {"Раф": 2}
+    run(main.cart_replace(1, {}))
+    assert run(main.cart_get(1)) == {}
+
+
+def test_parse_cart_ignores_bad_values():
+    assert main._parse_cart(["Латте", "2", "Раф", "x", "Мокко", "0"]) == {"Латте": 2}
+    assert main._parse_cart({"Латте": "1"}) == {"Латте": 1}
@@ -0,0 +1,42 @@
+from aiogram.fsm.storage.redis import RedisStorage
+
+import main
+from conftest import message_update
+
+
+def handler_names(r):
+    return [h.callback.__name__ for h in r.message.handlers]
+
+
+def test_build_dispatcher_leaves_module_router_detached(r):
+    storage = RedisStorage(redis=r)
+    first = main.build_dispatcher(storage)
+    second = main.build_dispatcher(storage)
+
+    assert main.router.parent_router is None
+    [first_router] = first.sub_routers
+    [second_router] = second.sub_routers
+    assert first_router is not second_router
+    assert handler_names(first_router) == handler_names(main.router) == handler_names(second_router)
+    assert len(first.message.middleware) == len(second.message.middleware) == 2
+    assert main.router.message.middleware._middlewares == []
+
+
+def test_order_flow_through_dispatcher(r, run, bot, monkeypatch):
+    # кафе всегда открыто, иначе оформление упирается в часы работы
+    monkeypatch.setattr(main, "WORK_START", 0)
+    monkeypatch.setattr(main, "WORK_END", 24)
+    dp = main.build_dispatcher(RedisStorage(redis=r))
+    drinks = list(main.MENU)
+    texts = ["/start", None, "2", main.BTN_CHECKOUT, main.BTN_CONFIRM, main.BTN_READY_20]
+
+    for user in range(3):
+        for i, text in enumerate(texts):
+            update = message_update(user * 10 + i + 1, 700 + user, text or drinks[user % len(drinks)])
+            run(dp.feed_raw_update(bot, update))
+
+    assert run(r.xlen(main.ORDER_STREAM_KEY)) == 3
+    # inner-middleware на диспетчере видит хендлеры вложенного роутера
+    handlers = {labels[0] for labels in main.METRIC_HANDLER_SECONDS._series}
+    assert {"cmd_start", "checkout", "confirm_order", "ready_time"} <= handlers
+    assert "unknown" not in handlers
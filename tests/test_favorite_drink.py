@@ -0,0 +1,41 @@
+import pytest
+
+import main
+from conftest import deliver_orders
+
+
+@pytest.fixture(autouse=True)
+def menu(monkeypatch):
+    monkeypatch.setattr(main, "MENU", {"Латте": 200, "Раф": 250})
+    monkeypatch.setitem(main.RATE_LIMIT_POLICIES, "order", main.RateLimitPolicy(limit=100, window_seconds=60))
+
+
+def _order(run, r, cart):
+    run(main.cart_replace(7, cart))
+    total = sum(main.MENU[d] * q for d, q in cart.items())
+    run(main.commit_order(7, "Петя", "petya", cart, total, 0))
+    for msg_id, order in deliver_orders(run, r, main.ORDER_GROUP_PROFILE):
+        run(main._apply_order_profile(None, msg_id, order))
+    return run(r.hgetall(f"{main.CUSTOMER_KEY_PREFIX}7"))
+
+
+def test_profile_keeps_favorite_drink(r, run):
+    profile = _order(run, r, {"Латте": 2})
+    assert (profile["favorite_drink"], profile["favorite_count"]) == ("Латте", "2")
+
+    profile = _order(run, r, {"Раф": 2})
+    assert profile["favorite_drink"] == "Латте"
+
+    profile = _order(run, r, {"Раф": 1})
+    assert (profile["favorite_drink"], profile["favorite_count"]) == ("Раф", "3")
+
+
+def test_backfill_favorites_from_drink_counts(r, run):
+    run(r.sadd(main.CUSTOMERS_SET_KEY, 1, 2))
+    run(r.hset(f"{main.CUSTOMER_DRINKS_PREFIX}1", mapping={"Латте": 2, "Раф": 5}))
+
+    assert run(main.backfill_favorite_drinks(r)) == 1
+    assert run(r.hget(f"{main.CUSTOMER_KEY_PREFIX}1", "favorite_drink")) == "Раф"
+    assert run(r.hget(f"{main.CUSTOMER_KEY_PREFIX}1", "favorite_count")) == "5"
+    assert not run(r.exists(f"{main.CUSTOMER_KEY_PREFIX}2"))
+    assert run(main.backfill_favorite_drinks(r)) == 0
@@ -0,0 +1,75 @@
+import pytest
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+
+import main
+
+
+@pytest.fixture
+def storage(r):
+    return RedisStorage(redis=r)
+
+
+@pytest.fixture
+def key():
+    return StorageKey(bot_id=1, chat_id=500, user_id=500)
+
+
+@pytest.fixture
+def usage():
+    calls = [0, 0.0]
+    token = main._update_redis_usage.set(calls)
+    yield calls
+    main._update_redis_usage.reset(token)
+
+
+def test_update_costs_one_read_and_one_write(run, storage, key, usage):
+    async def handler():
+        ctx = main.CachedFSMContext(storage, key)
+        assert await ctx.get_state() is None
+        await ctx.set_state(main.OrderStates.waiting_for_quantity)
+        await ctx.update_data(drink="Латте")
+        await ctx.update_data(qty=2)
+        assert await ctx.get_value("drink") == "Латте"
+        await ctx.flush()
+
+    run(handler())
+
+    assert usage[0] == 2
+    plain = FSMContext(storage=storage, key=key)
+    assert run(plain.get_state()) == main.OrderStates.waiting_for_quantity.state
+    assert run(plain.get_data()) == {"drink": "Латте", "qty": 2}
+
+
+def test_read_only_update_does_not_write(run, storage, key, usage):
+    run(FSMContext(storage=storage, key=key).set_data({"drink": "Раф"}))
+    usage[0] = 0
+
+    async def handler():
+        ctx = main.CachedFSMContext(storage, key)
+        data = await ctx.get_data()
+        data["drink"] = "changed"
+        assert await ctx.get_data() == {"drink": "Раф"}
+        await ctx.flush()
+
+    run(handler())
+
+    assert usage[0] == 1
+
+
+def test_clear_deletes_keys(run, r, storage, key):
+    plain = FSMContext(storage=storage, key=key)
+    run(plain.set_state(main.OrderStates.cart_view))
+    run(plain.set_data({"drink": "Раф"}))
+
+    async def handler():
+        ctx = main.CachedFSMContext(storage, key)
+        await ctx.clear()
+        await ctx.flush()
+
+    run(handler())
+
+    assert run(plain.get_state()) is None
+    assert run(plain.get_data()) == {}
+    assert run(r.keys("fsm:*")) == []
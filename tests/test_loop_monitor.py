@@ -0,0 +1,60 @@
+import asyncio
+import time
+import traceback
+
+import main
+
+
+def hog(seconds):
+    time.sleep(seconds)
+
+
+def test_blocking_call_is_attributed_to_its_frame(run):
+    monitor = main.LoopMonitor(interval=0.02, threshold=0.1)
+
+    async def scenario():
+        monitor.start()
+        try:
+            await asyncio.sleep(0.05)
+            hog(0.3)
+            await asyncio.sleep(0.1)
+        finally:
+            monitor.stop()
+
+    run(scenario())
+
+    assert monitor.blocked_total == 1
+    assert monitor.recent_max_lag() >= 0.2
+    [(where, count)] = monitor.top_offenders()
+    assert where.startswith("test_loop_monitor.py:hog:")
+    assert count == 1
+    assert not monitor.running()
+
+
+def test_short_pauses_are_not_counted_as_blocks(run):
+    monitor = main.LoopMonitor(interval=0.02, threshold=0.2)
+
+    async def scenario():
+        monitor.start()
+        try:
+            for _ in range(3):
+                hog(0.03)
+                await asyncio.sleep(0.03)
+        finally:
+            monitor.stop()
+
+    run(scenario())
+
+    assert monitor.blocked_total == 0
+    assert monitor.offenders == {}
+
+
+def test_blocking_location_prefers_main_frames():
+    stack = [
+        traceback.FrameSummary(main.__file__, 10, "handler"),
+        traceback.FrameSummary("/usr/lib/python3/json/decoder.py", 20, "decode"),
+    ]
+    assert main._blocking_location(stack) == "handler:10"
+
+    stack = [traceback.FrameSummary("/usr/lib/python3/json/decoder.py", 20, "decode")]
+    assert main._blocking_location(stack) == "decoder.py:decode:20"
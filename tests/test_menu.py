@@ -0,0 +1,68 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def menu(monkeypatch):
+    monkeypatch.setattr(main, "MENU", {"Латте": 200, "Капучино": 180})
+    monkeypatch.setattr(main, "MENU_VERSION", None)
+    main.invalidate_render_cache()
+    yield
+    main.invalidate_render_cache()
+
+
+def test_seed_fills_empty_redis_once(r, run, menu):
+    assert run(main.seed_menu_if_missing())
+    assert run(r.hgetall(main.MENU_REDIS_KEY)) == {"Латте": "200", "Капучино": "180"}
+    assert run(r.get(main.MENU_VERSION_KEY)) == "1"
+
+    main.MENU["Раф"] = 250
+    assert not run(main.seed_menu_if_missing())
+    assert "Раф" not in run(r.hgetall(main.MENU_REDIS_KEY))
+
+
+def test_seed_keeps_menu_cleared_by_owner(r, run, menu):
+    run(r.set(main.MENU_VERSION_KEY, 5))
+
+    assert not run(main.seed_menu_if_missing())
+    assert not run(r.exists(main.MENU_REDIS_KEY))
+
+    run(main.sync_menu_from_redis())
+    assert main.MENU == {}
+    assert main.MENU_VERSION == 5
+
+
+def test_seed_keeps_existing_hash(r, run, menu):
+    run(r.hset(main.MENU_REDIS_KEY, mapping={"Эспрессо": 120}))
+
+    assert run(main.seed_menu_if_missing())
+    assert run(r.hgetall(main.MENU_REDIS_KEY)) == {"Эспрессо": "120"}
+
+
+def test_refresh_reads_redis_only_on_new_version(r, run, menu):
+    run(main.seed_menu_if_missing())
+    run(main.sync_menu_from_redis())
+    assert main.MENU_VERSION == 1
+
+    run(r.hset(main.MENU_REDIS_KEY, "Раф", 250))
+    run(main.refresh_menu_if_stale(1))
+    assert "Раф" not in main.MENU
+
+    run(r.incr(main.MENU_VERSION_KEY))
+    run(main.refresh_menu_if_stale())
+    assert main.MENU["Раф"] == 250
+    assert main.MENU_VERSION == 2
+
+
+def test_owner_edit_bumps_version(r, run, menu):
+    run(main.seed_menu_if_missing())
+    run(main.sync_menu_from_redis())
+
+    run(main.menu_set_item("Раф", 250))
+    run(main.menu_delete_item("Латте"))
+
+    assert run(r.hgetall(main.MENU_REDIS_KEY)) == {"Капучино": "180", "Раф": "250"}
+    assert run(r.get(main.MENU_VERSION_KEY)) == "3"
+    assert main.MENU_VERSION == 3
+    assert main.MENU == {"Капучино": 180, "Раф": 250}
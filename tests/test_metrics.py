@@ -0,0 +1,64 @@
+from aiogram.fsm.storage.redis import RedisStorage
+from aiohttp.test_utils import make_mocked_request
+
+import main
+from conftest import message_update
+
+
+def test_render_counters_and_histograms():
+    registry = main.MetricsRegistry()
+    requests = registry.counter("requests_total", "Запросы", ("path",))
+    latency = registry.histogram("latency_seconds", "Задержка", buckets=(0.1, 1.0))
+    requests.inc('/a"b')
+    requests.inc('/a"b', value=2)
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.observe(value=value)
+
+    lines = registry.render().splitlines()
+
+    assert "# HELP requests_total Запросы" in lines
+    assert "# TYPE latency_seconds histogram" in lines
+    assert 'requests_total{path="/a\\"b"} 3' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{le="1"} 3' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 4' in lines
+    assert "latency_seconds_sum 3.65" in lines
+    assert "latency_seconds_count 4" in lines
+
+
+def test_broken_collector_is_skipped():
+    registry = main.MetricsRegistry()
+
+    @registry.collector
+    def broken():
+        raise RuntimeError("boom")
+
+    @registry.collector
+    def queue_size():
+        return [("queue_size", "gauge", "Очередь", {(): 7}, ())]
+
+    assert registry.render().splitlines()[-1] == "queue_size 7"
+
+
+def test_handler_latency_is_labelled_by_handler(r, run, bot):
+    dp = main.build_dispatcher(RedisStorage(redis=r))
+    before = main.METRIC_HANDLER_SECONDS._series.get(("cmd_start",), [[0], 0.0])[0][:]
+
+    run(dp.feed_raw_update(bot, message_update(1, 500, "/start")))
+
+    counts = main.METRIC_HANDLER_SECONDS._series[("cmd_start",)][0]
+    assert sum(counts) == sum(before) + 1
+    assert 'bot_handler_seconds_count{handler="cmd_start"}' in main.metrics.render()
+
+
+def test_metrics_endpoint_checks_token(run, monkeypatch):
+    monkeypatch.setattr(main, "METRICS_TOKEN", "secret")
+
+    denied = run(main.metrics_handler(make_mocked_request("GET", "/metrics")))
+    allowed = run(main.metrics_handler(make_mocked_request(
+        "GET", "/metrics", headers={"Authorization": "Bearer secret"},
+    )))
+
+    assert denied.status == 401
+    assert allowed.status == 200
+    assert "# TYPE bot_handler_seconds histogram" in allowed.text
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def menu(monkeypatch):
+    monkeypatch.setattr(main, "MENU", {"Латте": 200, "Капучино": 180})
+
+
+def _commit(run, user_id=1, cart=None):
+    cart = cart if cart is not None else {"Латте": 2, "Капучино": 1}
+    total = sum(main.MENU[d] * q for d, q in cart.items())
+    return run(main.commit_order(user_id, "Петя", "petya", cart, total, 20))
+
+
+def test_commit_takes_cart_and_writes_order(r, run):
+    run(main.cart_add(1, "Латте", 2))
+    run(main.cart_add(1, "Капучино", 1))
+
+    order = _commit(run)
+
+    assert order.order_id == 1
+    assert order.total == 580
+    assert not run(r.exists(main._cart_key(1)))
+    assert run(r.get(main.ORDER_SEQ_KEY)) == "1"
+    snapshot = json.loads(run(r.get(main._last_order_key(1))))
+    assert snapshot["cart"] == {"Латте": 2, "Капучино": 1}
+
+    [(_, fields)] = run(r.xrange(main.ORDER_STREAM_KEY))
+    assert main.OrderRecord.from_stream(fields) == order
+
+
+def test_changed_cart_writes_nothing(r, run):
+    run(main.cart_add(1, "Латте", 3))
+
+    assert _commit(run, cart={"Латте": 2}) is None
+    assert _commit(run, cart={"Латте": 3, "Капучино": 1}) is None
+
+    assert run(main.cart_get(1)) == {"Латте": 3}
+    assert not run(r.exists(main.ORDER_SEQ_KEY))
+    assert run(r.xlen(main.ORDER_STREAM_KEY)) == 0
+    assert not run(r.exists(main._rate_limit_key("order", 1)))
+
+
+def test_rate_limit_is_checked_in_the_same_script(r, run):
+    run(main.cart_add(1, "Латте", 1))
+    assert _commit(run, cart={"Латте": 1}).order_id == 1
+
+    run(main.cart_add(1, "Латте", 1))
+    with pytest.raises(main.OrderRateLimited) as exc:
+        _commit(run, cart={"Латте": 1})
+
+    policy = main.RATE_LIMIT_POLICIES["order"]
+    assert 0 < exc.value.retry_after <= policy.window_seconds
+    assert run(main.cart_get(1)) == {"Латте": 1}
+    assert run(r.xlen(main.ORDER_STREAM_KEY)) == 1
+
+
+def test_rate_limit_is_per_user(r, run):
+    for user_id in (1, 2):
+        run(main.cart_add(user_id, "Латте", 1))
+        assert _commit(run, user_id=user_id, cart={"Латте": 1}).order_id == user_id
@@ -0,0 +1,144 @@
+import os
+
+import pytest
+
+import main
+from conftest import deliver_orders
+
+
+@pytest.fixture(autouse=True)
+def setup(monkeypatch, r, run):
+    monkeypatch.setattr(main, "MENU", {"Латте": 200, "Раф": 250})
+    monkeypatch.setattr(main, "ORDER_BLOCK_MS", None)
+    run(main.ensure_order_groups(r))
+
+
+def _place(run, user_id, cart):
+    run(main.cart_replace(user_id, cart))
+    total = sum(main.MENU[d] * q for d, q in cart.items())
+    return run(main.commit_order(user_id, "Петя", "petya", cart, total, 20))
+
+
+def test_stats_are_applied_once_per_entry(r, run):
+    _place(run, 1, {"Латте": 2, "Раф": 1})
+    [(msg_id, order)] = deliver_orders(run, r, main.ORDER_GROUP_STATS)
+
+    run(main._apply_order_stats(None, msg_id, order))
+    run(main._apply_order_stats(None, msg_id, order))
+
+    assert run(r.get(main.STATS_TOTAL_ORDERS)) == "1"
+    assert run(r.get(main.STATS_TOTAL_REVENUE)) == "650"
+    assert run(r.hgetall(main.STATS_DRINKS_KEY)) == {"Латте": "2", "Раф": "1"}
+    assert run(r.hgetall(main.STATS_DRINKS_REV_KEY)) == {"Латте": "400", "Раф": "250"}
+    assert run(r.xpending(main.ORDER_STREAM_KEY, main.ORDER_GROUP_STATS))["pending"] == 0
+
+
+def test_profile_is_applied_once_per_entry(r, run):
+    _place(run, 1, {"Латте": 2})
+    [(msg_id, order)] = deliver_orders(run, r, main.ORDER_GROUP_PROFILE)
+
+    run(main._apply_order_profile(None, msg_id, order))
+    run(main._apply_order_profile(None, msg_id, order))
+
+    profile = run(r.hgetall(f"{main.CUSTOMER_KEY_PREFIX}1"))
+    assert (profile["total_orders"], profile["total_spent"]) == ("1", "400")
+    assert run(r.sismember(main.CUSTOMERS_SET_KEY, 1))
+    assert run(r.zscore(main.SEGMENT_SPEND_KEY, 1)) == 400
+    assert run(r.sismember(main._segment_drink_key("Латте"), 1))
+    assert run(r.zscore(main.CUSTOMERS_DUE_KEY, 1)) == order.ts + main.RETURN_CYCLE_DAYS * 86400
+
+
+def test_notify_enqueues_outbox_item_once(r, run, bot):
+    order = _place(run, 1, {"Латте": 1})
+    [(msg_id, delivered)] = deliver_orders(run, r, main.ORDER_GROUP_NOTIFY)
+
+    run(main._notify_order(bot, msg_id, delivered))
+    run(main._notify_order(bot, msg_id, delivered))
+
+    assert run(r.zrange(main.OUTBOX_PENDING_KEY, 0, -1)) == [f"order-{order.order_id}"]
+    assert f"#{order.order_id}" in run(r.hget(main._outbox_item_key(f"order-{order.order_id}"), "text"))
+
+
+def test_consume_batch_reads_new_entries_for_each_group(r, run, bot):
+    _place(run, 1, {"Латте": 1})
+    _place(run, 2, {"Раф": 2})
+
+    for group in main.ORDER_CONSUMERS:
+        assert run(main.order_consume_batch(bot, group)) == 2
+        assert run(r.xpending(main.ORDER_STREAM_KEY, group))["pending"] == 0
+
+    assert run(r.get(main.STATS_TOTAL_ORDERS)) == "2"
+    assert run(r.scard(main.CUSTOMERS_SET_KEY)) == 2
+    assert run(r.zcard(main.OUTBOX_PENDING_KEY)) == 2
+
+
+def test_failed_entry_is_reclaimed_then_dead_lettered(r, run, bot, monkeypatch):
+    monkeypatch.setattr(main, "ORDER_CLAIM_IDLE_MS", 0)
+    monkeypatch.setattr(main, "ORDER_MAX_DELIVERIES", 3)
+    calls = []
+
+    async def failing(bot, msg_id, order):
+        calls.append(msg_id)
+        raise RuntimeError("boom")
+
+    monkeypatch.setitem(main.ORDER_CONSUMERS, main.ORDER_GROUP_STATS, failing)
+    order = _place(run, 1, {"Латте": 1})
+
+    for _ in range(5):
+        run(main.order_consume_batch(bot, main.ORDER_GROUP_STATS))
+
+    assert len(calls) == 3
+    assert run(r.xpending(main.ORDER_STREAM_KEY, main.ORDER_GROUP_STATS))["pending"] == 0
+    [(_, dead)] = run(r.xrange(main.ORDER_DEAD_STREAM_KEY))
+    assert dead["order_id"] == str(order.order_id)
+    assert (dead["dead_group"], dead["dead_msg_id"], dead["dead_deliveries"]) == ("stats", calls[0], "4")
+
+
+def test_entries_of_a_dead_consumer_are_claimed(r, run, bot, monkeypatch):
+    monkeypatch.setattr(main, "ORDER_CLAIM_IDLE_MS", 0)
+    _place(run, 1, {"Латте": 1})
+    run(r.xreadgroup(main.ORDER_GROUP_STATS, "crashed-replica", {main.ORDER_STREAM_KEY: ">"}))
+
+    assert run(main.order_consume_batch(bot, main.ORDER_GROUP_STATS)) == 1
+    assert run(r.get(main.STATS_TOTAL_ORDERS)) == "1"
+    assert run(r.xpending(main.ORDER_STREAM_KEY, main.ORDER_GROUP_STATS))["pending"] == 0
+
+
+def test_consumer_name_is_per_process():
+    assert main.ORDER_CONSUMER_NAME.endswith(f"-{os.getpid()}")
+
+
+def test_trim_keeps_entries_a_lagging_group_has_not_acked(r, run, bot):
+    for user_id in range(1, 4):
+        _place(run, user_id, {"Латте": 1})
+    ids = [msg_id for msg_id, _ in run(r.xrange(main.ORDER_STREAM_KEY))]
+
+    # stats и notify всё обработали, profile ещё ничего не читал
+    for group in (main.ORDER_GROUP_STATS, main.ORDER_GROUP_NOTIFY):
+        run(main.order_consume_batch(bot, group))
+    assert run(main.order_trim_stream(r)) == 0
+    assert run(r.xlen(main.ORDER_STREAM_KEY)) == 3
+
+    # profile прочитал всё, но первая запись осталась в pending
+    deliver_orders(run, r, main.ORDER_GROUP_PROFILE)
+    for msg_id in ids[1:]:
+        run(r.xack(main.ORDER_STREAM_KEY, main.ORDER_GROUP_PROFILE, msg_id))
+    run(main.order_trim_stream(r))
+    assert run(r.xlen(main.ORDER_STREAM_KEY)) == 3
+
+    run(r.xack(main.ORDER_STREAM_KEY, main.ORDER_GROUP_PROFILE, ids[0]))
+    run(main.order_trim_stream(r))
+    assert [msg_id for msg_id, _ in run(r.xrange(main.ORDER_STREAM_KEY))] == ids[2:]
+
+
+def test_trim_removes_idle_consumers_without_pending(r, run, monkeypatch):
+    _place(run, 1, {"Латте": 1})
+    group = main.ORDER_GROUP_STATS
+    run(r.xreadgroup(group, "old-host-1", {main.ORDER_STREAM_KEY: ">"}))
+    run(r.xgroup_createconsumer(main.ORDER_STREAM_KEY, group, "old-host-2"))
+    monkeypatch.setattr(main, "ORDER_CONSUMER_IDLE_DELETE_MS", -1)
+
+    run(main.order_trim_stream(r))
+
+    consumers = {c["name"] for c in run(r.xinfo_consumers(main.ORDER_STREAM_KEY, group))}
+    assert consumers == {"old-host-1"}
@@ -0,0 +1,76 @@
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import main
+
+_METHOD = SendMessage(chat_id=1, text="x")
+
+
+class FakeBot:
+    """send_message по очереди поднимает исключения из errors[chat_id], потом отвечает успехом."""
+
+    def __init__(self, errors=None):
+        self.errors = {chat_id: list(items) for chat_id, items in (errors or {}).items()}
+        self.calls = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append((chat_id, time.monotonic()))
+        pending = self.errors.get(chat_id)
+        if pending:
+            raise pending.pop(0)
+
+
+def _sender(**kwargs):
+    options = {"rate_per_second": 1000, "concurrency": 8, "per_chat_interval": 0, "max_retries": 3}
+    options.update(kwargs)
+    return main.OutboundSender(**options)
+
+
+def test_errors_are_split_into_permanent_and_temporary(run):
+    bot = FakeBot({
+        2: [TelegramForbiddenError(_METHOD, "bot was blocked by the user")],
+        3: [TelegramBadRequest(_METHOD, "Bad Request: chat not found")],
+        4: [TelegramBadRequest(_METHOD, "Bad Request: message is too long")],
+    })
+
+    results = run(_sender().send_many(bot, [(1, "a"), (2, "b"), (3, "c"), (4, "d")]))
+
+    assert results == {1: main.SEND_OK, 2: main.SEND_BLOCKED, 3: main.SEND_BLOCKED, 4: main.SEND_FAILED}
+    assert [chat_id for chat_id, _ in bot.calls].count(4) == 1
+
+
+def test_retry_after_is_retried(run):
+    bot = FakeBot({1: [TelegramRetryAfter(_METHOD, "Too Many Requests", retry_after=0)]})
+
+    assert run(_sender().send(bot, 1, "a")) == main.SEND_OK
+    assert len(bot.calls) == 2
+
+
+def test_retry_after_exhausts_attempts(run):
+    bot = FakeBot({1: [TelegramRetryAfter(_METHOD, "Too Many Requests", retry_after=0)] * 3})
+
+    assert run(_sender(max_retries=2).send(bot, 1, "a")) == main.SEND_FAILED
+    assert len(bot.calls) == 3
+
+
+def test_token_bucket_limits_rate(run):
+    bot = FakeBot()
+    sender = _sender(rate_per_second=10)
+
+    # ведро на rate токенов: первые 10 сразу, ещё 3 — по одному за 0.1 с
+    started = time.monotonic()
+    run(sender.send_many(bot, [(chat_id, "a") for chat_id in range(13)]))
+
+    assert time.monotonic() - started >= 0.25
+
+
+def test_same_chat_is_spaced(run):
+    bot = FakeBot()
+    sender = _sender(per_chat_interval=0.1)
+
+    run(sender.send_many(bot, [(1, "a"), (2, "b"), (1, "c")]))
+
+    first, second = [at for chat_id, at in bot.calls if chat_id == 1]
+    assert second - first >= 0.09
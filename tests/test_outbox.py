@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+import pytest
+
+import main
+
+
+class FakeOutbound:
+    def __init__(self, results=None, delay=0.0):
+        self.results = results or {}
+        self.delay = delay
+        self.sent = []
+
+    async def send(self, bot, chat_id, text, **kwargs):
+        self.sent.append(chat_id)
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return self.results.get(chat_id, main.SEND_OK)
+
+
+@pytest.fixture
+def outbound(monkeypatch):
+    fake = FakeOutbound({2: main.SEND_FAILED, 3: main.SEND_BLOCKED})
+    monkeypatch.setattr(main, "notify_outbound", fake)
+    return fake
+
+
+def test_claim_leases_items(r, run):
+    item_id = run(main.outbox_enqueue(1, "hi"))
+    now = int(time.time())
+    claim = main.redis_script(main.OUTBOX_CLAIM_LUA)
+
+    assert run(claim(keys=[main.OUTBOX_PENDING_KEY], args=[now, now + 60, 10])) == [item_id]
+    assert run(claim(keys=[main.OUTBOX_PENDING_KEY], args=[now, now + 60, 10])) == []
+    assert run(r.zscore(main.OUTBOX_PENDING_KEY, item_id)) == now + 60
+
+
+def test_batch_settles_each_result(r, run, bot, outbound):
+    ok, failed, blocked = (run(main.outbox_enqueue(chat_id, "hi")) for chat_id in (1, 2, 3))
+
+    assert run(main.outbox_process_batch(bot)) == 3
+
+    assert not run(r.exists(main._outbox_item_key(ok)))
+    assert run(r.hget(main._outbox_item_key(failed), "attempts")) == "1"
+    assert run(r.zscore(main.OUTBOX_PENDING_KEY, failed)) > time.time()
+    assert run(r.lrange(main.OUTBOX_DEAD_KEY, 0, -1)) == [blocked]
+    assert run(r.zrange(main.OUTBOX_PENDING_KEY, 0, -1)) == [failed]
+
+
+def test_item_dies_after_max_attempts_and_can_be_requeued(r, run, bot, outbound, monkeypatch):
+    monkeypatch.setattr(main, "OUTBOX_RETRY_BASE_SECONDS", 0)
+    item_id = run(main.outbox_enqueue(2, "hi"))
+
+    for _ in range(main.OUTBOX_MAX_ATTEMPTS):
+        run(main.outbox_process_batch(bot))
+
+    assert run(r.lrange(main.OUTBOX_DEAD_KEY, 0, -1)) == [item_id]
+    assert run(r.zcard(main.OUTBOX_PENDING_KEY)) == 0
+
+    assert run(main.outbox_requeue_dead()) == 1
+    assert run(r.hget(main._outbox_item_key(item_id), "attempts")) == "0"
+    assert run(r.zrange(main.OUTBOX_PENDING_KEY, 0, -1)) == [item_id]
+
+
+def test_lease_is_renewed_while_batch_is_sending(r, run, bot, monkeypatch):
+    monkeypatch.setattr(main, "notify_outbound", FakeOutbound(delay=2.5))
+    monkeypatch.setattr(main, "OUTBOX_LEASE_SECONDS", 2)
+    monkeypatch.setattr(main, "OUTBOX_LEASE_RENEW_SECONDS", 0.5)
+    run(main.outbox_enqueue(1, "hi"))
+
+    async def scenario():
+        first = asyncio.create_task(main.outbox_process_batch(bot))
+        await asyncio.sleep(2.2)
+        second = await main.outbox_process_batch(bot)
+        return await first, second
+
+    assert run(scenario()) == (1, 0)
+    assert main.notify_outbound.sent == [1]
+    assert run(r.zcard(main.OUTBOX_PENDING_KEY)) == 0
+
+
+def test_outbox_is_not_queued_behind_a_broadcast(r, run, bot, session, monkeypatch):
+    for name, rate in (("outbound", 25), ("notify_outbound", 5)):
+        monkeypatch.setattr(main, name, main.OutboundSender(rate, 4, per_chat_interval=1.0, max_retries=0))
+
+    async def scenario():
+        # рассылка выбрала все токены общего bucket и упёрлась в flood wait
+        main.outbound.bucket.pause(60)
+        broadcast = asyncio.create_task(main.outbound.send_many(bot, [(1000 + i, "promo") for i in range(50)]))
+        await asyncio.sleep(0)
+        await main.outbox_enqueue(1, "new order")
+        started = time.monotonic()
+        processed = await asyncio.wait_for(main.outbox_process_batch(bot), timeout=2)
+        broadcast.cancel()
+        return processed, time.monotonic() - started
+
+    processed, elapsed = run(scenario())
+    assert processed == 1 and elapsed < 1
+    assert [(chat, text) for method, chat, text in session.requests] == [(1, "new order")]
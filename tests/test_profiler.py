@@ -0,0 +1,87 @@
+import asyncio
+import pstats
+import time
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def profile_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "PROFILE_DIR", str(tmp_path))
+    return tmp_path
+
+
+async def spin(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        sum(i * i for i in range(2000))
+        await asyncio.sleep(0)
+
+
+async def profile_while_spinning(seconds, mode):
+    busy = asyncio.create_task(spin(seconds + 0.1))
+    try:
+        return await main.run_profile(seconds, mode)
+    finally:
+        await busy
+
+
+def test_sample_mode_writes_collapsed_stacks(run, profile_dir):
+    result = run(profile_while_spinning(0.3, "sample"))
+
+    assert result.samples > 0
+    assert result.path.startswith(str(profile_dir)) and result.path.endswith(".collapsed")
+    lines = open(result.path, encoding="utf-8").read().splitlines()
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) == result.samples
+    assert any("test_profiler.py:spin" in line for line in lines)
+    assert "%" in result.summary
+
+
+def test_cpu_mode_dumps_pstats(run):
+    result = run(profile_while_spinning(0.2, "cpu"))
+
+    assert result.path.endswith(".pstats")
+    functions = {name for _, _, name in pstats.Stats(result.path).stats}
+    assert "spin" in functions
+    assert "cumulative" in result.summary
+
+
+def test_single_session_at_a_time(run):
+    async def scenario():
+        first = asyncio.create_task(main.run_profile(0.1, "cpu"))
+        await asyncio.sleep(0)
+        with pytest.raises(main.ProfilerBusy):
+            await main.run_profile(0.1, "cpu")
+        await first
+        return await main.run_profile(0.01, "cpu")
+
+    assert run(scenario()).mode == "cpu"
+
+
+def test_parse_profile_args():
+    assert main.parse_profile_args([]) == (main.PROFILE_DEFAULT_SECONDS, "sample")
+    assert main.parse_profile_args(["cpu", "3"]) == (3.0, "cpu")
+    with pytest.raises(ValueError):
+        main.parse_profile_args([str(main.PROFILE_MAX_SECONDS + 1)])
+    with pytest.raises(ValueError):
+        main.parse_profile_args(["0"])
+
+
+def test_admin_profile_handler_auth_and_validation(run, monkeypatch):
+    def request(query, token):
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        return make_mocked_request("GET", f"/admin/profile?{query}", headers=headers)
+
+    monkeypatch.setattr(main, "ADMIN_HTTP_TOKEN", "")
+    assert run(main.admin_profile_handler(request("seconds=1", "x"))).status == 401
+
+    monkeypatch.setattr(main, "ADMIN_HTTP_TOKEN", "secret")
+    assert run(main.admin_profile_handler(request("seconds=1", "wrong"))).status == 401
+    assert run(main.admin_profile_handler(request("seconds=999", "secret"))).status == 400
+
+    response = run(main.admin_profile_handler(request("seconds=0.05&mode=cpu", "secret")))
+    assert response.status == 200
+    assert response.headers["X-Profile-Path"].endswith(".pstats")
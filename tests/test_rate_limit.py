@@ -0,0 +1,85 @@
+import time
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+
+import main
+from conftest import message_update
+
+
+@pytest.fixture
+def policies(monkeypatch):
+    monkeypatch.setitem(main.RATE_LIMIT_POLICIES, "text", main.RateLimitPolicy(limit=3, window_seconds=60))
+
+
+def test_sliding_window_allows_limit_then_blocks(r, run, policies):
+    assert [run(main.rate_limit_hit("text", 1)) for _ in range(3)] == [0, 0, 0]
+
+    retry_after = run(main.rate_limit_hit("text", 1))
+    assert 59 < retry_after <= 60
+    assert run(r.zcard(main._rate_limit_key("text", 1))) == 3
+    assert run(main.rate_limit_hit("text", 2)) == 0
+
+
+def test_old_hits_leave_the_window(r, run, policies):
+    key = main._rate_limit_key("text", 1)
+    old_ms = int((time.time() - 61) * 1000)
+    run(r.zadd(key, {f"{old_ms}:{i}": old_ms for i in range(3)}))
+
+    assert run(main.rate_limit_hit("text", 1)) == 0
+    assert run(r.zcard(key)) == 1
+    assert 0 < run(r.pttl(key)) <= 60_000
+
+
+def test_notice_is_due_once_per_block(r, run):
+    assert run(main.rate_limit_notice_due(1, 12.3))
+    assert not run(main.rate_limit_notice_due(1, 12.3))
+    assert run(r.ttl(main._rate_limit_key("notice", 1))) == 13
+    assert run(main.rate_limit_notice_due(2, 12.3))
+
+
+def test_middleware_drops_flood_and_warns_once(r, run, bot, session, policies):
+    dp = main.build_dispatcher(RedisStorage(redis=r))
+    for i in range(6):
+        run(dp.feed_raw_update(bot, message_update(i + 1, 500, f"привет {i}")))
+
+    texts = [text for method, _, text in session.requests if method == "SendMessage"]
+    notices = [text for text in texts if text.startswith("⏳ Слишком много сообщений")]
+    assert len(texts) == 4
+    assert len(notices) == 1
+
+
+def test_only_free_text_is_charged_as_text(r, run, bot, policies, monkeypatch):
+    monkeypatch.setattr(main, "WORK_START", 0)
+    monkeypatch.setattr(main, "WORK_END", 24)
+    dp = main.build_dispatcher(RedisStorage(redis=r))
+    drink = next(iter(main.MENU))
+    # команды, кнопки, выбор напитка и ответы в состояниях бронирования
+    texts = ["/start", main.BTN_HOURS, main.BTN_READY_NOW, drink, main.BTN_CANCEL,
+             main.BTN_BOOKING, "15.02 19:00", "2", main.BTN_CANCEL] * 2
+    for i, text in enumerate(texts):
+        run(dp.feed_raw_update(bot, message_update(i + 1, 500, text)))
+
+    assert not run(r.exists(main._rate_limit_key("text", 500)))
+    assert not run(r.exists(main._rate_limit_key("booking", 500)))
+
+    run(dp.feed_raw_update(bot, message_update(100, 500, "просто текст")))
+    assert run(r.zcard(main._rate_limit_key("text", 500))) == 1
+
+
+def test_booking_is_charged_when_sent(r, run, bot, session, monkeypatch):
+    monkeypatch.setattr(main, "WORK_START", 0)
+    monkeypatch.setattr(main, "WORK_END", 24)
+    monkeypatch.setitem(main.RATE_LIMIT_POLICIES, "booking", main.RateLimitPolicy(limit=1, window_seconds=3600))
+    dp = main.build_dispatcher(RedisStorage(redis=r))
+    flow = [main.BTN_BOOKING, "15.02 19:00", "2", "-"]
+    texts = [main.BTN_BOOKING, main.BTN_CANCEL] * 3 + flow + flow
+    for i, text in enumerate(texts):
+        run(dp.feed_raw_update(bot, message_update(i + 1, 500, text)))
+
+    sent = [text for method, chat, text in session.requests if method == "SendMessage" and chat == 500]
+    assert sent.count("✅ Бронь отправлена админу.") == 1
+    assert sent[-1].startswith("⏳ Слишком много бронирований")
+    assert run(r.zcard(main._rate_limit_key("booking", 500))) == 1
+    assert run(dp.storage.get_state(StorageKey(bot.id, 500, 500))) is None
@@ -0,0 +1,73 @@
+import pytest
+
+import main
+
+
+class FakeExecutor:
+    def __init__(self, max_shard_queue=0):
+        self.max_shard_queue = max_shard_queue
+
+    def stats(self):
+        return {"max_shard_queue": self.max_shard_queue, "queued": self.max_shard_queue}
+
+
+@pytest.fixture
+def executor(monkeypatch):
+    fake = FakeExecutor()
+    monkeypatch.setattr(main, "update_executor", fake)
+    return fake
+
+
+def test_ready_when_every_dependency_is_ok(r, run, bot, session, executor):
+    result = run(main.ReadinessProbe().check(bot))
+
+    assert result["status"] == "ready"
+    assert set(result["checks"]) == {"redis", "loop_lag", "executor", "bot_api"}
+    assert [method for method, _, _ in session.requests] == ["GetMe"]
+
+
+def test_backlogged_shard_degrades_readiness(r, run, bot, executor):
+    executor.max_shard_queue = main.READY_SHARD_QUEUE_MAX + 1
+
+    result = run(main.ReadinessProbe().check(bot))
+
+    assert result["status"] == "degraded"
+    assert not result["checks"]["executor"]["ok"]
+    assert result["checks"]["redis"]["ok"]
+
+
+def test_unreachable_redis_degrades_readiness(run, bot, executor, monkeypatch):
+    async def down():
+        raise ConnectionError("redis down")
+
+    monkeypatch.setattr(main, "get_redis_client", down)
+
+    result = run(main.ReadinessProbe().check(bot))
+
+    assert result["status"] == "degraded"
+    assert result["checks"]["redis"] == {"ok": False, "error": "ConnectionError"}
+
+
+def test_result_and_bot_api_are_cached(r, run, bot, session, executor, monkeypatch):
+    probe = main.ReadinessProbe()
+    run(probe.check(bot))
+    run(probe.check(bot))
+    assert len(session.requests) == 1
+
+    monkeypatch.setattr(main, "READY_CACHE_SECONDS", 0)
+    run(probe.check(bot))
+    assert len(session.requests) == 1
+
+
+def test_readiness_handler_maps_status_to_http_code(r, run, bot, monkeypatch):
+    from aiohttp.test_utils import make_mocked_request
+
+    monkeypatch.setattr(main, "readiness", main.ReadinessProbe())
+    request = make_mocked_request("GET", "/ready", app={"bot": bot})
+    response = run(main.readiness_handler(request))
+    assert response.status == 503
+
+    monkeypatch.setattr(main, "update_executor", FakeExecutor())
+    monkeypatch.setattr(main, "readiness", main.ReadinessProbe())
+    response = run(main.readiness_handler(request))
+    assert response.status == 200
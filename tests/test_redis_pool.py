@@ -0,0 +1,47 @@
+import fakeredis
+import pytest
+import redis.asyncio as redis
+
+import main
+from conftest import FAKE_CONNECTION
+
+
+def _pool(server, **kwargs):
+    return main.InstrumentedRedisPool(
+        connection_class=FAKE_CONNECTION,
+        server=server,
+        decode_responses=True,
+        **kwargs,
+    )
+
+
+def test_helpers_share_one_client(r, run):
+    assert run(main.get_redis_client()) is r
+    assert run(main.get_redis_client()) is r
+
+
+def test_exhausted_pool_counts_timeout(run):
+    pool = _pool(fakeredis.FakeServer(), max_connections=1, timeout=0.05)
+    held = run(pool.get_connection())
+    with pytest.raises(redis.ConnectionError):
+        run(pool.get_connection())
+    run(pool.release(held))
+
+    stats = pool.stats()
+    assert stats["timeouts_total"] == 1
+    assert stats["errors_total"] == 0
+    assert stats["acquired_total"] == 1
+    run(pool.disconnect())
+
+
+def test_refused_connection_is_not_a_timeout(run):
+    server = fakeredis.FakeServer()
+    server.connected = False
+    pool = _pool(server, max_connections=2, timeout=0.05)
+    with pytest.raises(redis.ConnectionError):
+        run(pool.get_connection())
+
+    stats = pool.stats()
+    assert stats["timeouts_total"] == 0
+    assert stats["errors_total"] == 1
+    run(pool.disconnect())
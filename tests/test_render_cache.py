@@ -0,0 +1,42 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def menu(monkeypatch):
+    monkeypatch.setattr(main, "MENU", {"Латте": 200})
+    monkeypatch.setattr(main, "MENU_VERSION", 1)
+    main.invalidate_render_cache()
+    yield
+    main.invalidate_render_cache()
+
+
+def _buttons(kb):
+    return [button.text for row in kb.keyboard for button in row]
+
+
+def test_keyboard_is_built_once_per_version(menu):
+    first = main.create_client_menu_keyboard()
+    assert main.create_client_menu_keyboard() is first
+
+    main.MENU["Раф"] = 250
+    main.MENU_VERSION = 2
+    second = main.create_client_menu_keyboard()
+    assert second is not first
+    assert "Раф" in _buttons(second)
+
+
+def test_invalidate_drops_cached_keyboards(menu):
+    first = main.create_client_menu_keyboard()
+    main.MENU["Раф"] = 250
+    main.invalidate_render_cache()
+
+    assert "Раф" in _buttons(main.create_client_menu_keyboard())
+    assert "Раф" not in _buttons(first)
+
+
+def test_cart_keyboard_is_cached_per_flag(menu):
+    assert main.create_cart_keyboard(True) is main.create_cart_keyboard(True)
+    assert main.BTN_CLEAR_CART in _buttons(main.create_cart_keyboard(True))
+    assert main.BTN_CLEAR_CART not in _buttons(main.create_cart_keyboard(False))
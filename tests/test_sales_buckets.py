@@ -0,0 +1,43 @@
+from datetime import datetime
+
+import main
+
+
+def _msk(*args) -> datetime:
+    return datetime(*args, tzinfo=main.MSK_TZ)
+
+
+def test_range_uses_day_buckets_for_whole_days():
+    keys = main._bucket_keys_for_range(_msk(2026, 3, 1, 22, 30), _msk(2026, 3, 3, 1, 15))
+
+    assert keys == [
+        main._stats_hour_key(_msk(2026, 3, 1, 22)),
+        main._stats_hour_key(_msk(2026, 3, 1, 23)),
+        main._stats_day_key(_msk(2026, 3, 2)),
+        main._stats_hour_key(_msk(2026, 3, 3, 0)),
+        main._stats_hour_key(_msk(2026, 3, 3, 1)),
+    ]
+
+
+def test_summaries_merge_hour_and_day_buckets(r, run):
+    hour = main._stats_hour_key(_msk(2026, 3, 1, 23))
+    day = main._stats_day_key(_msk(2026, 3, 2))
+    run(r.hset(hour, mapping={"orders": 1, "revenue": 200, "qty:Латте": 1, "rev:Латте": 200}))
+    run(r.hset(day, mapping={
+        "orders": 3, "revenue": 560, "qty:Латте": 1, "rev:Латте": 200,
+        "qty:Раф": 2, "rev:Раф": 360, "hour:09": 2, "hour:23": 1,
+    }))
+
+    whole = run(main.get_sales_summary(_msk(2026, 3, 1, 23), _msk(2026, 3, 3)))
+
+    assert (whole.orders, whole.revenue) == (4, 760)
+    assert whole.drinks == {"Латте": 2, "Раф": 2}
+    assert whole.drinks_revenue == {"Латте": 400, "Раф": 360}
+    assert whole.orders_by_hour == {23: 2, 9: 2}
+
+
+def test_busiest_hour():
+    summary = main.SalesSummary(orders_by_hour={9: 2, 13: 5, 18: 1})
+
+    assert summary.busiest_hour == 13
+    assert main.SalesSummary().busiest_hour is None
@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+import main
+
+DAY = 86400
+
+
+@pytest.fixture
+def indexes(r, run):
+    now = int(time.time())
+    # user: (позиции, заказов, потрачено, дней с последнего заказа)
+    users = {
+        1: (["Латте"], 1, 200, 1),
+        2: (["Латте", "Раф"], 5, 1500, 20),
+        3: (["Раф"], 3, 900, 40),
+        4: (["Капучино"], 10, 3000, 2),
+    }
+    for user_id, (drinks, orders, spent, days_ago) in users.items():
+        for drink in drinks:
+            run(r.sadd(main._segment_drink_key(drink), user_id))
+        run(r.zadd(main.SEGMENT_ORDERS_KEY, {user_id: orders}))
+        run(r.zadd(main.SEGMENT_SPEND_KEY, {user_id: spent}))
+        run(r.zadd(main.SEGMENT_RECENCY_KEY, {user_id: now - days_ago * DAY}))
+
+
+def _members(run, r, segment):
+    dest, size = run(main.build_segment(segment))
+    members = sorted(int(m) for m in run(r.zrange(dest, 0, -1)))
+    assert size == len(members)
+    assert 0 < run(r.ttl(dest)) <= main.SEGMENT_RESULT_TTL_SECONDS
+    return members
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("", [1, 2, 3, 4]),
+    ("Латте, Раф", [1, 2, 3]),
+    ("Латте, Раф all", [2]),
+    ("orders=3", [2, 3, 4]),
+    ("Раф spent=1000", [2]),
+    ("inactive=14", [2, 3]),
+    ("active=7", [1, 4]),
+    ("Латте, Раф orders=2 inactive=30", [3]),
+])
+def test_segment_composition(r, run, indexes, raw, expected):
+    assert _members(run, r, main.parse_segment_args(raw)) == expected
+
+
+def test_result_score_is_last_order_ts(r, run, indexes):
+    dest, _ = run(main.build_segment(main.AudienceSegment(drinks=["Капучино"])))
+
+    assert run(r.zscore(dest, 4)) == run(r.zscore(main.SEGMENT_RECENCY_KEY, 4))
+
+
+def test_parse_segment_args():
+    segment = main.parse_segment_args("Латте, Флэт уайт inactive=14 orders=3 spent=1000 all")
+
+    assert segment.drinks == ["Латте", "Флэт уайт"]
+    assert segment.match_all_drinks
+    assert (segment.inactive_days, segment.min_orders, segment.min_spent) == (14, 3, 1000)
+    assert segment.active_days is None
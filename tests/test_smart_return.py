@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+import main
+
+
+class FakeOutbound:
+    def __init__(self, results):
+        self.results = results
+        self.sent = []
+
+    async def send_many(self, bot, messages, **kwargs):
+        self.sent += messages
+        return {chat_id: self.results.get(chat_id, main.SEND_OK) for chat_id, _ in messages}
+
+
+@pytest.fixture
+def outbound(monkeypatch):
+    fake = FakeOutbound({2: main.SEND_BLOCKED, 3: main.SEND_FAILED})
+    monkeypatch.setattr(main, "outbound", fake)
+    monkeypatch.setattr(main, "_in_send_window_msk", lambda: True)
+    return fake
+
+
+def _customer(run, r, user_id, **profile):
+    run(r.sadd(main.CUSTOMERS_SET_KEY, user_id))
+    run(r.hset(f"{main.CUSTOMER_KEY_PREFIX}{user_id}", mapping={"firstname": f"u{user_id}", **profile}))
+
+
+def test_due_index_drives_reminders(r, run, outbound):
+    now = int(time.time())
+    long_ago = now - (main.RETURN_CYCLE_DAYS + 1) * 86400
+    for user_id in (1, 2, 3):
+        _customer(run, r, user_id, last_order_ts=long_ago, favorite_drink="Раф")
+    _customer(run, r, 4, last_order_ts=now)
+    _customer(run, r, 5, last_order_ts=long_ago, offers_opt_out=1)
+    run(r.zadd(main.CUSTOMERS_DUE_KEY, {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}))
+
+    run(main.smart_return_check_and_send(None))
+
+    assert sorted(chat_id for chat_id, _ in outbound.sent) == [1, 2, 3]
+    assert "Раф" in dict(outbound.sent)[1]
+    due = dict(run(r.zrange(main.CUSTOMERS_DUE_KEY, 0, -1, withscores=True)))
+    assert due["1"] == pytest.approx(now + main.RETURN_COOLDOWN_DAYS * 86400, abs=2)
+    assert int(run(r.hget(f"{main.CUSTOMER_KEY_PREFIX}1", "last_trigger_ts"))) == pytest.approx(now, abs=2)
+    assert "2" not in due and not run(r.sismember(main.CUSTOMERS_SET_KEY, 2))
+    assert due["3"] == pytest.approx(now + main.RETURN_RETRY_SECONDS, abs=2)
+    assert due["4"] == pytest.approx(now + main.RETURN_CYCLE_DAYS * 86400, abs=2)
+    assert "5" not in due
+
+
+def test_not_due_customers_are_not_read(r, run, outbound):
+    _customer(run, r, 1, last_order_ts=0)
+    run(r.zadd(main.CUSTOMERS_DUE_KEY, {1: int(time.time()) + 3600}))
+
+    run(main.smart_return_check_and_send(None))
+
+    assert outbound.sent == []
+
+
+def test_backfill_indexes_existing_customers_once(r, run):
+    _customer(run, r, 1, last_order_ts=1000)
+    _customer(run, r, 2, last_order_ts=1000, last_trigger_ts=2000)
+    _customer(run, r, 3, last_order_ts=1000, offers_opt_out=1)
+
+    assert run(main.backfill_customers_due(r)) == 2
+    due = dict(run(r.zrange(main.CUSTOMERS_DUE_KEY, 0, -1, withscores=True)))
+    assert due == {
+        "1": 1000 + main.RETURN_CYCLE_DAYS * 86400,
+        "2": max(1000 + main.RETURN_CYCLE_DAYS * 86400, 2000 + main.RETURN_COOLDOWN_DAYS * 86400),
+    }
+    assert run(main.backfill_customers_due(r)) == 0
@@ -0,0 +1,49 @@
+import json
+import time
+
+import main
+
+
+def _count_redis_calls(run, coro):
+    usage = [0, 0.0]
+    token = main._update_redis_usage.set(usage)
+    try:
+        result = run(coro)
+    finally:
+        main._update_redis_usage.reset(token)
+    return result, usage[0]
+
+
+def test_start_context_is_one_round_trip(r, run):
+    snapshot = {"cart": {"Латте": 2}, "total": 400, "ts": 1}
+    run(r.set(main.MENU_VERSION_KEY, 7))
+    run(r.set(main._last_seen_key(42), str(time.time() - 3 * 86400)))
+    run(r.set(main._last_order_key(42), json.dumps(snapshot, ensure_ascii=False)))
+
+    ctx, calls = _count_redis_calls(run, main.load_start_context(42))
+
+    assert calls == 1
+    assert ctx.menu_version == 7
+    assert ctx.last_order == snapshot
+    assert ctx.offer_repeat
+    assert float(run(r.get(main._last_seen_key(42)))) > ctx.last_seen_ts
+
+
+def test_start_context_for_new_user(r, run):
+    ctx, calls = _count_redis_calls(run, main.load_start_context(43))
+
+    assert calls == 1
+    assert ctx.menu_version == 0
+    assert ctx.last_order is None
+    assert not ctx.offer_repeat
+    assert run(r.exists(main._last_seen_key(43)))
+
+
+def test_same_day_visit_does_not_offer_repeat(r, run):
+    run(r.set(main._last_seen_key(44), str(time.time())))
+    run(r.set(main._last_order_key(44), json.dumps({"cart": {"Латте": 1}})))
+
+    ctx = run(main.load_start_context(44))
+
+    assert ctx.last_order
+    assert not ctx.offer_repeat
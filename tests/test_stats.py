@@ -0,0 +1,35 @@
+import main
+
+
+def test_migration_moves_legacy_keys_into_hashes(r, run):
+    run(r.set(f"{main.STATS_DRINK_PREFIX}Латте", 5))
+    run(r.set(f"{main.STATS_DRINK_PREFIX}Раф", 1))
+    run(r.set(f"{main.STATS_DRINK_REV_PREFIX}Латте", 1000))
+    run(r.hset(main.STATS_DRINKS_KEY, "Латте", 2))
+
+    run(main.migrate_drink_stats_to_hash())
+
+    assert run(r.hgetall(main.STATS_DRINKS_KEY)) == {"Латте": "7", "Раф": "1"}
+    assert run(r.hgetall(main.STATS_DRINKS_REV_KEY)) == {"Латте": "1000"}
+    assert run(r.keys(f"{main.STATS_DRINK_PREFIX}*")) == []
+    assert run(r.keys(f"{main.STATS_DRINK_REV_PREFIX}*")) == []
+    assert run(r.exists(main.STATS_MIGRATED_KEY))
+
+
+def test_migration_runs_once(r, run):
+    run(main.migrate_drink_stats_to_hash())
+    run(r.set(f"{main.STATS_DRINK_PREFIX}Латте", 5))
+
+    run(main.migrate_drink_stats_to_hash())
+
+    assert run(r.get(f"{main.STATS_DRINK_PREFIX}Латте")) == "5"
+    assert not run(r.exists(main.STATS_DRINKS_KEY))
+
+
+def test_migration_batch_skips_vanished_keys(r, run):
+    run(r.set(f"{main.STATS_DRINK_PREFIX}Латте", 3))
+    keys = [f"{main.STATS_DRINK_PREFIX}Латте", f"{main.STATS_DRINK_PREFIX}Раф"]
+
+    run(main._migrate_stats_batch(keys, main.STATS_DRINK_PREFIX, main.STATS_DRINKS_KEY))
+
+    assert run(r.hgetall(main.STATS_DRINKS_KEY)) == {"Латте": "3"}
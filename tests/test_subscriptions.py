@@ -0,0 +1,62 @@
+import time
+
+import main
+
+
+def _cafe(run, r, cafe_id, admin_id, valid_until):
+    run(r.hset(main.k_cafe_profile(cafe_id), mapping={"admin_id": admin_id}))
+    run(r.hset(main.k_admin_subscription(cafe_id), mapping={
+        "cafebotify_paid": "1",
+        "cafebotify_valid_until": valid_until,
+    }))
+    run(main.index_cafe(r, cafe_id))
+
+
+def _sent_to(session, chat_id):
+    return [text for method, chat, text in session.requests if method == "SendMessage" and chat == chat_id]
+
+
+def test_expire_script_respects_renewal(r, run):
+    key = main.k_admin_subscription("c1")
+    run(r.hset(key, mapping={"cafebotify_paid": "1", "cafebotify_valid_until": 2000}))
+
+    assert run(main.redis_script(main.SUB_EXPIRE_LUA)(keys=[key], args=[1000])) == 0
+    assert run(r.hget(key, "cafebotify_paid")) == "1"
+    assert run(main.redis_script(main.SUB_EXPIRE_LUA)(keys=[key], args=[2000])) == 1
+    assert run(r.hget(key, "cafebotify_paid")) == "0"
+
+
+def test_scanner_blocks_expired_and_reminds_soon_expiring(r, run, bot, session):
+    now = int(time.time())
+    _cafe(run, r, "expired", "101", now - 60)
+    _cafe(run, r, "soon", "102", now + main.SUBS_REMIND_DAYS_BEFORE * 86400)
+    _cafe(run, r, "later", "103", now + 30 * 86400)
+
+    run(main.subs_check_and_notify(bot))
+
+    assert run(r.hget(main.k_admin_subscription("expired"), "cafebotify_paid")) == "0"
+    assert run(r.zrange(main.CAFES_ACTIVE_SUBS_KEY, 0, -1)) == ["soon", "later"]
+    assert len(_sent_to(session, 101)) == 1
+    assert len(_sent_to(session, 102)) == 1
+    assert _sent_to(session, 103) == []
+
+
+def test_reminder_is_sent_once_per_period(r, run, bot, session):
+    now = int(time.time())
+    _cafe(run, r, "soon", "102", now + main.SUBS_REMIND_DAYS_BEFORE * 86400)
+
+    run(main.subs_check_and_notify(bot))
+    run(r.delete(main.SUBS_SCAN_LOCK_KEY))
+    run(main.subs_check_and_notify(bot))
+
+    assert len(_sent_to(session, 102)) == 1
+
+
+def test_scan_lock_lets_one_replica_scan(r, run, bot, session):
+    _cafe(run, r, "expired", "101", int(time.time()) - 60)
+    run(r.set(main.SUBS_SCAN_LOCK_KEY, "other"))
+
+    run(main.subs_check_and_notify(bot))
+
+    assert run(r.hget(main.k_admin_subscription("expired"), "cafebotify_paid")) == "1"
+    assert session.requests == []
@@ -0,0 +1,142 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import main
+from conftest import message_update
+
+
+class FakeDispatcher:
+    """feed_raw_update отмечает начало и конец обработки, чтобы проверить порядок внутри чата."""
+
+    def __init__(self, delay=0.01, fail_on=(), delays=None):
+        self.delay = delay
+        self.delays = delays or {}
+        self.fail_on = set(fail_on)
+        self.events = []
+        self.started = []
+        self.active_chats = set()
+        self.overlap = False
+
+    async def feed_raw_update(self, bot, update, **kwargs):
+        chat_id = main.update_shard_key(update)
+        if chat_id in self.active_chats:
+            self.overlap = True
+        self.active_chats.add(chat_id)
+        self.started.append((chat_id, update["update_id"]))
+        try:
+            await asyncio.sleep(self.delays.get(chat_id, self.delay))
+            if update["update_id"] in self.fail_on:
+                raise RuntimeError("boom")
+            self.events.append((chat_id, update["update_id"]))
+        finally:
+            self.active_chats.discard(chat_id)
+
+
+def test_shard_key_is_the_chat():
+    assert main.update_shard_key(message_update(1, 500, "hi")) == 500
+    assert main.update_shard_key({"update_id": 9}) == 9
+
+
+def test_updates_of_one_chat_run_in_order(run):
+    dp = FakeDispatcher()
+
+    async def scenario():
+        executor = main.UpdateExecutor(dp, bot=None, workers=4, queue_size=100)
+        executor.start()
+        for i in range(1, 31):
+            assert executor.submit(message_update(i, 100 + i % 3, "hi"))
+        await executor.stop()
+        return executor
+
+    executor = run(scenario())
+
+    assert executor.processed == 30
+    assert not dp.overlap
+    for chat_id in (100, 101, 102):
+        ids = [update_id for chat, update_id in dp.events if chat == chat_id]
+        assert ids == sorted(ids) and len(ids) == 10
+
+
+def test_full_shard_rejects_and_errors_are_counted(run):
+    dp = FakeDispatcher(fail_on={2})
+
+    async def scenario():
+        executor = main.UpdateExecutor(dp, bot=None, workers=1, queue_size=2)
+        accepted = [executor.submit(message_update(i, 100, "hi")) for i in range(1, 5)]
+        executor.start()
+        await executor.stop()
+        return executor, accepted
+
+    executor, accepted = run(scenario())
+
+    assert accepted == [True, True, False, False]
+    assert executor.stats()["rejected"] == 2
+    assert (executor.processed, executor.errors) == (1, 1)
+
+
+def test_slow_chat_does_not_stall_its_shard(run):
+    dp = FakeDispatcher(delays={100: 0.5})
+
+    async def scenario():
+        executor = main.UpdateExecutor(dp, bot=None, workers=1, queue_size=100, shard_workers=2)
+        executor.start()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for i, chat_id in enumerate((100, 100, 200, 200), start=1):
+            executor.submit(message_update(i, chat_id, "hi"))
+        while len([e for e in dp.events if e[0] == 200]) < 2:
+            await asyncio.sleep(0.01)
+        fast_done = loop.time() - started
+        await executor.stop()
+        return fast_done
+
+    assert run(scenario()) < 0.3
+    assert not dp.overlap
+    assert [u for chat, u in dp.events if chat == 100] == [1, 2]
+
+
+def test_order_holds_with_several_workers_per_shard(run):
+    dp = FakeDispatcher(delay=0.005)
+
+    async def scenario():
+        executor = main.UpdateExecutor(dp, bot=None, workers=2, queue_size=100, shard_workers=4)
+        executor.start()
+        for i in range(1, 61):
+            executor.submit(message_update(i, 100 + i % 5, "hi"))
+        await executor.stop()
+        return executor
+
+    executor = run(scenario())
+
+    assert executor.processed == 60 and not dp.overlap
+    assert executor._chat_backlog == {}
+    for chat_id in range(100, 105):
+        assert [u for chat, u in dp.started if chat == chat_id] == sorted(u for chat, u in dp.started if chat == chat_id)
+
+
+def test_webhook_handler_uses_the_public_surface(run, bot):
+    assert "_handle_request_background" not in vars(main.ExecutorRequestHandler)
+    assert issubclass(main.ExecutorRequestHandler, main.BaseRequestHandler)
+    dp = FakeDispatcher(delay=0.2)
+
+    async def scenario():
+        executor = main.UpdateExecutor(dp, bot=bot, workers=1, queue_size=1, shard_workers=1)
+        app = web.Application()
+        main.ExecutorRequestHandler(executor, dispatcher=dp, bot=bot, secret_token="s3").register(app, path="/wh")
+        statuses = []
+        async with TestClient(TestServer(app)) as client:
+            resp = await client.post("/wh", json=message_update(1, 100, "hi"))
+            statuses.append(resp.status)
+            # первый апдейт в работе, второй ждёт в очереди шарда, третьему места нет
+            for i in (1, 2, 3):
+                resp = await client.post(
+                    "/wh", json=message_update(i, 100, "hi"), headers={"X-Telegram-Bot-Api-Secret-Token": "s3"}
+                )
+                statuses.append(resp.status)
+        return statuses, executor
+
+    statuses, executor = run(scenario())
+    assert statuses == [401, 200, 200, 503]
+    assert executor.processed == 2 and executor.rejected == 1